@@ -53,6 +53,14 @@ class Decomposer(object):
                     derivative spectroscopy
             manual: Where a spectrum has been fit manually using pyspeckit's
                     interactive fitter
+    backend : string
+        The fitter used for non-interactive fits. Current options:
+
+            pyspeckit: (default) fit using pyspeckit
+            native:    fit using scousepy's own Levenberg-Marquardt fitter.
+                       Only available for fittype='gaussian'
+    nativefit : dictionary
+        The result of a fit performed with the native backend
 
     """
     def __init__(self,spectral_axis,spectrum,rms):
@@ -80,6 +88,8 @@ class Decomposer(object):
         self.no_negative=False
         self.happy=False
         self.conditions=None
+        self.backend='pyspeckit'
+        self.nativefit=None
 
     def fit_spectrum_with_guesses(self, guesses, fittype='gaussian', method='dspec'):
         """
@@ -101,7 +111,7 @@ class Decomposer(object):
         self.fit_a_spectrum()
         self.get_model_information()
 
-    def fit_spectrum_from_parent(self,guesses,guesses_parent,tol,res,fittype='gaussian',method='parent'):
+    def fit_spectrum_from_parent(self,guesses,guesses_parent,tol,res,fittype='gaussian',method='parent',nativefit=None):
         """
         The fitting method most commonly used by scouse. This method will fit
         a spectrum and compare the result against another model. Most commonly
@@ -120,6 +130,10 @@ class Decomposer(object):
             the channel spacing
         fittype : string
             A string describing the pyspeckit fitter
+        nativefit : dictionary, optional
+            native backend only. The result of an initial fit already
+            performed using gaussfit.fit_gaussians, e.g. as part of a stack of
+            spectra. If provided, the initial fit is not repeated
         """
         self.method=method
         self.fittype=fittype
@@ -128,18 +142,18 @@ class Decomposer(object):
         self.tol=tol
         self.res=res
 
-        if self.psktemplate is not None:
-            self.update_template()
+        if nativefit is not None:
+            self.nativefit=nativefit
         else:
-            self.create_a_spectrum()
-        self.fit_a_spectrum()
+            self.prepare_and_fit()
 
-        errors=np.copy(self.pskspectrum.specfit.modelerrs)
+        modelpars, modelerrs, parnames = self.get_fit_results()
+        errors=np.copy(modelerrs)
         errors=[np.nan if error is None else error for error in errors ]
         errors=np.asarray([np.nan if np.invert(np.isfinite(error)) else error for error in errors  ])
 
         if np.any(np.invert(np.isfinite(errors))):
-            guesses = np.copy(self.pskspectrum.specfit.modelpars)
+            guesses = np.copy(modelpars)
 
             # adding this in a loop to ensure numpy doesn't spit an error out
             rounding = []
@@ -155,7 +169,7 @@ class Decomposer(object):
             self.guesses = np.asarray([np.around(guess,decimals=int(rounding[i])) for i, guess in enumerate(guesses)])
 
             # first get the number of parameters and components
-            nparams=np.size(self.pskspectrum.specfit.fitter.parnames)
+            nparams=np.size(parnames)
             ncomponents=np.size(self.guesses)/nparams
 
             # remove any instances of nans
@@ -177,7 +191,7 @@ class Decomposer(object):
             if ncomponents > 1:
                 # identify where amplitude is in paranames
                 namelist = ['tex', 'amp', 'amplitude', 'peak', 'tant', 'tmb']
-                foundname = [pname in namelist for pname in self.pskspectrum.specfit.fitter.parnames]
+                foundname = [pname in namelist for pname in parnames]
                 foundname = np.array(foundname)
                 idx=np.where(foundname==True)[0]
                 idx=idx[0]
@@ -199,11 +213,7 @@ class Decomposer(object):
             if np.size(self.guesses !=0) and is_divisible:
                 #self.psktemplate=None
                 #self.pskspectrum=None
-                if self.psktemplate is not None:
-                    self.update_template()
-                else:
-                    self.create_a_spectrum()
-                self.fit_a_spectrum()
+                self.prepare_and_fit()
 
         self.get_model_information()
         self.check_against_parent()
@@ -212,6 +222,32 @@ class Decomposer(object):
         self.psktemplate=None
         self.pskspectrum=None
 
+    def prepare_and_fit(self):
+        """
+        Sets up the spectrum for the fitter and fits it using the current
+        guesses
+
+        """
+        if self.backend!='native':
+            if self.psktemplate is not None:
+                self.update_template()
+            else:
+                self.create_a_spectrum()
+        self.fit_a_spectrum()
+
+    def get_fit_results(self):
+        """
+        Returns the best-fitting parameters, their uncertainties and the
+        parameter names of the current fit
+
+        """
+        if self.backend=='native':
+            from .gaussfit import parnames
+            return self.nativefit['params'], self.nativefit['errors'], parnames
+        else:
+            specfit=self.pskspectrum.specfit
+            return specfit.modelpars, specfit.modelerrs, specfit.fitter.parnames
+
     def fit_spectrum_manually(self, fittype='gaussian'):
         """
         Method used to manually fit a spectrum
@@ -402,6 +438,10 @@ class Decomposer(object):
         Fits a spectrum
 
         """
+        if self.backend=='native':
+            self.fit_a_spectrum_native()
+            return
+
         with warnings.catch_warnings():
             warnings.simplefilter('ignore')
             old_log = log.level
@@ -434,6 +474,20 @@ class Decomposer(object):
                                     use_lmfit=True)
             log.setLevel(old_log)
 
+    def fit_a_spectrum_native(self):
+        """
+        Fits a spectrum using the native Gaussian fitter
+
+        """
+        from .gaussfit import fit_gaussians
+
+        if str(self.fittype).lower()!='gaussian':
+            raise ValueError("The native fitter is only available for fittype='gaussian'")
+
+        result=fit_gaussians(self.spectral_axis, self.spectrum, self.rms,
+                             self.guesses, no_negative=self.no_negative)
+        self.nativefit={key: value[0] for key, value in result.items()}
+
     def fit_a_spectrum_interactively(self):
         """
         Fits a spectrum interactively
@@ -545,6 +599,10 @@ class Decomposer(object):
         """
         Framework for model solution dictionary
         """
+        if self.backend=='native':
+            self.get_model_information_native()
+            return
+
         self.modeldict={}
 
         if (None in self.pskspectrum.specfit.modelerrs):
@@ -590,6 +648,43 @@ class Decomposer(object):
             self.modeldict['fitconverge'] = self.fit_converge()
             self.modeldict['method']=self.method
 
+    def get_model_information_native(self):
+        """
+        Framework for model solution dictionary. As get_model_information but
+        for fits performed with the native backend
+        """
+        from astropy.stats import akaike_info_criterion_lsq as aic
+        from .gaussfit import parnames
+
+        fit=self.nativefit
+        npars=np.size(fit['params'])
+        self.modeldict={}
+        self.modeldict['parnames']=parnames
+        self.modeldict['rms']=self.rms
+
+        if not self.fit_converge():
+            self.modeldict['fittype']=None
+            self.modeldict['ncomps']=0
+            self.modeldict['params']=np.zeros(npars)
+            self.modeldict['errors']=np.zeros(npars)
+            self.modeldict['residstd']=np.nanstd(self.spectrum)
+            self.modeldict['chisq']=0.0
+            self.modeldict['dof']=0.0
+            self.modeldict['redchisq']=0.0
+            self.modeldict['AIC']=0.0
+        else:
+            self.modeldict['fittype']=self.fittype
+            self.modeldict['ncomps']=int(npars/len(parnames))
+            self.modeldict['params']=list(fit['params'])
+            self.modeldict['errors']=list(fit['errors'])
+            self.modeldict['residstd']=fit['residstd']
+            self.modeldict['chisq']=fit['chisq']
+            self.modeldict['dof']=fit['dof']
+            self.modeldict['redchisq']=fit['chisq']/fit['dof']
+            self.modeldict['AIC']=aic(fit['ssr'], npars, len(self.spectral_axis))
+        self.modeldict['fitconverge']=self.fit_converge()
+        self.modeldict['method']=self.method
+
     def get_aic(self):
         """
         Computes the AIC value
@@ -939,6 +1034,8 @@ class Decomposer(object):
         return diff
 
     def fit_converge(self):
+        if self.backend=='native':
+            return bool(self.nativefit['converged'])
         if None in self.pskspectrum.specfit.modelerrs:
             return False
         else:
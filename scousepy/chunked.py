@@ -0,0 +1,761 @@
+# Licensed under an MIT open source license - see LICENSE
+
+"""
+Chunked, lazily loaded stage files.
+
+Each stage file is a directory. The dictionaries keyed by integers (saa_dict,
+modelstore and indiv_dict) are split into chunks of consecutive keys. Each
+chunk is stored as a pickle of its objects, with the spectra stripped out and
+written separately as a single .npy block. An index of the keys (and, where
+available, their coordinates) is loaded up front and the chunks are only
+read from disk when one of their keys is accessed. Everything else is stored
+in a small header pickle. A ResultStore (indiv_dict from stage 3 onwards) is
+written in columns instead (see ResultStore.write) and read in full.
+
+Stages which are saved repeatedly (e.g. the bitesize sessions of stage 4) can
+be journaled: rather than writing the whole stage again, the objects which
+have changed since the stage was loaded are appended to a journal within the
+stage directory. Each journal record is checksummed and synced to disk, such
+that an interrupted write is ignored and the previous state is preserved.
+Once the journal grows beyond a fraction of the size of the stage, the stage
+is compacted by writing a new snapshot.
+
+Each full write of a stage goes to a new snapshot directory within the stage
+directory. A small pointer file names the current snapshot; it is replaced
+atomically once the new snapshot is complete, and only then is the previous
+snapshot removed (or kept as the backup). An interrupted write therefore
+leaves the previous snapshot in place.
+
+Stage files written by earlier versions of scousepy (a single pickle) can
+still be loaded.
+"""
+
+import os
+import sys
+import zlib
+import struct
+import shutil
+import pickle
+import numpy as np
+from collections.abc import Mapping, MutableMapping
+
+from .result_store import ResultStore
+
+__all__ = ('ChunkedDict', 'save_stage', 'load_stage', 'backup_stage',
+           'read_journal')
+
+if sys.version_info.major >= 3:
+    proto=3
+else:
+    proto=2
+
+_version=1
+_headerfile='header.pkl'
+_indexfile='index.npz'
+_journalfile='journal'
+# names the current snapshot of a stage directory
+_pointerfile='current'
+_snapshotprefix='snapshot_'
+# journal records: magic, length of the payload and its checksum
+_journalmagic=b'SJ01'
+_recordheader=struct.Struct('<4sQI')
+
+class ChunkedDict(MutableMapping):
+    """
+    A dictionary stored on disk in chunks which are loaded on demand. Loaded
+    chunks are kept in memory, so objects modified in place keep their
+    modifications. New keys are held in memory until the dictionary is saved.
+
+    Pickling (and copying) a ChunkedDict produces a regular dictionary.
+
+    Parameters
+    ----------
+    path : string
+        directory written by ChunkedDict.write
+    journal : dictionary, optional
+        objects which supersede those on disk, as pickled bytes keyed by key
+        (None for deleted keys). See load_stage
+
+    Attributes
+    ----------
+    path : string
+        the directory containing the chunks
+    nchunks : int
+        number of chunks on disk
+    coordinates : ndarray
+        (x, y) coordinates of the objects on disk in the order of keys. None
+        if the objects have no coordinates
+
+    """
+    def __init__(self, path, journal=None):
+
+        self.path=path
+        with np.load(os.path.join(path, _indexfile)) as index:
+            keys=index['keys']
+            chunks=index['chunks']
+            self.coordinates=index['coordinates'] if 'coordinates' in index.files else None
+        self.nchunks=int(np.max(chunks))+1 if np.size(chunks)!=0 else 0
+        self._diskkeys=keys
+        self._lookup=dict(zip(keys.tolist(), chunks.tolist()))
+        self._cache={}
+        self._new={}
+        # the last saved state of each journaled key, and the keys deleted
+        # since the last save
+        self._journal={}
+        self._overlay={}
+        self._deleted=set()
+        if journal is not None:
+            self._apply_journal(journal)
+
+    def __repr__(self):
+        """
+        Return a nice printable format for the object.
+        """
+        return "<< scousepy chunked dictionary; nkeys={0}, nchunks={1}, loaded={2} >>".format(len(self), self.nchunks, len(self._cache))
+
+    def __reduce__(self):
+        return (dict, (list(self.items()),))
+
+    @staticmethod
+    def write(path, mapping, chunksize=1024):
+        """
+        Writes a dictionary keyed by integers to disk
+
+        Parameters
+        ----------
+        path : string
+            output directory
+        mapping : dictionary
+            the dictionary to write
+        chunksize : int
+            number of keys per chunk
+
+        """
+        os.makedirs(path)
+        keys=np.array([int(key) for key in mapping.keys()], dtype='int64')
+
+        # consecutive keys are stored together
+        order=np.argsort(keys, kind='stable')
+        chunks=np.empty(np.size(keys), dtype='int64')
+        chunks[order]=np.arange(np.size(keys))//chunksize
+
+        coordinates=[]
+        for start in range(0, np.size(keys), chunksize):
+            chunkkeys=keys[order[start:start+chunksize]].tolist()
+            objects=[mapping[key] for key in chunkkeys]
+            coordinates.extend(_get_coordinates(obj) for obj in objects)
+            _write_chunk(os.path.join(path, _chunkname(start//chunksize)), chunkkeys, objects)
+
+        index={'keys': keys, 'chunks': chunks}
+        if (np.size(keys)!=0) and all(xy is not None for xy in coordinates):
+            # coordinates were gathered in key order
+            index['coordinates']=np.empty((np.size(keys), 2), dtype='int64')
+            index['coordinates'][order]=np.array(coordinates, dtype='int64')
+        np.savez(os.path.join(path, _indexfile), **index)
+
+    def _apply_journal(self, journal):
+        """
+        Applies the changes recorded in the journal to the keys on disk
+        """
+        self._journal.update(journal)
+        for key, data in journal.items():
+            if data is None:
+                self._lookup.pop(key, None)
+                self._new.pop(key, None)
+            elif self._lookup.get(key, -1) >= 0:
+                self._overlay[key]=pickle.loads(data)
+            else:
+                self._lookup[key]=-1
+                self._new[key]=pickle.loads(data)
+
+    def _load_chunk(self, chunk):
+        """
+        Returns the contents of a chunk, reading it from disk if necessary
+        """
+        if chunk not in self._cache:
+            objects=_read_chunk(os.path.join(self.path, _chunkname(chunk)))
+            for key in list(objects):
+                if self._lookup.get(key)!=chunk:
+                    # deleted or superseded by a new object
+                    del objects[key]
+                elif key in self._overlay:
+                    objects[key]=self._overlay.pop(key)
+            self._cache[chunk]=objects
+        return self._cache[chunk]
+
+    def __getitem__(self, key):
+        chunk=self._lookup[key]
+        if chunk < 0:
+            return self._new[key]
+        return self._load_chunk(chunk)[key]
+
+    def __setitem__(self, key, value):
+        chunk=self._lookup.get(key, -1)
+        if chunk < 0:
+            self._lookup[key]=-1
+            self._new[key]=value
+        else:
+            self._load_chunk(chunk)[key]=value
+        self._deleted.discard(key)
+
+    def __delitem__(self, key):
+        chunk=self._lookup.pop(key)
+        self._deleted.add(key)
+        if chunk < 0:
+            del self._new[key]
+        else:
+            self._load_chunk(chunk).pop(key)
+
+    def __contains__(self, key):
+        return key in self._lookup
+
+    def __iter__(self):
+        return iter(self._lookup)
+
+    def __len__(self):
+        return len(self._lookup)
+
+    def sort(self):
+        """
+        Orders the keys, without reading any chunks
+        """
+        self._lookup=dict(sorted(self._lookup.items()))
+
+    def get_changes(self):
+        """
+        Finds the objects which have changed since the dictionary was loaded
+        or last saved. Only the objects held in memory can have changed, so
+        the cost scales with the number of loaded chunks rather than the size
+        of the dictionary. Objects are compared through their pickled state
+
+        Returns
+        -------
+        updated : dictionary
+            the pickled state of the new and modified objects
+        deleted : list
+            the deleted keys
+
+        """
+        updated={}
+        for chunk, objects in self._cache.items():
+            base=None
+            for key, obj in objects.items():
+                data=pickle.dumps(obj, protocol=proto)
+                if key in self._journal:
+                    clean=self._journal[key]
+                else:
+                    if base is None:
+                        base=_read_chunk(os.path.join(self.path, _chunkname(chunk)))
+                    clean=pickle.dumps(base[key], protocol=proto) if key in base else None
+                if data!=clean:
+                    updated[key]=data
+        for key, obj in self._new.items():
+            data=pickle.dumps(obj, protocol=proto)
+            if data!=self._journal.get(key):
+                updated[key]=data
+        deleted=[key for key in self._deleted if key not in self._lookup]
+        return updated, deleted
+
+    def _mark_saved(self, updated, deleted):
+        """
+        Records that the changes have been written to the journal
+        """
+        self._journal.update(updated)
+        for key in deleted:
+            self._journal[key]=None
+        self._deleted.clear()
+
+    @property
+    def nloaded(self):
+        """
+        Number of chunks currently held in memory
+        """
+        return len(self._cache)
+
+    def load(self, keys=None):
+        """
+        Reads the chunks containing the given keys (default all) from disk
+
+        Parameters
+        ----------
+        keys : iterable, optional
+            the keys to load
+
+        Returns
+        -------
+        subset : dictionary
+            the requested objects
+
+        """
+        if keys is None:
+            keys=list(self._lookup)
+        chunks=set(self._lookup[key] for key in keys)
+        for chunk in sorted(chunks):
+            if chunk >= 0:
+                self._load_chunk(chunk)
+        return {key: self[key] for key in keys}
+
+    def tile(self, xrange, yrange):
+        """
+        Returns the objects located within a tile. Only the chunks containing
+        these objects are read
+
+        Parameters
+        ----------
+        xrange, yrange : tuple
+            (min, max) pixel coordinates of the tile. Inclusive of min and
+            exclusive of max
+
+        Returns
+        -------
+        subset : dictionary
+            the objects located within the tile
+
+        """
+        if self.coordinates is None:
+            raise ValueError("The objects in this dictionary have no coordinates")
+        x, y = self.coordinates[:,0], self.coordinates[:,1]
+        inside=(x >= xrange[0]) & (x < xrange[1]) & (y >= yrange[0]) & (y < yrange[1])
+        keys=[key for key in self._diskkeys[inside].tolist() if key in self._lookup]
+        # new objects are not in the index
+        for key, obj in self._new.items():
+            xy=_get_coordinates(obj)
+            if (xy is not None) and (xrange[0] <= xy[0] < xrange[1]) and (yrange[0] <= xy[1] < yrange[1]):
+                keys.append(key)
+        return self.load(keys)
+
+def _chunkname(chunk):
+    return 'chunk_{0:06d}'.format(chunk)
+
+def _get_coordinates(obj):
+    """
+    Returns the (x, y) coordinates of an SAA or individual spectrum
+    """
+    coordinates=getattr(obj, 'coordinates', None)
+    if coordinates is None or np.size(coordinates)!=2:
+        return None
+    return [int(coordinates[0]), int(coordinates[1])]
+
+def _get_spectra(objects):
+    """
+    Stacks the spectra of a list of objects if they all share the same shape
+    and dtype. Returns None otherwise, or if the spectra are held by reference
+    """
+    if any(getattr(obj, 'reference', None) is not None for obj in objects):
+        return None
+    spectra=[getattr(obj, 'spectrum', None) for obj in objects]
+    if len(spectra)==0 or not all(type(spectrum) is np.ndarray for spectrum in spectra):
+        return None
+    if len(set((spectrum.shape, spectrum.dtype.str) for spectrum in spectra))!=1:
+        return None
+    if spectra[0].dtype.hasobject:
+        return None
+    return np.stack(spectra)
+
+def _write_chunk(path, keys, objects):
+    """
+    Writes a chunk. The spectra, if any, are written as an .npy block
+    """
+    spectra=_get_spectra(objects)
+    if spectra is not None:
+        np.save(path+'.npy', spectra)
+        for obj in objects:
+            obj.spectrum=None
+    try:
+        with open(path+'.pkl', 'wb') as fh:
+            pickle.dump((keys, objects, spectra is not None), fh, protocol=proto)
+    finally:
+        # restore the spectra of the objects held in memory
+        if spectra is not None:
+            for obj, spectrum in zip(objects, spectra):
+                obj.spectrum=spectrum
+
+def _read_chunk(path):
+    """
+    Reads a chunk, reattaching the spectra
+    """
+    with open(path+'.pkl', 'rb') as fh:
+        keys, objects, has_spectra = pickle.load(fh)
+    if has_spectra:
+        spectra=np.load(path+'.npy')
+        for obj, spectrum in zip(objects, spectra):
+            obj.spectrum=spectrum
+    return dict(zip(keys, objects))
+
+def _is_chunkable(value):
+    """
+    Dictionaries with integer keys are chunked
+    """
+    if not isinstance(value, Mapping) or len(value)==0:
+        return False
+    return all(isinstance(key, (int, np.integer)) and not isinstance(key, bool) for key in value.keys())
+
+def _is_nested(value):
+    """
+    Dictionaries of chunkable dictionaries (e.g. saa_dict) are chunked
+    individually
+    """
+    return _is_chunkable(value) and all(_is_chunkable(item) or (isinstance(item, Mapping) and len(item)==0) for item in value.values())
+
+def _read_header(path):
+    with open(os.path.join(path, _headerfile), 'rb') as fh:
+        return pickle.load(fh)
+
+def read_journal(path):
+    """
+    Reads the journal of a stage directory. Reading stops at the first
+    incomplete or corrupt record, e.g. one left by an interrupted write
+
+    Parameters
+    ----------
+    path : string
+        the stage directory, or one of its snapshots
+
+    Returns
+    -------
+    records : list
+        the valid records
+    size : int
+        the size of the valid part of the journal in bytes
+
+    """
+    records=[]
+    size=0
+    filename=os.path.join(_get_snapshot(path), _journalfile)
+    if not os.path.exists(filename):
+        return records, size
+
+    with open(filename, 'rb') as fh:
+        while True:
+            head=fh.read(_recordheader.size)
+            if len(head) < _recordheader.size:
+                break
+            magic, length, checksum = _recordheader.unpack(head)
+            if magic!=_journalmagic:
+                break
+            payload=fh.read(length)
+            if (len(payload) < length) or (zlib.crc32(payload)!=checksum):
+                break
+            records.append(pickle.loads(payload))
+            size+=_recordheader.size+length
+    return records, size
+
+def _append_record(path, payload, size):
+    """
+    Appends a record to the journal after its valid part, discarding anything
+    left by an interrupted write, and syncs it to disk
+    """
+    filename=os.path.join(path, _journalfile)
+    with open(filename, 'r+b' if os.path.exists(filename) else 'wb') as fh:
+        fh.truncate(size)
+        fh.seek(size)
+        fh.write(_recordheader.pack(_journalmagic, len(payload), zlib.crc32(payload)))
+        fh.write(payload)
+        fh.flush()
+        os.fsync(fh.fileno())
+
+def _get_stage_size(path):
+    """
+    Size of a stage directory in bytes, excluding the journal
+    """
+    size=0
+    for root, dirs, files in os.walk(path):
+        for fn in files:
+            if fn!=_journalfile:
+                size+=os.path.getsize(os.path.join(root, fn))
+    return size
+
+def _journal_stage(path, state, compact):
+    """
+    Appends the changes to the state of an existing stage to its journal.
+    Returns False if the stage must be written in full instead, i.e. if the
+    chunked dictionaries of state were not loaded from this stage, or if the
+    journal has outgrown the stage
+    """
+    path=_get_snapshot(path)
+    if not os.path.isdir(path) or not os.path.exists(os.path.join(path, _headerfile)):
+        return False
+    header=_read_header(path)
+    if (header.get('version')!=_version) or (len(header['items'])!=len(state)):
+        return False
+
+    record={'values': {}, 'items': {}}
+    dicts=[]
+    for (kind, name, value), item in zip(header['items'], state):
+        if kind=='value':
+            if _is_chunkable(item) or _is_nested(item):
+                return False
+            record['values'][name]=item
+        elif kind=='chunked':
+            if not isinstance(item, ChunkedDict) or \
+               (os.path.normpath(item.path)!=os.path.join(path, name)):
+                return False
+            dicts.append((name, item))
+        elif kind=='store':
+            if not isinstance(item, ResultStore) or (item._path!=os.path.join(path, name)):
+                return False
+            dicts.append((name, item))
+        else:
+            return False
+
+    for name, item in dicts:
+        updated, deleted = item.get_changes()
+        if (len(updated)!=0) or (len(deleted)!=0):
+            record['items'][name]=(updated, deleted)
+
+    payload=pickle.dumps(record, protocol=proto)
+    records, size = read_journal(path)
+    if size+len(payload) > compact*_get_stage_size(path):
+        return False
+
+    _append_record(path, payload, size)
+    for name, item in dicts:
+        if isinstance(item, ResultStore):
+            item._mark_saved()
+        else:
+            item._mark_saved(*record['items'].get(name, ({}, [])))
+    return True
+
+def backup_stage(path):
+    """
+    Renames an existing stage file (or directory) to path+'.bk', replacing any
+    previous backup
+    """
+    if os.path.lexists(path):
+        _remove(path+'.bk')
+        os.rename(path, path+'.bk')
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+def _get_snapshot(path):
+    """
+    Returns the directory holding the current snapshot of a stage directory.
+    Stage directories written by earlier versions of scousepy have no
+    snapshots and are returned as they are
+    """
+    pointer=os.path.join(path, _pointerfile)
+    if not os.path.isfile(pointer):
+        return path
+    with open(pointer, 'r') as fh:
+        return os.path.join(path, fh.read().strip())
+
+def _get_snapshot_name(path):
+    """
+    Name of a new snapshot of a stage directory, following any existing one
+    (including those left by an interrupted write)
+    """
+    numbers=[int(fn[len(_snapshotprefix):]) for fn in os.listdir(path)
+             if fn.startswith(_snapshotprefix) and fn[len(_snapshotprefix):].isdigit()]
+    return _snapshotprefix+str(max(numbers, default=0)+1)
+
+def _get_legacy_entries(path):
+    """
+    The contents of a stage directory written by earlier versions of scousepy,
+    where the snapshot is held in the stage directory itself
+    """
+    return [fn for fn in os.listdir(path)
+            if fn in (_headerfile, _journalfile) or fn.startswith('item_')]
+
+def _sync_tree(path):
+    """
+    Flushes the files of a directory to disk
+    """
+    for root, dirs, files in os.walk(path):
+        for fn in files:
+            # a writable handle is required to sync on all platforms
+            with open(os.path.join(root, fn), 'r+b') as fh:
+                os.fsync(fh.fileno())
+
+def _set_snapshot(path, name):
+    """
+    Points a stage directory to a given snapshot. The pointer file is replaced
+    atomically
+    """
+    tmpfile=os.path.join(path, _pointerfile+'.tmp')
+    with open(tmpfile, 'w') as fh:
+        fh.write(name)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(tmpfile, os.path.join(path, _pointerfile))
+
+def _write_snapshot(path, state, chunksize):
+    """
+    Writes the objects of a stage to a new snapshot directory
+    """
+    os.makedirs(path)
+    items=[]
+    for i, value in enumerate(state):
+        name='item_{0}'.format(i)
+        if isinstance(value, ResultStore):
+            value.write(os.path.join(path, name))
+            items.append(('store', name, None))
+        elif _is_nested(value):
+            keys=list(value.keys())
+            for key in keys:
+                if len(value[key])!=0:
+                    ChunkedDict.write(os.path.join(path, name, str(int(key))), value[key], chunksize=chunksize)
+            items.append(('nested', name, [(key, len(value[key])!=0) for key in keys]))
+        elif _is_chunkable(value):
+            ChunkedDict.write(os.path.join(path, name), value, chunksize=chunksize)
+            items.append(('chunked', name, None))
+        else:
+            items.append(('value', name, value))
+
+    with open(os.path.join(path, _headerfile), 'wb') as fh:
+        pickle.dump({'version': _version, 'items': items}, fh, protocol=proto)
+    _sync_tree(path)
+
+def save_stage(path, state, backup=False, chunksize=1024, journal=False,
+               compact=0.5):
+    """
+    Saves the state of a stage
+
+    Parameters
+    ----------
+    path : string
+        the output directory
+    state : tuple
+        the objects to save. Dictionaries keyed by integers, or dictionaries of
+        these, are chunked. ResultStores are written in columns
+    backup : bool
+        keep the previous snapshot of the stage as path+'.bk'
+    chunksize : int
+        number of keys per chunk
+    journal : bool
+        if the chunked dictionaries of state were loaded from this stage, only
+        append the objects which have changed to the journal of the stage. The
+        stage is otherwise written in full
+    compact : float
+        the stage is written in full (compacting the journal) once the journal
+        would exceed this fraction of the size of the stage
+
+    Notes
+    -----
+    A full write goes to a new snapshot within the stage directory, which
+    replaces the previous snapshot once it is complete. Stage files written
+    by earlier versions of scousepy as a single pickle are instead replaced by
+    renaming; should this be interrupted, load_stage recovers the stage.
+
+    Once a stage has been written in full, the chunked dictionaries of state
+    which were loaded from it are read again from the new snapshot on demand.
+
+    """
+    path=os.path.normpath(path)
+    if journal and _journal_stage(path, state, compact):
+        return
+
+    if os.path.isdir(path):
+        oldsnapshot=_get_snapshot(path)
+        name=_get_snapshot_name(path)
+        _write_snapshot(os.path.join(path, name), state, chunksize)
+        _set_snapshot(path, name)
+
+        # the previous snapshot is no longer referenced and can be retired
+        if oldsnapshot==path:
+            entries=_get_legacy_entries(path)
+        else:
+            entries=[os.path.basename(oldsnapshot)]
+        if backup:
+            _remove(path+'.bk')
+            os.makedirs(path+'.bk')
+            for entry in entries:
+                os.rename(os.path.join(path, entry), os.path.join(path+'.bk', entry))
+            if oldsnapshot!=path:
+                _set_snapshot(path+'.bk', entries[0])
+        # this also removes snapshots left by interrupted writes
+        for entry in os.listdir(path):
+            if (entry in entries) or (entry.startswith(_snapshotprefix) and entry!=name):
+                _remove(os.path.join(path, entry))
+    else:
+        # a new stage, or a single pickle written by an earlier version. The
+        # stage directory is written alongside and moved into place
+        oldsnapshot=path
+        tmppath=path+'.tmp'
+        _remove(tmppath)
+        os.makedirs(tmppath)
+        name=_snapshotprefix+'1'
+        _write_snapshot(os.path.join(tmppath, name), state, chunksize)
+        _set_snapshot(tmppath, name)
+        if backup:
+            backup_stage(path)
+        else:
+            _remove(path)
+        os.rename(tmppath, path)
+
+    # dictionaries loaded from this stage now refer to the new snapshot, and
+    # stores are journaled against it
+    for i, value in enumerate(state):
+        if isinstance(value, ResultStore):
+            value._mark_saved(os.path.join(path, name, 'item_{0}'.format(i)))
+        elif isinstance(value, ChunkedDict) and \
+           (os.path.dirname(os.path.normpath(value.path))==oldsnapshot):
+            value.__init__(os.path.join(path, name, 'item_{0}'.format(i)))
+
+def _recover_stage(path):
+    """
+    Returns the path from which to load a stage which is missing because its
+    replacement was interrupted. A complete replacement is moved into place,
+    otherwise the backup is used
+    """
+    tmppath=path+'.tmp'
+    if os.path.isfile(os.path.join(tmppath, _pointerfile)):
+        os.rename(tmppath, path)
+        return path
+    if os.path.lexists(path+'.bk'):
+        return path+'.bk'
+    return path
+
+def load_stage(path):
+    """
+    Loads the state of a stage. Chunked dictionaries are loaded lazily
+
+    Parameters
+    ----------
+    path : string
+        a stage directory written by save_stage, or a stage file written by
+        earlier versions of scousepy
+
+    Returns
+    -------
+    state : tuple
+        the saved objects
+
+    """
+    path=os.path.normpath(path)
+    if not os.path.lexists(path):
+        path=_recover_stage(path)
+    if not os.path.isdir(path):
+        with open(path, 'rb') as fh:
+            return pickle.load(fh)
+
+    path=_get_snapshot(path)
+    header=_read_header(path)
+
+    # replay the journal
+    records, size = read_journal(path)
+    values={}
+    changes={}
+    for record in records:
+        values.update(record['values'])
+        for name, (updated, deleted) in record['items'].items():
+            journal=changes.setdefault(name, {})
+            journal.update(updated)
+            for key in deleted:
+                journal[key]=None
+
+    state=[]
+    for kind, name, value in header['items']:
+        if kind=='nested':
+            state.append({key: ChunkedDict(os.path.join(path, name, str(int(key)))) if nonempty else {}
+                          for key, nonempty in value})
+        elif kind=='chunked':
+            state.append(ChunkedDict(os.path.join(path, name), journal=changes.get(name)))
+        elif kind=='store':
+            state.append(ResultStore.read(os.path.join(path, name), journal=changes.get(name)))
+        else:
+            state.append(values.get(name, value))
+    return tuple(state)
@@ -77,6 +77,7 @@ class ConfigMaker(object):
         self.njobs=3
         self.verbose=True
         self.autosave=True
+        self.reference_mode=False
         self.snr=3
         self.alpha=5
         self.no_negative=True
@@ -84,6 +85,7 @@ class ConfigMaker(object):
         self.save_fig=True
         self.write_ascii=True
         self.tol=[2.0,3.0,1.0,2.5,2.5,0.5]
+        self.backend=self.make_string('pyspeckit')
 
     def set_defaults_init_desc(self):
 
@@ -99,6 +101,8 @@ class ConfigMaker(object):
         self.verbose_simple=True
         self.autosave_description="autosave output from individual steps [True/False]"
         self.autosave_simple=True
+        self.reference_mode_description="hold references to the spectra rather than copies [True/False]"
+        self.reference_mode_simple=False
         self.write_moments_description="save moment maps as FITS files [True/False]"
         self.write_moments_simple=False
         self.save_fig_description="generate a figure of the coverage map [True/False]"
@@ -113,6 +117,8 @@ class ConfigMaker(object):
         self.write_ascii_simple=False
         self.tol_description="Tolerance values for the fitting. See Henshaw et al. 2016a"
         self.tol_simple=True
+        self.backend_description="fitter used for the automated fitting [pyspeckit/native]"
+        self.backend_simple=False
 
     def set_defaults_cov(self):
         self.config_file=str('# ScousePy config file\n\n')
@@ -213,6 +219,10 @@ class ConfigMaker(object):
                     'default': self.autosave,
                     'description': self.autosave_description,
                     'simple': self.autosave_simple}),
+                ('reference_mode', {
+                    'default': self.reference_mode,
+                    'description': self.reference_mode_description,
+                    'simple': self.reference_mode_simple}),
                 ]
 
             stage_1 = [
@@ -250,6 +260,10 @@ class ConfigMaker(object):
                     'default': self.tol,
                     'description': self.tol_description,
                     'simple': self.tol_simple}),
+                ('backend', {
+                    'default': self.backend,
+                    'description': self.backend_description,
+                    'simple': self.backend_simple}),
                 ]
 
         elif self.configtype=='coverage':
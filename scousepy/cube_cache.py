@@ -0,0 +1,226 @@
+# Licensed under an MIT open source license - see LICENSE
+
+"""
+Cube cache shared by all stages.
+
+The FITS file is opened once per session with memmap and the spectral axis is
+converted once. The resulting cube is reused whenever the same (unmodified)
+file is requested again, e.g. at the start of each stage, by ScouseSpatial or
+compute_stats.
+
+The unmasked spectra within vel_range (the data which are fitted) are in
+addition persisted as a channel-contiguous array (one spectrum per row) in a
+.npy file in the output directory. The file is keyed by the FITS file and
+vel_range and is memory mapped by the stages which need the trimmed spectra,
+so that it only needs to be built once.
+"""
+
+import os
+import numpy as np
+
+__all__ = ('read_cube', 'extract_spectra', 'get_trimmed_spectra', 'clear_cube_cache')
+
+# cubes opened during this session, keyed by the path, size and modification
+# time of the FITS file
+_cubes={}
+
+def get_file_key(fitsfile):
+    """
+    Returns a key identifying a given version of a file
+    """
+    stat=os.stat(fitsfile)
+    return (os.path.abspath(fitsfile), stat.st_size, stat.st_mtime_ns)
+
+def read_cube(fitsfile):
+    """
+    Reads a FITS cube, converting the spectral axis to km/s (radio) in
+    increasing order. The FITS file is memory mapped. Cubes are cached for the
+    session and are only read again if the file is modified.
+
+    Parameters
+    ----------
+    fitsfile : string
+        path to the FITS file
+
+    Returns
+    -------
+    cube : spectral cube
+
+    """
+    import astropy.units as u
+    from spectral_cube import SpectralCube
+
+    key=get_file_key(fitsfile)
+    if key in _cubes:
+        return _cubes[key]
+
+    cube=SpectralCube.read(fitsfile, memmap=True).with_spectral_unit(u.km/u.s,
+                                            velocity_convention='radio')
+    if cube.spectral_axis.diff()[0] < 0:
+        if np.abs(cube.spectral_axis[0].value -
+                            cube[::-1].spectral_axis[-1].value) > 1e-5:
+            raise ImportError("Update to a more recent version of "
+                              "spectral-cube or reverse the axes "
+                              "manually.")
+        cube = cube[::-1]
+
+    # older versions of the file are no longer needed
+    for oldkey in [oldkey for oldkey in _cubes if oldkey[0]==key[0]]:
+        del _cubes[oldkey]
+    _cubes[key]=cube
+    return cube
+
+def clear_cube_cache():
+    """
+    Removes all cubes from the session cache
+    """
+    _cubes.clear()
+
+def extract_spectra(cube, indices=None, channels=None, out=None, filled=True,
+                    nchanblock=64):
+    """
+    Extracts the spectra of a set of pixels from the filled data of a cube in
+    bulk. Rather than slicing the cube once per pixel, the cube is read in
+    blocks of channels covering the whole map and the requested pixels are
+    gathered from each block with a single fancy-indexing operation.
+
+    Parameters
+    ----------
+    cube : spectral cube
+    indices : ndarray, optional
+        flattened indices of the pixels. Default is all pixels. Reads are
+        fastest if the indices are sorted
+    channels : ndarray, optional
+        indices of the channels to extract. Default is all channels
+    out : ndarray, optional
+        array of shape (npix, nchan) in which to place the spectra
+    filled : bool
+        if True the masked values are filled (as cube.filled_data), otherwise
+        the unmasked data are returned (as cube[:, y, x].value)
+    nchanblock : int
+        number of channels read from the cube at a time. Limits the memory
+        footprint
+
+    Returns
+    -------
+    spectra : ndarray
+        the spectra, one per row, in the order of indices
+
+    """
+    npix=int(np.prod(cube.shape[1:]))
+    if channels is None:
+        channels=np.arange(cube.shape[0])
+    nchan=np.size(channels)
+    nrows=npix if indices is None else np.size(indices)
+
+    for k0 in range(0, nchan, nchanblock):
+        block=channels[k0:k0+nchanblock]
+        if filled:
+            data=cube.filled_data[block[0]:block[-1]+1].value[block-block[0]]
+        else:
+            data=cube.unmasked_data[block[0]:block[-1]+1].value[block-block[0]]
+        data=data.reshape(np.size(block), npix)
+        if indices is not None:
+            data=data[:, indices]
+        if out is None:
+            out=np.empty((nrows, nchan), dtype=data.dtype)
+        out[:, k0:k0+np.size(block)]=data.T
+
+    return out
+
+def get_trimmed_key(scouseobject):
+    """
+    Generates a key identifying the trimmed spectra, namely the FITS file, the
+    channels within vel_range, and the fact that the data are unmasked
+
+    Parameters
+    ----------
+    scouseobject : Instance of the scousepy class
+
+    Returns
+    -------
+    key : string
+        md5 checksum of the inputs. None if the cube was not read from a file
+
+    """
+    import hashlib
+
+    if (scouseobject.datadirectory is None) or (scouseobject.filename is None):
+        return None
+    fitsfile=os.path.join(scouseobject.datadirectory, scouseobject.filename+'.fits')
+    if not os.path.exists(fitsfile):
+        return None
+
+    md5=hashlib.md5()
+    md5.update(repr(get_file_key(fitsfile)).encode())
+    md5.update(repr(scouseobject.cube.shape).encode())
+    md5.update(scouseobject.cube.header.tostring().encode())
+    md5.update(np.asarray(scouseobject.cube.spectral_axis.value).tobytes())
+    md5.update(np.asarray(scouseobject.trimids, dtype='bool').tobytes())
+    # the spectra are fitted as cube[:, y, x].value, i.e. without the mask
+    md5.update(b'unmasked')
+    return md5.hexdigest()
+
+def get_trimmed_filename(scouseobject, key):
+    """
+    Filename of the trimmed spectra
+    """
+    return os.path.join(scouseobject.outputdirectory, scouseobject.filename,
+                        'cache', 'trimmed_'+key+'.npy')
+
+def get_trimmed_spectra(scouseobject, nchanblock=64):
+    """
+    Returns the file containing the unmasked spectra within vel_range, stored
+    as a (npix, nchan) array, in the precision of the cube, indexed by the
+    flattened pixel index. The file
+    is written to the output directory the first time it is requested and
+    should be opened with mmap_mode (see shared_data.MappedArray).
+
+    Parameters
+    ----------
+    scouseobject : Instance of the scousepy class
+    nchanblock : int
+        number of channels read from the cube at a time when building the
+        array
+
+    Returns
+    -------
+    filename : string
+        the .npy file containing the spectra. None if the cube was not read
+        from a file, or if there is no output directory
+
+    """
+    if (scouseobject.cube is None) or (scouseobject.trimids is None) or \
+       (scouseobject.outputdirectory is None):
+        return None
+    key=get_trimmed_key(scouseobject)
+    if key is None:
+        return None
+
+    filename=get_trimmed_filename(scouseobject, key)
+    if os.path.exists(filename):
+        return filename
+
+    cachedir=os.path.dirname(filename)
+    os.makedirs(cachedir, exist_ok=True)
+    # only the latest version is kept
+    for fn in os.listdir(cachedir):
+        if fn.startswith('trimmed_') and fn.endswith('.npy'):
+            os.remove(os.path.join(cachedir, fn))
+
+    cube=scouseobject.cube
+    npix=int(np.prod(cube.shape[1:]))
+    channels=np.where(scouseobject.trimids)[0]
+    nchan=np.size(channels)
+
+    tmpfilename=filename+'.tmp'
+    dtype=np.result_type(cube.unmasked_data[0:1,0:1,0:1].dtype, np.float32)
+    spectra=np.lib.format.open_memmap(tmpfilename, mode='w+', dtype=dtype,
+                                      shape=(npix, nchan))
+    extract_spectra(cube, channels=channels, out=spectra, filled=False,
+                    nchanblock=nchanblock)
+    spectra.flush()
+    del spectra
+    os.replace(tmpfilename, filename)
+
+    return filename
@@ -0,0 +1,240 @@
+# Licensed under an MIT open source license - see LICENSE
+
+"""
+Persistent worker pool used for all of scousepy's parallel processing.
+
+A single executor is kept for the whole session. Work is handed out in small
+chunks from a shared queue so that idle workers pick up the remaining tasks,
+and results are streamed back as they complete.
+
+Data common to every task (the "context") is inherited by the workers when
+they are forked rather than being pickled with each task. The workers hold
+copies of the context as it was at the time of the fork, so by default the
+pool is forked again for every call. Callers whose context is not modified
+between calls (e.g. because the state which changes is sent with the tasks
+or is held in shared memory) can pass refresh=False to keep the workers, in
+which case the pool is only forked again if the context holds different
+objects.
+"""
+
+import os
+import atexit
+import warnings
+from tqdm import tqdm
+
+__all__ = ('Executor', 'get_executor', 'shutdown_executor')
+
+_executor=None
+
+try:
+    import multiprocessing
+    _mpcontext=multiprocessing.get_context('fork')
+    _ncpus=multiprocessing.cpu_count()
+    _multi=True
+except Exception:
+    _mpcontext=None
+    _ncpus=1
+    _multi=False
+
+# the context of the current pool. Set in the parent before the workers are
+# forked and inherited by the workers
+_context=None
+
+class Executor(object):
+    """
+    A long-lived pool of worker processes
+
+    Parameters
+    ----------
+    njobs : int
+        Number of worker processes. If njobs <= 1, or multiprocessing is not
+        available, tasks are executed in serial
+    chunks_per_worker : int
+        Controls the size of the chunks handed to the workers. The tasks are
+        split into roughly njobs*chunks_per_worker chunks
+
+    """
+    def __init__(self, njobs=None, chunks_per_worker=8):
+
+        if njobs is None:
+            njobs=_ncpus
+        if njobs > _ncpus:
+            warnings.warn("Number of requested cores is greater than the "
+                          "number of available CPUs.")
+        self.njobs=int(njobs)
+        self.chunks_per_worker=chunks_per_worker
+        self.pool=None
+        self.context=None
+        self.pid=None
+
+    def __repr__(self):
+        """
+        Return a nice printable format for the object.
+        """
+        return "<< scousepy executor; njobs={0} >>".format(self.njobs)
+
+    @property
+    def parallel(self):
+        """
+        Whether or not tasks will be distributed over multiple processes
+        """
+        # a forked worker must not use the pool of its parent
+        if (self.pid is not None) and (self.pid != os.getpid()):
+            return False
+        return _multi and (self.njobs > 1)
+
+    def map(self, function, sequence, context=None, verbose=False, refresh=True):
+        """
+        Maps function over sequence. Equivalent to
+        [function(context+[item]) for item in sequence] if context is provided
+        or [function(item) for item in sequence] if not.
+
+        Parameters
+        ----------
+        function : callable
+            A module level function accepting a single argument
+        sequence : iterable
+            The tasks
+        context : list
+            Arguments common to all tasks. These are prepended to each task
+        verbose : bool
+            Display a progress bar
+        refresh : bool
+            The workers hold copies of the context made when they were forked.
+            If True (default) the workers are forked again so that they see
+            the current state of the context. Set to False to keep the
+            workers of the previous call, which is only safe if the objects
+            of the context have not been modified since. The workers are
+            always forked again if the context holds different objects
+
+        Returns
+        -------
+        results : list
+            The results in the same order as sequence
+
+        """
+        sequence=list(sequence)
+        results=[None]*len(sequence)
+        for i, result in self.imap(function, sequence, context=context, verbose=verbose,
+                                   refresh=refresh):
+            results[i]=result
+        return results
+
+    def imap(self, function, sequence, context=None, verbose=False, refresh=True):
+        """
+        As map but yields (index, result) pairs in the order in which the tasks
+        complete
+        """
+        if refresh:
+            # the context may have been modified since the workers were forked
+            self.shutdown()
+        sequence=list(sequence)
+        size=len(sequence)
+        if size==0:
+            return
+
+        if verbose:
+            progress_bar=tqdm(total=size)
+
+        if (not self.parallel) or (size==1):
+            # serial mode
+            for i, item in enumerate(sequence):
+                yield i, _call(function, context, item)
+                if verbose:
+                    progress_bar.update()
+        else:
+            pool=self.get_pool(context)
+            chunksize=max(1, size//(self.njobs*self.chunks_per_worker))
+            tasks=[(i, function, item) for i, item in enumerate(sequence)]
+            try:
+                for i, result in pool.imap_unordered(_run, tasks, chunksize=chunksize):
+                    yield i, result
+                    if verbose:
+                        progress_bar.update()
+            except BaseException:
+                # kill the workers on any exception (including ctrl-C). A new
+                # pool will be created when next needed
+                self.shutdown()
+                raise
+
+        if verbose:
+            progress_bar.close()
+
+    def get_pool(self, context):
+        """
+        Returns the pool of workers, (re)creating it if the context has changed
+        """
+        global _context
+        if (self.pool is not None) and not _same_context(self.context, context):
+            self.shutdown()
+        if self.pool is None:
+            _context=context
+            self.context=None if context is None else list(context)
+            self.pool=_mpcontext.Pool(processes=self.njobs)
+            self.pid=os.getpid()
+        return self.pool
+
+    def shutdown(self):
+        """
+        Terminates the workers
+        """
+        if (self.pool is not None) and (self.pid == os.getpid()):
+            self.pool.terminate()
+            self.pool.join()
+        self.pool=None
+        self.context=None
+
+def _same_context(old, new):
+    """
+    Whether two contexts hold the same objects. The lists themselves are
+    usually built anew for each call
+    """
+    if (old is None) or (new is None):
+        return (old is None) and (new is None)
+    return (len(old)==len(new)) and all(a is b for a, b in zip(old, new))
+
+def _call(function, context, item):
+    """
+    Calls function on a single task
+    """
+    if context is None:
+        return function(item)
+    else:
+        return function(list(context)+[item])
+
+def _run(task):
+    """
+    Executed by the workers. The context is that inherited from the parent
+    """
+    i, function, item = task
+    return i, _call(function, _context, item)
+
+def get_executor(njobs=None):
+    """
+    Returns the session executor, creating it if necessary
+
+    Parameters
+    ----------
+    njobs : int
+        Number of worker processes. The executor is recreated if this differs
+        from the current executor
+
+    """
+    global _executor
+    if _executor is not None:
+        if (njobs is None) or (_executor.njobs == int(njobs)):
+            return _executor
+        _executor.shutdown()
+    _executor=Executor(njobs=njobs)
+    return _executor
+
+def shutdown_executor():
+    """
+    Terminates the workers of the session executor
+    """
+    global _executor
+    if _executor is not None:
+        _executor.shutdown()
+    _executor=None
+
+atexit.register(shutdown_executor)
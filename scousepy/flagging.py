@@ -0,0 +1,308 @@
+# Licensed under an MIT open source license - see LICENSE
+
+"""
+Vectorised flagging engine for ScouseSpatial.
+
+Computes flags 1-7 (see scousespatial.flagging_method) for blocks of pixels at
+once from the arrays of SharedModels, rather than for each spectrum in turn.
+The neighbours of each pixel are gathered from the key grid, the weighted
+median number of components is computed over the windows, and the components
+of the neighbours are matched to those of each pixel over padded
+(npixels, nneighbours, ncomp_max, ncomp_max) arrays.
+
+The engine reproduces flagging_method, including the order of the floating
+point summations. The few pixels for which it cannot (e.g. non-finite
+parameters) are passed to flagging_method.
+"""
+
+import numpy as np
+
+__all__ = ('flag_spectra',)
+
+_amplitude_names=['tex', 'amp', 'amplitude', 'peak', 'tant', 'tmb']
+_dispersion_names=['dispersion', 'width', 'fwhm']
+
+def get_parameter_index(parnames, namelist):
+    """
+    Returns the position of the first parameter whose name is in namelist.
+    None if there is none
+    """
+    found=[i for i, parname in enumerate(parnames) if parname in namelist]
+    return found[0] if len(found)!=0 else None
+
+def flag_spectra(self, models, keys, blocksize=None):
+    """
+    Flags the spectra of a set of pixels
+
+    Parameters
+    ----------
+    self : instance of the ScouseSpatial class
+        the key grid (self.keygrid) must have been built from models
+    models : instance of the SharedModels class
+    keys : ndarray
+        the pixels to flag
+    blocksize : int, optional
+        number of pixels processed at a time. Default limits the intermediate
+        arrays to a few tens of Mb
+
+    Returns
+    -------
+    results : list
+        [index, flag, compflag, paramflag] for each pixel, as returned by
+        flagging_method. None if the parameters include no amplitude or no
+        dispersion
+
+    """
+    from .scousespatial import flagging_method
+
+    parnames=models.parnames
+    if parnames is None:
+        return None
+    iamp=get_parameter_index(parnames, _amplitude_names)
+    idisp=get_parameter_index(parnames, _dispersion_names)
+    if (iamp is None) or (idisp is None):
+        return None
+
+    keys=np.asarray(keys, dtype='int64')
+    nparams=len(parnames)
+    ncomp_max=max(models.maxparams//nparams, 1)
+    nneighbours=self.blocksize**2-1
+    if blocksize is None:
+        blocksize=max(2**22//(nneighbours*ncomp_max*ncomp_max), 1)
+
+    results=[]
+    for start in range(0, np.size(keys), blocksize):
+        block=keys[start:start+blocksize]
+        flags, compflags, paramflags, fallback = _flag_block(self, models, block, iamp, idisp, nparams, ncomp_max)
+        for i, index in enumerate(block.tolist()):
+            if fallback[i]:
+                results.append(flagging_method([self, models, models[index]]))
+            else:
+                results.append([index, flags[i], compflags[i], paramflags[i]])
+
+    return results
+
+def _sum(values, counts):
+    """
+    Sums the first counts[i] elements of each row of values. Rows with equal
+    counts are summed together as contiguous arrays, such that each sum is
+    identical to that of numpy over the corresponding 1D array
+    """
+    sums=np.zeros(np.shape(values)[0])
+    for count in np.unique(counts):
+        if count==0:
+            continue
+        rows=np.flatnonzero(counts==count)
+        sums[rows]=np.ascontiguousarray(values[rows,:count]).sum(axis=1)
+    return sums
+
+def _weighted_median(data, weights, valid):
+    """
+    Vectorised ScouseSpatial.weighted_median over the rows of data
+    """
+    nrows=np.shape(data)[0]
+    rows=np.arange(nrows)
+    weights=np.where(valid, weights, 0.0)
+
+    # sort each row by data and then by weight, placing the invalid entries
+    # at the end
+    order=np.lexsort((weights, data, ~valid), axis=1)
+    sorted_data=np.take_along_axis(data, order, axis=1)
+    sorted_weights=np.take_along_axis(weights, order, axis=1)
+
+    # sequential sums, as the builtin sum
+    cs_weights=np.cumsum(sorted_weights, axis=1)
+    midpoint=0.5*cs_weights[:,-1]
+
+    median=np.zeros(nrows)
+    # a single neighbour outweighs all others
+    heavy=np.any(weights > midpoint[:,np.newaxis], axis=1)
+    maxweight=np.max(weights, axis=1)
+    first=np.argmax(valid & (weights==maxweight[:,np.newaxis]), axis=1)
+    median[heavy]=data[rows, first][heavy]
+
+    idx=np.sum(cs_weights <= midpoint[:,np.newaxis], axis=1)-1
+    idx=np.clip(idx, 0, np.shape(data)[1]-1)
+    nxt=np.clip(idx+1, 0, np.shape(data)[1]-1)
+    equal=cs_weights[rows, idx]==midpoint
+    average=0.5*(sorted_data[rows, idx]+sorted_data[rows, nxt])
+    median[~heavy]=np.where(equal, average, sorted_data[rows, nxt])[~heavy]
+
+    return np.trunc(median).astype('int64')
+
+def _flag_block(self, models, block, iamp, idisp, nparams, ncomp_max):
+    """
+    Flags a block of pixels
+    """
+    from .neighbours import get_kernel_weights
+
+    shape=self.cubeshape[1:]
+    bsize=self.blocksize
+    nblock=np.size(block)
+    ncomps_all=models.ncomps.array
+    params_all=models.params.array
+    errors_all=models.errors.array
+
+    # the neighbours, excluding the central pixel
+    before=(bsize-1)//2
+    slots=np.delete(np.arange(bsize*bsize), before*bsize+before)
+    kernel=get_kernel_weights(bsize).ravel()[slots]
+    y, x = np.divmod(block, shape[1])
+    window=self.keygrid.window(x, y, bsize)[:,slots]
+    ncomps=ncomps_all[block].astype('int64')
+    nbncomps=np.where(window >= 0, ncomps_all[np.maximum(window, 0)], 0).astype('int64')
+    valid=(window >= 0) & (nbncomps!=0)
+
+    flag=np.zeros((nblock, 8), dtype='bool')
+    # pixels without a model are left to flagging_method
+    fallback=~models.has_model.array[block]
+    compflags=[[] for _ in range(nblock)]
+    paramflags=[[] for _ in range(nblock)]
+
+    zero=(ncomps==0) & ~fallback
+    flag[zero,1]=True
+    noneighbours=~zero & ~fallback & ~np.any(valid, axis=1)
+    flag[noneighbours,2]=True
+    active=np.flatnonzero(~zero & ~noneighbours & ~fallback)
+
+    if np.size(active)!=0:
+        n=ncomps[active]
+        nn=nbncomps[active]
+        nvalid=valid[active]
+        nactive=np.size(active)
+        cmax=int(np.max(n))
+        # only the components present in this block are needed
+        cmax=max(cmax, int(np.max(nn)))
+        comps=np.arange(cmax)
+
+        params=params_all[block[active], :cmax*nparams].reshape(nactive, cmax, nparams)
+        errors=errors_all[block[active], :cmax*nparams].reshape(nactive, cmax, nparams)
+        hascomp=comps[np.newaxis,:] < n[:,np.newaxis]
+
+        # flags 3 and 4: measurement/uncertainty < flag_sigma
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sigma_amp=params[:,:,iamp]/errors[:,:,iamp]
+            sigma_disp=params[:,:,idisp]/errors[:,:,idisp]
+        flag[active,3]=np.any(hascomp & (sigma_amp < self.flag_sigma), axis=1)
+        flag[active,4]=np.any(hascomp & (sigma_disp < self.flag_sigma), axis=1)
+
+        # flag 5: deviation from the weighted median number of components
+        weights=np.broadcast_to(kernel, nn.shape)
+        wmedian=_weighted_median(nn.astype('float64'), weights, nvalid)
+        flag[active,5]=np.abs(n-wmedian) > self.flag_deltancomps
+
+        # flag 6: number of component jumps
+        jumps=np.count_nonzero(nvalid & (np.abs(n[:,np.newaxis]-nn) > self.flag_ncomponentjump), axis=1)
+        flag[active,6]=jumps > self.flag_njumps
+
+        # flag 7: deviation from the mean neighbour model
+        flag7, comp7, param7, bad = _flag_mean_neighbour(self, params, n, nn, nvalid, weights,
+                                                         params_all, window[active], nparams, cmax)
+        flag[active,7]=flag7
+        fallback[active]=bad
+        for i, j in enumerate(active.tolist()):
+            if flag7[i]:
+                compflags[j]=comp7[i]
+                paramflags[j]=param7[i]
+
+    return flag.tolist(), compflags, paramflags, fallback
+
+def _flag_mean_neighbour(self, params, n, nn, valid, weights, params_all, window, nparams, cmax):
+    """
+    Vectorised ScouseSpatial.get_mean_neighbour and get_nstddev_from_mean
+    """
+    nactive, nneighbours = np.shape(nn)
+    comps=np.arange(cmax)
+    rows=np.arange(nactive)
+
+    nbparams=params_all[np.maximum(window, 0), :cmax*nparams].reshape(nactive, nneighbours, cmax, nparams)
+
+    # distances between the components of each pixel and of its neighbours,
+    # shape (pixel, neighbour, component, neighbour component)
+    pdiff=np.zeros((nactive, nneighbours, cmax, cmax))
+    with np.errstate(invalid='ignore', over='ignore'):
+        for m in range(nparams):
+            pdiff+=(params[:,np.newaxis,:,np.newaxis,m]-nbparams[:,:,np.newaxis,:,m])**2.
+    distances=np.sqrt(pdiff).reshape(nactive, nneighbours, cmax*cmax)
+
+    # find_closest_match: the distances are flattened with the components of
+    # the pixel varying slowest, and component k of the neighbour is matched
+    # using elements k*ncomps to (k+1)*ncomps of the flattened distances
+    k=comps[np.newaxis,np.newaxis,:,np.newaxis]
+    i=comps[np.newaxis,np.newaxis,np.newaxis,:]
+    ncomps=n[:,np.newaxis,np.newaxis,np.newaxis]
+    nbncomps=np.maximum(nn, 1)[:,:,np.newaxis,np.newaxis]
+    element=k*ncomps+i
+    position=(element//nbncomps)*cmax+element%nbncomps
+    segment=valid[:,:,np.newaxis,np.newaxis] & (k < nbncomps) & (i < ncomps)
+    position=np.where(segment, position, 0).reshape(nactive, nneighbours, cmax*cmax)
+    candidates=np.take_along_axis(distances, position, axis=2).reshape(nactive, nneighbours, cmax, cmax)
+    bad=np.any(segment & ~np.isfinite(candidates), axis=(1,2,3))
+    candidates=np.where(segment, candidates, np.inf)
+    idmin=np.argmin(candidates, axis=3)
+
+    # the matched neighbour components, in the order in which they are found
+    matched=(valid[:,:,np.newaxis] & (comps[np.newaxis,np.newaxis,:] < nn[:,:,np.newaxis]))
+    weight=np.where(nn==n[:,np.newaxis], weights, weights**2.)
+    target=np.where(matched, idmin, -1).reshape(nactive, nneighbours*cmax)
+    matchweights=np.repeat(weight, cmax, axis=1)
+    matchparams=nbparams.reshape(nactive, nneighbours*cmax, nparams)
+
+    meanparams=np.zeros((nactive, cmax, nparams))
+    meanstddev=np.full((nactive, cmax, nparams), 1e-10)
+    found=np.zeros((nactive, cmax), dtype='bool')
+    for c in range(cmax):
+        selected=target==c
+        counts=np.sum(selected, axis=1)
+        found[:,c]=counts!=0
+        # move the selected components to the front, preserving their order
+        order=np.argsort(~selected, axis=1, kind='stable')
+        w=np.take_along_axis(matchweights, order, axis=1)
+        scl=_sum(w, counts)
+        for m in range(nparams):
+            prop=np.take_along_axis(matchparams[:,:,m], order, axis=1)
+            inside=np.arange(np.shape(prop)[1])[np.newaxis,:] < counts[:,np.newaxis]
+            bad|=np.any(inside & ~np.isfinite(prop), axis=1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                average=_sum(prop*w, counts)/scl
+                variance=_sum((prop-average[:,np.newaxis])**2*w, counts)/scl
+            meanparams[found[:,c],c,m]=average[found[:,c]]
+            meanstddev[found[:,c],c,m]=np.sqrt(variance[found[:,c]])
+
+    # mean parameters equal to zero are removed element by element in
+    # get_mean_neighbour, which only this engine cannot reproduce for
+    # components which were matched
+    bad|=np.any(found[:,:,np.newaxis] & (meanparams==0.0), axis=(1,2))
+
+    # get_nstddev_from_mean: the closest component of the mean model
+    pdiff=np.zeros((nactive, cmax, cmax))
+    with np.errstate(invalid='ignore', over='ignore'):
+        for m in range(nparams):
+            pdiff+=(params[:,:,np.newaxis,m]-meanparams[:,np.newaxis,:,m])**2.
+    diff=np.where(found[:,np.newaxis,:], np.sqrt(pdiff), np.inf)
+    hascomp=comps[np.newaxis,:] < n[:,np.newaxis]
+    bad|=np.any(hascomp[:,:,np.newaxis] & found[:,np.newaxis,:] & np.isnan(diff), axis=(1,2))
+    closest=np.argmin(diff, axis=2)
+
+    closestparams=meanparams[rows[:,np.newaxis], closest]
+    closeststddev=meanstddev[rows[:,np.newaxis], closest]
+    closeststddev=np.where(closeststddev!=0, closeststddev, 1e-5)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        nstddev=np.absolute(params-closestparams)/closeststddev
+    nstddev_av=np.sqrt(np.sum(nstddev**2, axis=2)/nparams)
+
+    threshold=self.flag_nstddev
+    flag7=np.any(hascomp & (nstddev_av > threshold), axis=1)
+    compflag=[]
+    paramflag=[]
+    for i in range(nactive):
+        if flag7[i]:
+            ncomp=int(n[i])
+            flagged=nstddev[i,:ncomp] > threshold
+            compflag.append(np.any(flagged, axis=1).tolist())
+            paramflag.append(flagged.ravel().tolist())
+        else:
+            compflag.append([])
+            paramflag.append([])
+
+    return flag7, compflag, paramflag, bad
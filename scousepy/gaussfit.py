@@ -0,0 +1,229 @@
+# Licensed under an MIT open source license - see LICENSE
+
+"""
+Native multi-component Gaussian fitter.
+
+A Levenberg-Marquardt minimiser with analytic derivatives which fits a stack
+of spectra with the same number of components simultaneously. Used as an
+alternative to pyspeckit for fittype='gaussian'. The model is that of
+pyspeckit's gaussian fitter, with the parameters of each component ordered as
+amplitude, shift, width.
+"""
+
+import numpy as np
+import warnings
+
+__all__ = ('parnames', 'gaussian_model', 'fit_gaussians')
+
+parnames=['amplitude', 'shift', 'width']
+
+def gaussian_model(spectral_axis, params):
+    """
+    Computes a multi-component Gaussian model
+
+    Parameters
+    ----------
+    spectral_axis : ndarray
+        the spectral axis
+    params : ndarray
+        the model parameters. Either a 1D array of length 3*ncomps or a 2D
+        array of shape (nspec, 3*ncomps)
+
+    Returns
+    -------
+    model : ndarray
+        the model spectra, shape (nchan,) or (nspec, nchan)
+
+    """
+    params=np.asarray(params, dtype='float64')
+    model, _ = _model_and_jacobian(np.asarray(spectral_axis, dtype='float64'),
+                                   np.atleast_2d(params), jacobian=False)
+    return model[0] if params.ndim==1 else model
+
+def _model_and_jacobian(x, params, jacobian=True):
+    """
+    Returns the model, shape (nspec, nchan), and its derivatives with respect
+    to the parameters, shape (nspec, nchan, npars)
+    """
+    nspec, npars = params.shape
+    amp=params[:,0::3,np.newaxis]
+    shift=params[:,1::3,np.newaxis]
+    width=params[:,2::3,np.newaxis]
+
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        dx=x[np.newaxis,np.newaxis,:]-shift
+        gauss=np.exp(-0.5*(dx/width)**2)
+        model=np.sum(amp*gauss, axis=1)
+        if not jacobian:
+            return model, None
+
+        jac=np.empty((nspec, np.size(x), npars))
+        dshift=amp*gauss*dx/width**2
+        jac[:,:,0::3]=np.swapaxes(gauss, 1, 2)
+        jac[:,:,1::3]=np.swapaxes(dshift, 1, 2)
+        jac[:,:,2::3]=np.swapaxes(dshift*dx/width, 1, 2)
+
+    return model, jac
+
+def _solve(matrices, vectors):
+    """
+    Solves a stack of linear systems. Singular systems return NaNs.
+    """
+    try:
+        return np.linalg.solve(matrices, vectors[...,np.newaxis])[...,0]
+    except np.linalg.LinAlgError:
+        solutions=np.full(vectors.shape, np.nan)
+        for i in range(vectors.shape[0]):
+            try:
+                solutions[i]=np.linalg.solve(matrices[i], vectors[i])
+            except np.linalg.LinAlgError:
+                pass
+        return solutions
+
+def _constrain(params, no_negative):
+    """
+    Applies the parameter limits: widths are positive and, if no_negative,
+    amplitudes are non-negative
+    """
+    params[:,2::3]=np.abs(params[:,2::3])
+    if no_negative:
+        params[:,0::3]=np.clip(params[:,0::3], 0.0, None)
+    return params
+
+def fit_gaussians(spectral_axis, spectra, rms, guesses, no_negative=False,
+                  maxiter=200, ftol=1e-10, lambda0=1e-3, lambdamax=1e10):
+    """
+    Fits multi-component Gaussian models to a stack of spectra
+
+    Parameters
+    ----------
+    spectral_axis : ndarray
+        the spectral axis, shape (nchan,)
+    spectra : ndarray
+        the spectra, shape (nspec, nchan) or (nchan,). Non-finite channels are
+        ignored
+    rms : number or ndarray
+        the noise of each spectrum
+    guesses : ndarray
+        initial guesses, shape (nspec, 3*ncomps) or (3*ncomps,)
+    no_negative : bool
+        do not allow negative amplitudes
+    maxiter : int
+        maximum number of iterations
+    ftol : float
+        the fit of a spectrum has converged once the relative decrease in chi
+        squared of an accepted step falls below this value
+    lambda0 : float
+        initial damping parameter
+    lambdamax : float
+        the fit of a spectrum stops once its damping parameter exceeds this
+        value
+
+    Returns
+    -------
+    result : dictionary
+        A dictionary of arrays with one entry per spectrum:
+
+        params : best-fitting parameters
+        errors : parameter uncertainties, scaled by the reduced chi squared.
+                 NaN if the covariance matrix could not be computed
+        converged : whether or not the uncertainties could be computed
+        chisq : chi squared
+        dof : number of degrees of freedom
+        residstd : standard deviation of the residuals
+        ssr : sum of the squared residuals
+        niter : number of iterations
+
+    """
+    x=np.asarray(spectral_axis, dtype='float64')
+    spectra=np.atleast_2d(np.asarray(spectra, dtype='float64'))
+    params=np.array(np.atleast_2d(guesses), dtype='float64')
+    nspec, nchan = spectra.shape
+    npars=params.shape[1]
+    if (npars==0) or (npars % 3 != 0):
+        raise ValueError("The number of guesses must be a multiple of 3")
+    if params.shape[0]!=nspec:
+        params=np.repeat(params, nspec, axis=0)
+    rms=np.broadcast_to(np.asarray(rms, dtype='float64'), (nspec,))
+
+    # non-finite channels are excluded using zero weights
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weights=np.broadcast_to(1.0/rms[:,np.newaxis]**2, spectra.shape)
+    valid=np.isfinite(spectra) & np.isfinite(weights)
+    weights=np.where(valid, weights, 0.0)
+    data=np.where(valid, spectra, 0.0)
+    nvalid=np.sum(valid, axis=1)
+
+    params=_constrain(params, no_negative)
+    model, jac = _model_and_jacobian(x, params)
+    resid=data-model
+    chisq=np.sum(weights*resid**2, axis=1)
+
+    damping=np.full(nspec, lambda0)
+    niter=np.zeros(nspec, dtype='int')
+    active=(nvalid > 0) & np.all(np.isfinite(params), axis=1) & np.isfinite(chisq)
+    identity=np.eye(npars)
+
+    for iteration in range(maxiter):
+        ids=np.flatnonzero(active)
+        if np.size(ids)==0:
+            break
+        niter[ids]+=1
+
+        # damped normal equations
+        jw=jac[ids]*weights[ids,:,np.newaxis]
+        alpha=np.einsum('snp,snq->spq', jw, jac[ids])
+        beta=np.einsum('snp,sn->sp', jw, resid[ids])
+        diagonal=np.diagonal(alpha, axis1=1, axis2=2)
+        damped=alpha+(damping[ids,np.newaxis]*diagonal)[:,:,np.newaxis]*identity
+        step=_solve(damped, beta)
+
+        trial=_constrain(params[ids]+step, no_negative)
+        trialmodel, trialjac = _model_and_jacobian(x, trial)
+        trialresid=data[ids]-trialmodel
+        trialchisq=np.sum(weights[ids]*trialresid**2, axis=1)
+
+        improved=np.isfinite(trialchisq) & (trialchisq <= chisq[ids])
+        accepted=ids[improved]
+        rejected=ids[~improved]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            reduction=(chisq[accepted]-trialchisq[improved])/chisq[accepted]
+        params[accepted]=trial[improved]
+        model[accepted]=trialmodel[improved]
+        jac[accepted]=trialjac[improved]
+        resid[accepted]=trialresid[improved]
+        chisq[accepted]=trialchisq[improved]
+        damping[accepted]/=10.0
+        damping[rejected]*=10.0
+
+        active[accepted[~(reduction > ftol)]]=False
+        active[rejected[damping[rejected] > lambdamax]]=False
+
+    # uncertainties from the covariance matrix, scaled by the reduced chi
+    # squared as in lmfit
+    dof=nvalid-npars
+    alpha=np.einsum('snp,snq->spq', jac*weights[:,:,np.newaxis], jac)
+    covariance=np.full(alpha.shape, np.nan)
+    for i in range(nspec):
+        if np.all(np.isfinite(alpha[i])):
+            try:
+                covariance[i]=np.linalg.inv(alpha[i])
+            except np.linalg.LinAlgError:
+                pass
+    with np.errstate(divide='ignore', invalid='ignore'):
+        redchisq=np.where(dof > 0, chisq/dof, np.nan)
+        variance=np.diagonal(covariance, axis1=1, axis2=2)*redchisq[:,np.newaxis]
+        errors=np.sqrt(np.where(variance >= 0, variance, np.nan))
+    converged=np.all(np.isfinite(errors), axis=1)
+
+    resid=np.where(valid, resid, np.nan)
+    with warnings.catch_warnings():
+        # spectra without any valid channels
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        residstd=np.nanstd(resid, axis=1)
+    ssr=np.nansum(resid**2, axis=1)
+
+    return {'params': params, 'errors': errors, 'converged': converged,
+            'chisq': chisq, 'dof': dof, 'residstd': residstd, 'ssr': ssr,
+            'niter': niter}
@@ -17,7 +17,7 @@ import shutil
 import time
 import pickle
 
-from .parallel_map import *
+from .executor import get_executor
 
 if sys.version_info.major >= 3:
     proto=3
@@ -123,6 +123,10 @@ def generate_config_file(filename, datadirectory, outputdir, configdir, config_f
                 'default': 'True',
                 'description': "autosave output from individual steps [True/False]",
                 'simple': True}),
+            ('reference_mode', {
+                'default': 'False',
+                'description': "hold references to the spectra rather than copies [True/False]",
+                'simple': False}),
             ]
 
     else:
@@ -221,6 +225,10 @@ def generate_config_file(filename, datadirectory, outputdir, configdir, config_f
             'default': "[2.0,3.0,1.0,2.5,2.5,0.5]",
             'description': "Tolerance values for the fitting. See Henshaw et al. 2016a",
             'simple': True}),
+        ('backend', {
+            'default': make_string('pyspeckit'),
+            'description': "fitter used for the automated fitting [pyspeckit/native]",
+            'simple': False}),
         ]
 
     dct_default = OrderedDict(default)
@@ -342,32 +350,63 @@ def output_moments(cube_header, moments, dir, filename):
             #name='_mom'+str(i)
             #fits.writeto(dir+filename+name+'.fits', moments[i], header, overwrite=True)
 
+def output_rms_map(cube_header, moments, rms_map, dir, filename):
+    """
+    Write the rms map out as a fits file alongside the moment maps
+    """
+    try:
+        unit=cube_header['BUNIT']
+    except KeyError:
+        unit='I'
+
+    header=moments[0].header
+    header['BUNIT']=unit
+    fits.writeto(dir+filename+'_rms.fits', rms_map, header, overwrite=True)
+
 def output_ascii_saa(self, path):
     """
     Outputs an ascii table containing the information for each fit.
     """
+    from .result_store import ResultStore
+    from .tables import write_table
 
     for i in range(len(self.wsaa)):
         saa_dict = self.saa_dict[i]
         if any(SAA.to_be_fit for SAA in saa_dict.values()):
-            table = make_table(self, saa_dict, saa=True)
-            table.write(path+'_model_solutions_'+str(self.wsaa[i])+'.dat', format='ascii', \
-                        overwrite=True, delimiter='\t')
+            results = ResultStore.from_saa_dict(saa_dict, self.cube.shape[1:])
+            # SAAs fitted with zero components are not tabulated
+            write_table(results, path+'_model_solutions_'+str(self.wsaa[i])+'.dat',
+                        format='ascii', mask=results.fitted)
         else:
             # I don't know how we got to this case, but I encountered it at least once.
             print("No fits were found for the {0}'th spectral averaging area.".format(i))
 
-def output_ascii_indiv(self, outputdir, filename = None):
+def output_ascii_indiv(self, outputdir, filename = None, format='ascii'):
     """
-    Outputs an ascii table containing the information for each fit.
+    Outputs a table containing the information for each fit. The table is
+    written in chunks straight from the parameter arrays.
+
+    Parameters
+    ----------
+    self : instance of the scousepy class
+    outputdir : string
+        output directory
+    filename : string, optional
+        output filename
+    format : string
+        'ascii' (tab delimited), 'fits' (binary table) or 'npz' (compressed
+        columnar, readable with numpy.load)
+
     """
+    from .result_store import ResultStore
+    from .tables import write_table
+
     if filename is None:
-        filename='best_fit_solutions.dat'
+        extensions = {'ascii': '.dat', 'fits': '.fits', 'npz': '.npz'}
+        filename='best_fit_solutions'+extensions.get(format, '.dat')
 
-    saa_dict = self.saa_dict[0]
-    table = make_table(self, saa_dict, indiv=True)
-    table.write(outputdir+filename, format='ascii', \
-                overwrite=True, delimiter='\t')
+    results = ResultStore.from_scouseobject(self)
+    write_table(results, outputdir+filename, format=format)
     return
 
 def make_table(self, saa_dict, saa=False, indiv=False):
@@ -451,24 +490,25 @@ def get_solnlist_saa(self, saa_dict):
 
 def get_solnlist_indiv(self):
     """
-    Returns list of solutions to individual pixels
+    Returns an array of solutions to individual pixels, one row per component.
+    Models with zero components contribute a single row. The columns are as
+    described in get_soln_desc
     """
-    solnlist = []
-    for key in self.indiv_dict.keys():
-        spectrum = self.indiv_dict[key]
-        soln = spectrum.model
-        if soln is not None:
-            if soln.ncomps==0.0:
-                solution_desc = get_soln_desc(0, soln, \
-                                              spectrum.coordinates[0], \
-                                              spectrum.coordinates[1])
-                solnlist.append(solution_desc)
-            else:
-                for k in range(int(soln.ncomps)):
-                    solution_desc = get_soln_desc(k, soln, \
-                                                  spectrum.coordinates[0], \
-                                                  spectrum.coordinates[1])
-                    solnlist.append(solution_desc)
+    from .result_store import ResultStore
+
+    results = ResultStore.from_scouseobject(self)
+    rows, params, errors = results.get_components(include_empty=True)
+
+    # interleave the parameters and their uncertainties
+    parameters = np.empty((np.size(rows), 2*results.nparams))
+    parameters[:,0::2] = params
+    parameters[:,1::2] = errors
+
+    non_specific_before = [results.ncomps[rows], results.x[rows], results.y[rows]]
+    non_specific_after = [results.rms[rows], results.residstd[rows], results.chisq[rows],
+                          results.dof[rows], results.redchisq[rows], results.AIC[rows]]
+
+    solnlist = np.column_stack(non_specific_before+[parameters]+non_specific_after)
 
     return solnlist
 
@@ -500,7 +540,69 @@ def get_soln_desc(idx, soln, x, y):
 
     return solution_desc
 
-def create_modelcube(self, njobs=1, verbose=True):
+def output_parameter_cubes(self, outputdir=None, sortby='shift', descending=False):
+    """
+    Writes the parameters of the best-fitting models, and their uncertainties,
+    as FITS cubes of shape (ncomp_max, ny, nx), one per parameter.
+
+    Parameters
+    ----------
+    self : instance of the scousepy class
+    outputdir : string, optional
+        output directory. Default is the stage 4 directory
+    sortby : string, optional
+        the parameter by which the components of each spectrum are ordered,
+        e.g. 'shift' (velocity) or 'amplitude'. If None, the components are
+        left in the order of the fit
+    descending : bool
+        order the components in descending order, e.g. brightest first
+
+    Returns
+    -------
+    filenames : list
+        the files written
+
+    Notes
+    -----
+    Output files are <filename>_<parameter>.fits and
+    <filename>_err_<parameter>.fits. Planes beyond the number of components of
+    a given spectrum are NaN.
+
+    """
+    from .result_store import ResultStore
+
+    if outputdir is None:
+        outputdir = self.outputdirectory+self.filename+'/stage_4/'
+
+    results = ResultStore.from_scouseobject(self)
+    if results.parnames is None:
+        raise ValueError("No best-fitting models were found.")
+    params, errors = results.get_component_cubes(sortby=sortby, descending=descending)
+
+    header = self.cube[0,:,:].header
+    header['CTYPE3'] = 'COMPONENT'
+    header['CRPIX3'] = 1.0
+    header['CRVAL3'] = 1.0
+    header['CDELT3'] = 1.0
+    # units of the gaussian parameters
+    try:
+        unit = header['BUNIT']
+    except KeyError:
+        unit = ''
+    units = {'amplitude': unit, 'shift': 'km s-1', 'width': 'km s-1'}
+
+    filenames = []
+    for j, parname in enumerate(results.parnames):
+        header['BUNIT'] = units.get(parname, '')
+        for name, data in [(parname, params[j]), ('err_'+parname, errors[j])]:
+            filename = os.path.join(outputdir, self.filename+'_'+name+'.fits')
+            fits.writeto(filename, data, header, overwrite=True)
+            filenames.append(filename)
+
+    return filenames
+
+def create_modelcube(self, njobs=1, verbose=True, outputfile=None,
+                     tilesize=2**22):
     """
     Generates a "clean" datacube from the scousepy decomposition. Returns a
     clean cube
@@ -512,8 +614,21 @@ def create_modelcube(self, njobs=1, verbose=True):
         number of cpus
     verbose: bool
         verbose output
+    outputfile : string, optional
+        if provided, the model cube is streamed into this FITS file, which is
+        memory mapped, rather than being held in memory
+    tilesize : number
+        approximate number of elements (pixels times channels) evaluated at a
+        time
+
+    Notes
+    -----
+    The models are evaluated from the parameter arrays of the best-fitting
+    solutions in tiles of rows of the map (see synthesis.py)
 
     """
+    from .result_store import ResultStore
+    from .synthesis import get_model_components, synthesise_cube, create_fits_file
 
     # Time it
     starttime = time.time()
@@ -527,33 +642,115 @@ def create_modelcube(self, njobs=1, verbose=True):
 # 
 #     _cube = cube[min(trimids):max(trimids)+1, :, :]
     _cube = self.cube
-    _modelcube = np.full_like(_cube, np.nan)
+    shape = _cube.shape[1:]
 
     if verbose:
         print("")
         print("Generating models:")
         print("")
 
-    args = [self]
-    inputs = [[key] + args for key in self.indiv_dict.keys()]
-    if njobs==1:
-        mods = ProgressBar.map(genmodel, inputs)
+    store = ResultStore.from_indiv_dict(self.indiv_dict, shape)
+    components = get_model_components(store)
+
+    if outputfile is not None:
+        create_fits_file(outputfile, _cube.header, _cube.shape)
+        with fits.open(outputfile, mode='update', memmap=True) as hdul:
+            synthesise_cube(self.x, components, shape, hdul[0].data,
+                            njobs=njobs, tilesize=tilesize, verbose=verbose)
+        modelcube = SpectralCube.read(outputfile)
     else:
-        mods = parallel_map(genmodel, inputs, numcores=njobs)
-    mergedmods = [mod for mod in mods]
-    mergedmods = np.asarray(mergedmods)
+        _modelcube = np.empty(_cube.shape, dtype='float32')
+        synthesise_cube(self.x, components, shape, _modelcube,
+                        njobs=njobs, tilesize=tilesize, verbose=verbose)
+        modelcube = SpectralCube(data=_modelcube, wcs=_cube.wcs)
+
+    endtime = time.time()
+    if verbose:
+        print("")
+        print('Process completed in: {0} minutes'.format((endtime-starttime)/60.))
+        print("")
+
+    return modelcube
+
+def create_residual_products(self, outputdir=None, njobs=1, verbose=True,
+                             write_model=False, tilesize=2**22, overwrite=True):
+    """
+    Generates the residual cube of the scousepy decomposition together with
+    maps of the rms, maximum and skewness of the residuals, in a single pass
+    over the data. The cubes are streamed into memory-mapped FITS files.
+
+    Parameters
+    ----------
+    self : instance of the scousepy class
+    outputdir : string, optional
+        output directory. Default is the stage 4 directory
+    njobs : Number
+        number of cpus
+    verbose: bool
+        verbose output
+    write_model : bool
+        also write the model cube
+    tilesize : number
+        approximate number of elements (pixels times channels) processed at a
+        time
+    overwrite : bool
+        overwrite existing files
+
+    Returns
+    -------
+    statistics : dictionary
+        the residual rms, max and skew maps
+
+    Notes
+    -----
+    The residuals are computed from the unmasked data, i.e. the spectra which
+    were fitted, and the statistics over the channels within vel_range. Pixels
+    without a best-fitting model are NaN. Output files are
+    <filename>_residual_cube.fits, <filename>_model_cube.fits and, as for the
+    maps of ScouseFitChecker.save_maps, stage_4_residual_<statistic>.fits
+
+    """
+    from .result_store import ResultStore
+    from .synthesis import get_model_components, synthesise_residuals, create_fits_file
+    from .scousefitchecker import get_map_directory, save_map_files
+
+    starttime = time.time()
+
+    if outputdir is None:
+        outputdir = get_map_directory(self)
+    cube = self.cube
+    shape = cube.shape[1:]
 
     if verbose:
         print("")
-        print("Creating model cube:")
+        print("Generating residuals:")
         print("")
-        progress_bar = ProgressBar(self.indiv_dict.keys())
 
-    for i, key in enumerate(self.indiv_dict.keys()):
-        _modelcube[:, self.indiv_dict[key].coordinates[1],
-                      self.indiv_dict[key].coordinates[0]] = mergedmods[i]
-        if verbose:
-            progress_bar.update()
+    store = ResultStore.from_indiv_dict(self.indiv_dict, shape)
+    components = get_model_components(store)
+    channels = None if self.trimids is None else np.where(self.trimids)[0]
+
+    residualfile = os.path.join(outputdir, self.filename+'_residual_cube.fits')
+    modelfile = os.path.join(outputdir, self.filename+'_model_cube.fits')
+    create_fits_file(residualfile, cube.header, cube.shape, overwrite=overwrite)
+    if write_model:
+        create_fits_file(modelfile, cube.header, cube.shape, overwrite=overwrite)
+
+    with fits.open(residualfile, mode='update', memmap=True) as hdul:
+        if write_model:
+            with fits.open(modelfile, mode='update', memmap=True) as hdulmodel:
+                maps = synthesise_residuals(self.x, components, cube, hdul[0].data,
+                                            out_model=hdulmodel[0].data, channels=channels,
+                                            njobs=njobs, tilesize=tilesize, verbose=verbose)
+        else:
+            maps = synthesise_residuals(self.x, components, cube, hdul[0].data,
+                                        channels=channels, njobs=njobs,
+                                        tilesize=tilesize, verbose=verbose)
+
+    # saved alongside the diagnostic maps of ScouseFitChecker
+    statistics = dict(zip(['rms', 'max', 'skew'], maps))
+    save_map_files(self, ['residual_'+mapname for mapname in statistics],
+                   list(statistics.values()), savedir=outputdir, overwrite=overwrite)
 
     endtime = time.time()
     if verbose:
@@ -561,35 +758,7 @@ def create_modelcube(self, njobs=1, verbose=True):
         print('Process completed in: {0} minutes'.format((endtime-starttime)/60.))
         print("")
 
-    return SpectralCube(data=_modelcube, wcs=_cube.wcs)
-
-def genmodel(inputs):
-    """
-    generates the model for the creation of the model cube
-    """
-    key, self = inputs
-    spectrum = self.indiv_dict[key]
-    bfmodel = spectrum.model
-    if bfmodel.ncomps>0:
-# Commented out by TW on 27-jul-23 because stage_5 is not defined
-#         from .stage_5 import recreate_model
-#         mod,res = recreate_model(self, spectrum, bfmodel)
-        from .SpectralDecomposer import Decomposer
-        decomposer=Decomposer(self.x, spectrum.spectrum, spectrum.rms)
-        Decomposer.create_a_spectrum(decomposer)
-        pskspectrum=decomposer.pskspectrum
-        pskspectrum.specfit.fittype = bfmodel.fittype
-        pskspectrum.specfit.fitter = pskspectrum.specfit.Registry.multifitters[bfmodel.fittype]
-        mod = np.zeros([len(self.x), int(bfmodel.ncomps)])
-        for k in range(int(bfmodel.ncomps)):
-            modparams = bfmodel.params[(k*len(bfmodel.parnames)):(k*len(bfmodel.parnames))+len(bfmodel.parnames)]
-            mod[:,k] = pskspectrum.specfit.get_model_frompars(self.x, modparams)
-        totmod = np.nansum(mod, axis=1)
-    else:
-#         totmod = np.full_like(self.xtrim, np.nan)
-        totmod = np.full_like(self.x, np.nan)
-
-    return totmod
+    return statistics
 
 def save(self, filename):
     """
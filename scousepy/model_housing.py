@@ -2,6 +2,104 @@
 
 import numpy as np
 
+# sources of the spectra held by reference, keyed by name. See
+# register_spectrum_source
+_spectrum_sources={}
+
+class SpectrumReference(object):
+    """
+    A reference to a spectrum held by a registered source (the data cube or an
+    array of spectra). SAAs and individual spectra created in reference mode
+    hold one of these instead of a copy of their spectrum. The spectrum is
+    materialised each time it is requested.
+
+    Parameters
+    ----------
+    source : string
+        name of the source (see register_spectrum_source)
+    key : int
+        the flattened pixel index of the spectrum if the source is a cube,
+        otherwise the row of the source array
+
+    """
+    __slots__ = ('source', 'key')
+
+    def __init__(self, source, key):
+        self.source=source
+        self.key=int(key)
+
+    def __repr__(self):
+        """
+        Return a nice printable format for the object.
+        """
+        return "< scousepy spectrum reference; source={0}; key={1} >".format(self.source, self.key)
+
+    def __getstate__(self):
+        return (self.source, self.key)
+
+    def __setstate__(self, state):
+        self.source, self.key = state
+
+    def get(self):
+        """
+        Returns the spectrum
+        """
+        if self.source not in _spectrum_sources:
+            raise KeyError("The spectrum source '{0}' is not available. Load the "
+                           "data cube and stage 1 output first.".format(self.source))
+        source=_spectrum_sources[self.source]
+        if hasattr(source, 'filled_data'):
+            # spectral cube
+            y, x = np.unravel_index(self.key, source.shape[1:])
+            return source.unmasked_data[:, y, x].value
+        return np.asarray(source[self.key])
+
+def register_spectrum_source(name, data):
+    """
+    Registers the source of spectra held by reference
+
+    Parameters
+    ----------
+    name : string
+        name of the source
+    data : spectral cube or ndarray
+        either a cube, indexed with the flattened pixel index, or a 2D array
+        with one spectrum per row
+
+    """
+    _spectrum_sources[name]=data
+
+def get_cube_source(scouseobject):
+    """
+    Name of the source of the individual spectra of a scouse object
+    """
+    return 'cube:'+str(scouseobject.filename)
+
+def get_saa_source(scouseobject, key):
+    """
+    Name of the source of the SAA spectra of a given wsaa
+    """
+    return 'saa:'+str(scouseobject.filename)+':'+str(key)
+
+def _get_spectrum(self):
+    if (self._spectrum is None) and (self.reference is not None):
+        return self.reference.get()
+    return self._spectrum
+
+def _set_spectrum(self, spectrum):
+    if isinstance(spectrum, SpectrumReference):
+        self.reference=spectrum
+        self._spectrum=None
+    else:
+        self._spectrum=spectrum
+
+def _set_state(self, state):
+    # objects pickled before the introduction of reference mode
+    if 'spectrum' in state:
+        state['_spectrum']=state.pop('spectrum')
+    state.setdefault('reference', None)
+    self.__dict__.update(state)
+
 class saa(object):
     """
     Stores all the information regarding individual spectral averaging areas
@@ -11,8 +109,8 @@ class saa(object):
     ----------
     coordinates : array
         The coordinates of the SAA in pixel units. In (x,y).
-    spectrum : array
-        The spectrum
+    spectrum : array or SpectrumReference
+        The spectrum, or a reference to it
     index : number
         The index of the spectral averaging area (used as a key for saa_dict)
     to_be_fit : bool
@@ -26,13 +124,18 @@ class saa(object):
     coordinates : array
         The coordinates of the SAA in pixel units
     spectrum : array
-        The spectrum
+        The spectrum. Materialised from reference if the SAA was created in
+        reference mode
+    reference : SpectrumReference
+        The reference to the spectrum (None if the spectrum is held directly)
     rms : number
         An estimate of the rms
     indices : array
         The indices of individual pixels located within the SAA
     indices_flat : array
         The same indices but flattened according to the shape of the cube
+    indices_shape : tuple
+        The (y, x) shape used to flatten the indices
     to_be_fit : bool
         Indicating whether or not the SAA is to be fit or not
     individual_spectra : dictionary
@@ -46,10 +149,12 @@ class saa(object):
 
         self.index=index
         self.coordinates=coordinates
+        self.reference=None
         self.spectrum=spectrum
         self.rms=get_rms(self,scouseobject)
         self.indices=None
         self.indices_flat=None
+        self.indices_shape=None
         self.to_be_fit=to_be_fit
         self.model=None
         self.individual_spectra=None
@@ -60,6 +165,9 @@ class saa(object):
         """
         return "< scousepy SAA; index={0} >".format(self.index)
 
+    spectrum=property(_get_spectrum, _set_spectrum)
+    __setstate__=_set_state
+
     def add_indices(self, indices, shape):
         """
         Adds indices contained within the SAA
@@ -74,6 +182,7 @@ class saa(object):
         """
         self.indices=np.array(indices, dtype='int')
         self.indices_flat=np.ravel_multi_index(indices.T, shape)
+        self.indices_shape=tuple(shape)
 
     def add_saamodel(self, model):
         """
@@ -95,8 +204,8 @@ class individual_spectrum(object):
     ----------
     coordinates : array
         The coordinates of the spectrum in pixel units. In (x,y).
-    spectrum : array
-        The spectrum
+    spectrum : array or SpectrumReference
+        The spectrum, or a reference to it
     index : number
         The flattened index of the spectrum
     scouseobject : instance of the scouse class
@@ -105,9 +214,17 @@ class individual_spectrum(object):
         parent model solution to provide initial guesses for the fitter
     saaindex : number
         Index of the SAA. Used to locate a given spectrum's parent SAA
+    rms : number
+        The rms of the spectrum. If None (default) this will be computed from
+        the spectrum
 
     Attributes
     ----------
+    spectrum : array
+        The spectrum. Materialised from reference if the spectrum was created
+        in reference mode
+    reference : SpectrumReference
+        The reference to the spectrum (None if the spectrum is held directly)
     template : instance of pyspeckit's Spectrum class
         A template spectrum updated during fitting
     model : instance of the indivmodel class
@@ -125,15 +242,23 @@ class individual_spectrum(object):
     decision : string
         The decision made during stage 4 of the process, i.e. if the spectrum
         was refit,
+    nretries : int or list
+        The number of times the spectrum was refit with updated guesses during
+        stage 3. After compilation this is a list with one entry per model in
+        model_from_parent
     """
 
     def __init__(self, coordinates, spectrum, index=None, scouseobject=None,
-                 saa_dict_index=None, saaindex=None):
+                 saa_dict_index=None, saaindex=None, rms=None):
 
         self.index=index
         self.coordinates=coordinates
+        self.reference=None
         self.spectrum=spectrum
-        self.rms=get_rms(self, scouseobject)
+        if rms is None:
+            self.rms=get_rms(self, scouseobject)
+        else:
+            self.rms=rms
         self.saa_dict_index=saa_dict_index
         self.saaindex=saaindex
         self.template=None
@@ -145,6 +270,7 @@ class individual_spectrum(object):
         self.model_from_spatial=None
         self.model_from_manual=None
         self.decision=None
+        self.nretries=None
 
     def __repr__(self):
         """
@@ -152,6 +278,9 @@ class individual_spectrum(object):
         """
         return "<< scousepy individual spectrum; index={0} >>".format(self.index)
 
+    spectrum=property(_get_spectrum, _set_spectrum)
+    __setstate__=_set_state
+
     def add_model(self, model):
         """
         Adds model solution
@@ -175,15 +304,22 @@ class individual_spectrum(object):
 
 def get_rms(self, scouseobject):
     """
-    Calculates rms value. Used by both saa and individual_spectrum classes
+    Calculates rms value. Used by both saa and individual_spectrum classes.
+    The rms of individual spectra is taken from the rms map where available.
 
     Parameters
     ----------
     scouseobject : instance of the scouse class
 
     """
+    if isinstance(self, individual_spectrum) and (self.index is not None):
+        rms=lookup_rms(scouseobject, self.index)
+        if rms is not None:
+            return rms
+
     from scousepy.noisy import getnoise
-    noisy=getnoise(scouseobject.x, self.spectrum)
+    from scousepy.stage_1 import get_noise_params
+    noisy=getnoise(scouseobject.x, self.spectrum, **get_noise_params(scouseobject))
 
     if np.isfinite(noisy.rms):
         rms = noisy.rms
@@ -194,6 +330,32 @@ def get_rms(self, scouseobject):
 
     return rms
 
+def lookup_rms(scouseobject, index):
+    """
+    Looks up rms values in the rms map
+
+    Parameters
+    ----------
+    scouseobject : instance of the scouse class
+    index : number or array
+        flattened index (or indices) of the spectra
+
+    Returns
+    -------
+    rms : number or list
+        The rms value(s). Where the rms could not be determined, the value
+        measured over the entire cube is used. None if there is no rms map.
+
+    """
+    rms_map=getattr(scouseobject, 'rms_map', None)
+    if rms_map is None:
+        return None
+
+    rms=rms_map.ravel()[index]
+    if np.ndim(rms)==0:
+        return rms if np.isfinite(rms) else scouseobject.rms_approx
+    return [r if np.isfinite(r) else scouseobject.rms_approx for r in rms]
+
 class basemodel(object):
     """
     Base model for scouse. These properties are shared by both SAA model
@@ -0,0 +1,209 @@
+# Licensed under an MIT open source license - see LICENSE
+
+"""
+Grid-indexed neighbour lookup.
+
+The keys of indiv_dict (flattened pixel indices) are placed on a 2D grid the
+shape of the map, with -1 marking pixels without a spectrum. The neighbours of
+any number of pixels within a blocksize x blocksize window are then gathered
+with array indexing, rather than by building and filtering lists of keys for
+each pixel in turn.
+"""
+
+import numpy as np
+
+__all__ = ('get_window_offsets', 'get_window', 'get_kernel_weights',
+           'get_offset_weights', 'KeyGrid')
+
+# spatial weight kernels, keyed by blocksize
+_kernels={}
+
+def get_window_offsets(blocksize):
+    """
+    Returns the (y, x) offsets of the pixels of a blocksize x blocksize window
+    relative to its centre, in row-major order
+    """
+    before=(blocksize-1)//2
+    offsets=np.arange(blocksize)-before
+    dy, dx = np.meshgrid(offsets, offsets, indexing='ij')
+    return dy.ravel(), dx.ravel()
+
+def get_window(xpos, ypos, blocksize, shape):
+    """
+    Returns the flattened indices of the pixels within a window centred on
+    each of a set of pixels
+
+    Parameters
+    ----------
+    xpos, ypos : int or ndarray
+        the coordinates of the reference pixels
+    blocksize : int
+        size of the window
+    shape : tuple
+        the (y, x) shape of the map
+
+    Returns
+    -------
+    indices : ndarray
+        shape np.shape(xpos)+(blocksize**2,), in row-major order within the
+        window. -1 where the window extends beyond the map
+
+    """
+    dy, dx = get_window_offsets(blocksize)
+    y=np.asarray(ypos, dtype='int64')[...,np.newaxis]+dy
+    x=np.asarray(xpos, dtype='int64')[...,np.newaxis]+dx
+    inside=(y >= 0) & (y < shape[0]) & (x >= 0) & (x < shape[1])
+    return np.where(inside, y*shape[1]+x, -1)
+
+def get_kernel_weights(blocksize):
+    """
+    Returns the spatial weights of the pixels within a window: a Gaussian
+    kernel of sigma=1, normalised to the value of the nearest neighbours
+    (second highest value, the highest being the central pixel). Computed once
+    per blocksize
+
+    Parameters
+    ----------
+    blocksize : int
+        size of the window
+
+    Returns
+    -------
+    weights : ndarray
+        shape (blocksize, blocksize), indexed by the (y, x) offset from the
+        centre plus (blocksize-1)//2. Read-only
+
+    """
+    if blocksize not in _kernels:
+        from astropy.convolution import Gaussian2DKernel
+        kernel=Gaussian2DKernel(1, x_size=blocksize, y_size=blocksize).array
+        weights=kernel/np.sort(kernel.ravel())[-2]
+        weights.setflags(write=False)
+        _kernels[blocksize]=weights
+    return _kernels[blocksize]
+
+def get_offset_weights(blocksize, dy, dx):
+    """
+    Returns the spatial weights of pixels at given (y, x) offsets from the
+    centre of the window. See get_kernel_weights
+    """
+    before=(blocksize-1)//2
+    return get_kernel_weights(blocksize)[np.asarray(dy)+before, np.asarray(dx)+before]
+
+class KeyGrid(object):
+    """
+    A 2D grid of the keys of a dictionary of spectra (e.g. indiv_dict or
+    SharedModels). Pixels without a spectrum are -1.
+
+    Parameters
+    ----------
+    keys : ndarray
+        the flattened pixel indices of the spectra
+    shape : tuple
+        the (y, x) shape of the map
+
+    Attributes
+    ----------
+    grid : ndarray
+        the keys, shape (ny, nx)
+
+    """
+    def __init__(self, keys, shape):
+
+        self.shape=tuple(shape)
+        self.grid=np.full(self.shape, -1, dtype='int64')
+        keys=np.asarray(keys, dtype='int64')
+        self.grid.ravel()[keys]=keys
+        self._padded={}
+
+    def __repr__(self):
+        """
+        Return a nice printable format for the object.
+        """
+        return "<< scousepy key grid; shape={0}; nkeys={1} >>".format(self.shape, np.count_nonzero(self.grid >= 0))
+
+    @classmethod
+    def from_dict(cls, indiv_dict, shape):
+        """
+        Creates a grid of the spectra of indiv_dict (or of SharedModels) which
+        have a best-fitting model
+        """
+        from .shared_data import SharedModels
+        from .result_store import ResultStore
+        if isinstance(indiv_dict, SharedModels):
+            keys=np.flatnonzero(indiv_dict.has_model.array)
+        elif isinstance(indiv_dict, ResultStore):
+            keys=indiv_dict.index[indiv_dict.has_model]
+        else:
+            keys=[key for key, spectrum in indiv_dict.items() if spectrum.model is not None]
+        return cls(keys, shape)
+
+    def __contains__(self, key):
+        """
+        Whether a key is on the grid
+        """
+        return bool(self.grid.ravel()[key] == key)
+
+    def add(self, key):
+        """
+        Adds a key to the grid
+        """
+        self.grid.ravel()[key]=key
+        self._padded={}
+
+    def window(self, xpos, ypos, blocksize):
+        """
+        Returns the keys within a window centred on each of a set of pixels
+
+        Parameters
+        ----------
+        xpos, ypos : int or ndarray
+            the coordinates of the reference pixels
+        blocksize : int
+            size of the window
+
+        Returns
+        -------
+        keys : ndarray
+            shape np.shape(xpos)+(blocksize**2,). -1 where there is no
+            spectrum or the window extends beyond the map
+
+        """
+        indices=get_window(xpos, ypos, blocksize, self.shape)
+        return np.where(indices >= 0, self.grid.ravel()[np.maximum(indices, 0)], -1)
+
+    def neighbours(self, xpos, ypos, blocksize):
+        """
+        Returns the keys of the neighbours of a single pixel, excluding the
+        pixel itself
+        """
+        keys=self.window(xpos, ypos, blocksize)
+        centre=int(ypos)*self.shape[1]+int(xpos)
+        return keys[(keys >= 0) & (keys != centre)]
+
+    def containing(self, xpos, ypos, blocksize):
+        """
+        Returns the keys of the pixels whose window contains a single pixel,
+        excluding the pixel itself, i.e. those whose neighbours change when
+        the pixel changes
+        """
+        dy, dx = get_window_offsets(blocksize)
+        y=int(ypos)-dy
+        x=int(xpos)-dx
+        inside=(y >= 0) & (y < self.shape[0]) & (x >= 0) & (x < self.shape[1])
+        keys=self.grid[y[inside], x[inside]]
+        centre=int(ypos)*self.shape[1]+int(xpos)
+        return keys[(keys >= 0) & (keys != centre)]
+
+    def windows(self, blocksize):
+        """
+        Returns the windows centred on every pixel of the map as a read-only
+        view of shape (ny, nx, blocksize, blocksize), without copying the grid
+        """
+        if blocksize not in self._padded:
+            before=(blocksize-1)//2
+            after=blocksize-1-before
+            self._padded[blocksize]=np.pad(self.grid, ((before, after), (before, after)),
+                                           mode='constant', constant_values=-1)
+        return np.lib.stride_tricks.sliding_window_view(self._padded[blocksize],
+                                                        (blocksize, blocksize))
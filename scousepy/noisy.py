@@ -1,6 +1,7 @@
 # Licensed under an MIT open source license - see LICENSE
 
 import numpy as np
+from functools import lru_cache
 from astropy.stats import sigma_clip, mad_std, median_absolute_deviation
 
 class getnoise(object):
@@ -153,14 +154,7 @@ class getnoise(object):
             less than p_limit to be due to chance.
 
         """
-        for consec_channels in range(2, 30):
-            a = np.zeros((consec_channels, consec_channels))
-            for i in range(consec_channels - 1):
-                a[i, 0] = a[i, i + 1] = 0.5
-            a[consec_channels - 1, consec_channels - 1] = 1.0
-            if np.linalg.matrix_power(
-                    a, n_channels - 1)[0, consec_channels - 1] < p_limit:
-                return consec_channels
+        return get_max_consecutive_channels(n_channels, p_limit)
 
     def mask_broadpeaks(self, n_channels, pad_channels, consecutive_channels, ranges, max_consecutive_channels=14 ):
         """
@@ -241,7 +235,7 @@ class getnoise(object):
             else:
                 ranges = np.where(absdiff == 1)[0].reshape(-1, 2)
 
-        sort_indices = np.argsort(ranges[:, 0])
+        sort_indices = np.argsort(ranges[:, 0], kind='mergesort')
         ranges = ranges[sort_indices]
 
         consecutive_channels = ranges[:, 1] - ranges[:, 0]
@@ -351,3 +345,207 @@ class getnoise(object):
                 mask[low:upp] = 0
 
         return mask.astype('bool')
+
+@lru_cache(maxsize=None)
+def get_max_consecutive_channels(n_channels, p_limit):
+    """
+    Determine the maximum number of random consecutive positive/negative
+    channels. This only depends on the number of channels and p_limit and so
+    the result is cached.
+
+    Parameters
+    ----------
+    n_channels : int
+        Number of spectral channels.
+    p_limit : float
+        Maximum probability for consecutive positive/negative channels being
+        due to chance.
+
+    Returns
+    -------
+    consec_channels : int
+        Number of consecutive positive/negative channels that have a probability
+        less than p_limit to be due to chance.
+
+    """
+    for consec_channels in range(2, 30):
+        a = np.zeros((consec_channels, consec_channels))
+        for i in range(consec_channels - 1):
+            a[i, 0] = a[i, i + 1] = 0.5
+        a[consec_channels - 1, consec_channels - 1] = 1.0
+        if np.linalg.matrix_power(
+                a, n_channels - 1)[0, consec_channels - 1] < p_limit:
+            return consec_channels
+
+def getnoise_batch(spectral_axis, spectra, p_limit=0.02, pad_channels=2,
+                   n_mad=5.0, remove_broad=True, mad=False, blocksize=4096):
+    """
+    Vectorised version of getnoise for many spectra at once. Returns the same
+    rms values as getnoise(spectral_axis, spectrum, ...).rms would for each
+    spectrum individually.
+
+    Parameters
+    ----------
+    spectral_axis : array
+        An array of values corresponding to the spectral axis (e.g. velocity)
+    spectra : numpy.ndarray
+        An (nspec, nchan) array of spectra
+    p_limit : float
+        Maximum probability for consecutive positive/negative channels being
+        due to chance
+    pad_channels : int
+        Number of channels by which peak intervals are extended on both sides
+    n_mad : float
+        Multiple of the median absolute deviation used to identify spikes
+    remove_broad : boolean
+        If True, broad components are masked prior to computing the MAD
+    mad : boolean
+        If True the rms is computed as the median absolute deviation of the
+        noise channels
+    blocksize : int
+        Number of spectra processed together. Limits the memory footprint
+
+    Returns
+    -------
+    rms : numpy.ndarray
+        An array of length nspec containing the rms of each spectrum. Spectra
+        for which the noise cannot be determined are returned as nan.
+
+    """
+    spectra=np.atleast_2d(np.asarray(spectra))
+    nspec=spectra.shape[0]
+    n_channels=np.size(spectral_axis)
+    dtype=np.result_type(spectra.dtype, np.float32)
+    rms=np.full(nspec, np.nan, dtype=dtype)
+
+    if remove_broad:
+        max_consecutive_channels=get_max_consecutive_channels(n_channels, p_limit)
+    else:
+        max_consecutive_channels=None
+
+    for i in range(0, nspec, blocksize):
+        rms[i:i+blocksize]=_getnoise_block(spectra[i:i+blocksize], n_channels,
+                                           pad_channels, n_mad,
+                                           max_consecutive_channels, mad)
+    return rms
+
+def _getnoise_block(spectra, n_channels, pad_channels, n_mad,
+                    max_consecutive_channels, mad):
+    """
+    Computes the rms of a block of spectra. See getnoise_batch.
+    """
+    nspec=spectra.shape[0]
+    channels=np.arange(n_channels)
+    rms=np.full(nspec, np.nan, dtype=np.result_type(spectra.dtype, np.float32))
+
+    # fail safe checks - see getnoise
+    with np.errstate(invalid='ignore'):
+        valid=np.isfinite(spectra).any(axis=1) & \
+              ~((spectra>0.0).all(axis=1) | (spectra<0.0).all(axis=1))
+    if not valid.any():
+        return rms
+    spectra=spectra[valid]
+
+    nanmask=np.isnan(spectra)
+    with np.errstate(invalid='ignore'):
+        ispos=spectra>=0.0
+        isneg=spectra<=0.0
+
+    # run-length encoding of the positive and negative features. For each
+    # channel we record the end of the run that it belongs to and whether or
+    # not a run starts there.
+    start_pos, end_pos=_runs(ispos, channels)
+    start_neg, end_neg=_runs(isneg, channels)
+
+    mask=nanmask.copy()
+    if max_consecutive_channels is not None:
+        broad_pos=start_pos & ((end_pos-channels)>=max_consecutive_channels)
+        broad_neg=start_neg & ((end_neg-channels)>=max_consecutive_channels)
+        mask|=_mask_intervals(np.concatenate((broad_pos, broad_neg), axis=1),
+                              np.concatenate((end_pos, end_neg), axis=1),
+                              n_channels, pad_channels)
+
+    # MAD of the reflected negative noise (which equals the median of the
+    # absolute negative values). Falls back on the MAD of the unmasked
+    # channels where there are no negative channels.
+    with np.errstate(invalid='ignore'):
+        noise=np.where(mask, np.nan, spectra)
+        negative=np.where(noise<0.0, np.abs(noise), np.nan)
+    hasneg=(~np.isnan(negative)).any(axis=1)
+    MAD=np.full(spectra.shape[0], np.nan)
+    if hasneg.any():
+        MAD[hasneg]=np.nanmedian(negative[hasneg], axis=1)
+    fallback=~hasneg & (~mask).any(axis=1)
+    if fallback.any():
+        MAD[fallback]=_nanmad(noise[fallback])
+
+    # mask outlier peaks. Each high-amplitude channel masks the peak with the
+    # latest starting channel, mirroring the np.digitize lookup in getnoise.
+    spectrum_masked=np.where(mask, 0.0, spectra)
+    with np.errstate(invalid='ignore'):
+        high=np.abs(spectrum_masked)>(n_mad*MAD)[:,None]
+    if high.any():
+        isstart=start_pos | start_neg
+        latest=np.maximum.accumulate(np.where(isstart, channels, -1), axis=1)
+        rows=np.nonzero(high)[0]
+        lower=latest[high]
+        upper=np.where(start_neg[rows, lower], end_neg[rows, lower],
+                       end_pos[rows, lower])
+        outliers=np.zeros_like(mask)
+        outliers[rows, lower]=True
+        ends=np.zeros(mask.shape, dtype=end_pos.dtype)
+        np.maximum.at(ends, (rows, lower), upper)
+        mask|=_mask_intervals(outliers, ends, n_channels, pad_channels)
+
+    # determine the noise from the remaining channels
+    nnoise=np.sum(~mask, axis=1)
+    noise=np.where(mask, np.nan, spectra)
+    if not mad:
+        sumsq=np.sum(np.where(mask, 0.0, spectra)**2, axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            result=np.sqrt(sumsq/nnoise)
+    else:
+        result=np.full(spectra.shape[0], np.nan)
+        if (nnoise>0).any():
+            result[nnoise>0]=_nanmad(noise[nnoise>0])
+    result[nnoise==0]=np.nan
+
+    rms[valid]=result
+    return rms
+
+def _runs(inrun, channels):
+    """
+    For a 2D boolean array returns where runs of True values start and, for
+    every channel, the (exclusive) index at which its run ends.
+    """
+    n_channels=inrun.shape[1]
+    previous=np.zeros_like(inrun)
+    previous[:,1:]=inrun[:,:-1]
+    start=inrun & ~previous
+    end=np.where(inrun, n_channels, channels)
+    end=np.minimum.accumulate(end[:,::-1], axis=1)[:,::-1]
+    return start, end
+
+def _mask_intervals(starts, ends, n_channels, pad_channels):
+    """
+    Builds a 2D mask from intervals [start-pad, end+pad) where starts is a
+    boolean array marking the first channel of each interval and ends gives
+    the corresponding (exclusive) end. starts/ends may hold several sets of
+    channels concatenated along axis 1.
+    """
+    nspec=starts.shape[0]
+    rows, cols=np.nonzero(starts)
+    lower=np.maximum(0, (cols%n_channels)-pad_channels)
+    upper=np.minimum(n_channels, ends[rows, cols]+pad_channels)
+    # difference array of interval edges
+    edges=np.zeros((nspec, n_channels+1), dtype='int64')
+    np.add.at(edges, (rows, lower), 1)
+    np.add.at(edges, (rows, upper), -1)
+    return np.cumsum(edges[:,:-1], axis=1)>0
+
+def _nanmad(data):
+    """
+    Median absolute deviation along axis 1 ignoring nans
+    """
+    median=np.nanmedian(data, axis=1)
+    return np.nanmedian(np.abs(data-median[:,None]), axis=1)
@@ -0,0 +1,1661 @@
+# Licensed under an MIT open source license - see LICENSE
+
+"""
+Columnar storage of the individual spectra and their model solutions.
+
+From stage 3 onwards indiv_dict is a ResultStore rather than a dictionary of
+individual_spectrum objects. The attributes of the spectra are held in numpy
+columns with one entry per spectrum, and those of the models in a second
+table with one entry per model. Variable-length attributes (parameters,
+guesses, lists of models) are held in ragged columns addressed by offsets, and
+the spectra either as references to the data cube or as rows of a single 2D
+block. There is therefore no longer a Python object (and its dictionary of
+attributes) per spectrum and per model.
+
+Indexing the store returns a view of a spectrum, which behaves as an
+individual_spectrum: reading an attribute gathers it from the columns and
+setting one writes it back, such that code written for a dictionary of
+individual_spectrum objects works unchanged. The models of a spectrum are
+returned as views in the same way. Models assigned to a spectrum are copied
+into the store. Pickling or copying a view produces a standalone
+individual_spectrum (or indivmodel), e.g. when spectra are sent to worker
+processes.
+
+Operations over the whole map (statistics, map making and output tables) read
+the columns directly and are vectorised.
+"""
+
+import os
+import pickle
+import weakref
+import numpy as np
+from collections.abc import MutableMapping
+
+from .model_housing import individual_spectrum, indivmodel, SpectrumReference
+
+__all__ = ('ResultStore',)
+
+# kinds of the values held in the columns
+_ABSENT=-1
+_NONE=0
+_FLOAT=1
+_INT=2
+_BOOL=3
+_OBJECT=4
+_FLIST=5
+_ILIST=6
+_FARRAY=7
+_IARRAY=8
+_BARRAY=9
+
+# how the spectrum of each row is held
+_SPECTRUM_NONE=0
+_SPECTRUM_REFERENCE=1
+_SPECTRUM_BLOCK=2
+_SPECTRUM_OBJECT=3
+
+_storefile='columns.npz'
+_objectfile='objects.pkl'
+_spectrafile='spectra.npy'
+
+class ResultStore(MutableMapping):
+    """
+    Columnar store of individual spectra and their model solutions, keyed by
+    index. Indexing returns a view of a spectrum which behaves as an
+    individual_spectrum. The rows are kept in the order in which the spectra
+    were added (see sort).
+
+    Parameters
+    ----------
+    shape : tuple, optional
+        the (y, x) shape of the map. Required for map making
+
+    Attributes
+    ----------
+    index : ndarray
+        flattened index of each spectrum
+    x, y : ndarray
+        coordinates of each spectrum. Integers unless any are fractional (e.g.
+        the centres of spectral averaging areas)
+    specrms : ndarray
+        rms of each spectrum
+    decision : ndarray
+        the decision made during stage 4
+    has_model : ndarray
+        whether or not the spectrum has a best-fitting model
+    fittype, method : ndarray
+        model type and fitting method of the best-fitting models ('' if None)
+    ncomps, rms, residstd, chisq, dof, redchisq, AIC : ndarray
+        properties of the best-fitting models (NaN if no model)
+    fitconverge : ndarray
+        whether or not the fits converged
+    parnames : list
+        the parameter names
+
+    """
+    float_columns = ('ncomps', 'rms', 'residstd', 'chisq', 'dof', 'redchisq', 'AIC')
+    string_columns = ('fittype', 'method', 'decision')
+    ragged_attributes = ('saa_dict_index', 'saaindex', 'nretries',
+                         'guesses_from_parent', 'guesses_updated')
+    model_attributes = ('model', 'model_from_parent', 'model_from_dspec',
+                        'model_from_spatial', 'model_from_manual')
+
+    def __init__(self, shape=None):
+
+        self.shape=None if shape is None else tuple(shape)
+        self._n=0
+        self._capacity=0
+        self._rowmap=np.zeros(0, dtype='int64')
+
+        # spectrum table
+        self._index=np.zeros(0, dtype='int64')
+        self._x=np.zeros(0, dtype='float64')
+        self._y=np.zeros(0, dtype='float64')
+        self._coordkind=np.zeros(0, dtype='int8')
+        self._speckind=np.zeros(0, dtype='int8')
+        self._refkey=np.zeros(0, dtype='int64')
+        self._specrow=np.zeros(0, dtype='int64')
+        self._cls=np.zeros(0, dtype='int16')
+        self._columns={'rms': _Scalar(), 'decision': _Label(), 'template': _Label(mode='object'),
+                       'source': _Label()}
+        for name in self.ragged_attributes+self.model_attributes:
+            self._columns[name]=_Ragged()
+        # attributes without a column, keyed by index
+        self._extras={}
+        self._spectra=None
+        self._nspectra=0
+        self._classes=[individual_spectrum]
+
+        # model table
+        self._nmodels=0
+        self._mcapacity=0
+        self._owner=np.zeros(0, dtype='int64')
+        self._mcls=np.zeros(0, dtype='int16')
+        self._mcolumns={name: _Scalar() for name in self.float_columns+('fitconverge',)}
+        self._mcolumns['fittype']=_Label()
+        self._mcolumns['method']=_Label()
+        self._mcolumns['parnames']=_Label(mode='list')
+        self._mcolumns['params']=_Ragged()
+        self._mcolumns['errors']=_Ragged()
+        # attributes without a column, keyed by model
+        self._mextras={}
+        self._mclasses=[indivmodel]
+
+        self._init_state()
+
+    def _init_state(self):
+        # standalone models which have been assigned to the spectra
+        self._ingested=weakref.WeakKeyDictionary()
+        self._cache={}
+        # the stage directory from which the store was loaded (or to which it
+        # was last saved) and the keys changed since
+        self._path=None
+        self._dirty=set()
+        self._deleted=set()
+
+    def __repr__(self):
+        """
+        Return a nice printable format for the object.
+        """
+        return "<< scousepy result store; nspec={0}; nmodels={1} >>".format(len(self), self._nmodels)
+
+    def __getstate__(self):
+        state=self.__dict__.copy()
+        for name in ['_ingested', '_cache', '_path', '_dirty', '_deleted']:
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_state()
+
+    @classmethod
+    def from_indiv_dict(cls, indiv_dict, shape=None):
+        """
+        Creates a store from a dictionary of individual spectra, sorted by
+        index. A store is returned as it is
+
+        Parameters
+        ----------
+        indiv_dict : dictionary
+            dictionary of individual spectra
+        shape : tuple, optional
+            the (y, x) shape of the map
+
+        """
+        if isinstance(indiv_dict, ResultStore):
+            if (indiv_dict.shape is None) and (shape is not None):
+                indiv_dict.shape=tuple(shape)
+            return indiv_dict
+        store=cls(shape)
+        for key, spectrum in indiv_dict.items():
+            store[key]=spectrum
+        store.sort()
+        store.trim()
+        return store
+
+    @classmethod
+    def from_saa_dict(cls, saa_dict, shape):
+        """
+        Creates a store from the spectral averaging areas which were fit. The
+        keys are the indices of the SAAs rather than pixel indices. The store is
+        a copy: the SAAs remain in saa_dict
+        """
+        return cls.from_indiv_dict({key: SAA for key, SAA in saa_dict.items() if SAA.to_be_fit}, shape)
+
+    @classmethod
+    def from_scouseobject(cls, scouseobject):
+        """
+        Returns the indiv_dict of a scouse object as a store
+        """
+        return cls.from_indiv_dict(scouseobject.indiv_dict, scouseobject.cube.shape[1:])
+
+    #--------------------------------------------------------------------------#
+    # dictionary interface
+    #--------------------------------------------------------------------------#
+
+    def row(self, key):
+        """
+        Returns the row of a given index
+        """
+        try:
+            index=int(key)
+        except (TypeError, ValueError):
+            raise KeyError(key)
+        if (index != key) or (index < 0) or (index >= np.size(self._rowmap)) or (self._rowmap[index] < 0):
+            raise KeyError(key)
+        return int(self._rowmap[index])
+
+    def __getitem__(self, key):
+        row=self.row(key)
+        return _SpectrumView(self, int(self._index[row]))
+
+    def __setitem__(self, key, spectrum):
+        try:
+            index=int(key)
+        except (TypeError, ValueError):
+            raise TypeError("The keys of a ResultStore are integers")
+        if (index != key) or (index < 0):
+            raise TypeError("The keys of a ResultStore are non-negative integers")
+        if isinstance(spectrum, _SpectrumView) and (spectrum._store is self) and (spectrum._key==index):
+            return
+
+        state, cls = _get_state(spectrum)
+        if index in self:
+            row=self.row(index)
+            self._clear_row(row)
+        else:
+            row=self._add_row(index)
+        self._cls[row]=self._get_class(self._classes, cls)
+        memo={}
+        for name, value in state.items():
+            self._set(row, index, name, value, memo)
+        self._touch(index)
+
+    def __delitem__(self, key):
+        row=self.row(key)
+        keep=np.ones(self._n, dtype='bool')
+        keep[row]=False
+        self._extras.pop(int(key), None)
+        self._take(np.flatnonzero(keep))
+        self._touch(int(key))
+        self._deleted.add(int(key))
+
+    def __contains__(self, key):
+        try:
+            self.row(key)
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        return iter(self._index[:self._n].tolist())
+
+    def __len__(self):
+        return self._n
+
+    @property
+    def is_sorted(self):
+        """
+        Whether the rows are ordered by index
+        """
+        return not np.any(np.diff(self.index) < 0)
+
+    def sort(self):
+        """
+        Orders the rows by index
+        """
+        self._take(np.argsort(self._index[:self._n], kind='stable'))
+
+    def trim(self):
+        """
+        Releases the room reserved for further spectra and models, e.g. once
+        the spectra of a stage have all been added
+        """
+        n=self._n
+        for name in ['_index', '_x', '_y', '_coordkind', '_speckind', '_refkey', '_specrow', '_cls']:
+            setattr(self, name, getattr(self, name)[:n].copy())
+        for column in self._columns.values():
+            column.trim(n)
+        self._capacity=n
+        if self._spectra is not None:
+            self._spectra=self._spectra[:self._nspectra].copy()
+        self._owner=self._owner[:self._nmodels].copy()
+        self._mcls=self._mcls[:self._nmodels].copy()
+        for column in self._mcolumns.values():
+            column.trim(self._nmodels)
+        self._mcapacity=self._nmodels
+
+    #--------------------------------------------------------------------------#
+    # rows
+    #--------------------------------------------------------------------------#
+
+    def _touch(self, key):
+        """
+        Records that a spectrum has changed
+        """
+        self._cache.clear()
+        if self._path is not None:
+            self._dirty.add(key)
+            self._deleted.discard(key)
+
+    def _reserve(self, n):
+        """
+        Enlarges the spectrum table to hold at least n rows
+        """
+        if n <= self._capacity:
+            return
+        capacity=max(n, 2*self._capacity, 16)
+        for name, fill in [('_index', -1), ('_x', np.nan), ('_y', np.nan),
+                           ('_coordkind', _ABSENT), ('_speckind', _SPECTRUM_NONE),
+                           ('_refkey', -1), ('_specrow', -1), ('_cls', 0)]:
+            setattr(self, name, _grow(getattr(self, name), capacity, fill))
+        for column in self._columns.values():
+            column.reserve(capacity)
+        self._capacity=capacity
+
+    def _add_row(self, index):
+        self._reserve(self._n+1)
+        if index >= np.size(self._rowmap):
+            self._rowmap=_grow(self._rowmap, max(index+1, 2*np.size(self._rowmap)), -1)
+        row=self._n
+        self._n+=1
+        self._index[row]=index
+        self._rowmap[index]=row
+        return row
+
+    def _clear_row(self, row):
+        self._coordkind[row]=_ABSENT
+        self._speckind[row]=_SPECTRUM_NONE
+        for column in self._columns.values():
+            column.clear(row)
+        self._extras.pop(int(self._index[row]), None)
+
+    def _take(self, rows):
+        """
+        Keeps the given rows of the spectrum table, in the given order
+        """
+        rows=np.asarray(rows, dtype='int64')
+        n=np.size(rows)
+        for name in ['_index', '_x', '_y', '_coordkind', '_speckind', '_refkey', '_specrow', '_cls']:
+            column=getattr(self, name)
+            column[:n]=column[rows]
+        for column in self._columns.values():
+            column.take(rows)
+        self._rowmap[:]=-1
+        self._rowmap[self._index[:n]]=np.arange(n)
+        self._n=n
+        self._cache.clear()
+
+    def _row_key(self, key):
+        """
+        The row of a spectrum held by a view
+        """
+        row=self._rowmap[key] if key < np.size(self._rowmap) else -1
+        if row < 0:
+            raise KeyError("Spectrum {0} is no longer in the store".format(key))
+        return int(row)
+
+    def _set(self, row, key, name, value, memo):
+        """
+        Sets an attribute of a spectrum
+        """
+        if name=='index':
+            if (value is not None) and (value==key):
+                self._extras.get(key, {}).pop('index', None)
+            else:
+                self._extras.setdefault(key, {})['index']=value
+        elif name=='coordinates':
+            self._set_coordinates(row, key, value)
+        elif name=='spectrum':
+            self._set_spectrum(row, key, value)
+        elif name=='_spectrum':
+            if (value is None) and (self._speckind[row]==_SPECTRUM_REFERENCE):
+                return
+            self._set_spectrum(row, key, value)
+        elif name=='reference':
+            if value is None:
+                if self._speckind[row]==_SPECTRUM_REFERENCE:
+                    self._speckind[row]=_SPECTRUM_NONE
+            else:
+                self._set_spectrum(row, key, value)
+        elif name in self.model_attributes:
+            self._columns[name].set(row, self._get_model_ids(value, key, memo))
+        elif name in self._columns and name!='source':
+            self._columns[name].set(row, value)
+        else:
+            self._extras.setdefault(key, {})[name]=value
+
+    def _set_coordinates(self, row, key, value):
+        if value is None:
+            self._coordkind[row]=_NONE
+        elif (type(value) is np.ndarray) and (value.shape==(2,)) and (value.dtype.kind in 'iuf'):
+            self._x[row], self._y[row] = value
+            self._coordkind[row]=_INT if value.dtype.kind in 'iu' else _FLOAT
+        else:
+            self._coordkind[row]=_OBJECT
+            self._extras.setdefault(key, {})['coordinates']=value
+            return
+        if key in self._extras:
+            self._extras[key].pop('coordinates', None)
+
+    def _set_spectrum(self, row, key, spectrum):
+        if key in self._extras:
+            self._extras[key].pop('_spectrum', None)
+        if spectrum is None:
+            self._speckind[row]=_SPECTRUM_NONE
+        elif isinstance(spectrum, SpectrumReference):
+            self._speckind[row]=_SPECTRUM_REFERENCE
+            self._columns['source'].set(row, spectrum.source)
+            self._refkey[row]=spectrum.key
+        elif self._fits_block(spectrum):
+            if self._specrow[row] < 0:
+                self._specrow[row]=self._add_block_row()
+            self._spectra[self._specrow[row]]=spectrum
+            self._speckind[row]=_SPECTRUM_BLOCK
+        else:
+            self._speckind[row]=_SPECTRUM_OBJECT
+            self._extras.setdefault(key, {})['_spectrum']=spectrum
+
+    def _fits_block(self, spectrum):
+        """
+        Whether a spectrum can be held in the block of spectra, creating the
+        block for the first spectrum
+        """
+        if (type(spectrum) is not np.ndarray) or (spectrum.ndim!=1) or (spectrum.dtype.kind not in 'iuf'):
+            return False
+        if self._spectra is None:
+            self._spectra=np.zeros((0, np.size(spectrum)), dtype=spectrum.dtype)
+        return (spectrum.dtype==self._spectra.dtype) and (np.size(spectrum)==self._spectra.shape[1])
+
+    def _add_block_row(self):
+        if self._nspectra >= self._spectra.shape[0]:
+            self._spectra=_grow(self._spectra, max(16, 2*self._spectra.shape[0]), 0)
+        self._nspectra+=1
+        return self._nspectra-1
+
+    def _get_spectrum(self, row, key, copy=False):
+        kind=self._speckind[row]
+        if kind==_SPECTRUM_REFERENCE:
+            return None
+        if kind==_SPECTRUM_BLOCK:
+            spectrum=self._spectra[self._specrow[row]]
+            return spectrum.copy() if copy else spectrum
+        if kind==_SPECTRUM_OBJECT:
+            return self._extras[key]['_spectrum']
+        return None
+
+    def _get_reference(self, row):
+        if self._speckind[row]!=_SPECTRUM_REFERENCE:
+            return None
+        return SpectrumReference(self._columns['source'].get(row), self._refkey[row])
+
+    def _get(self, key, name, model=None):
+        """
+        Gets an attribute of a spectrum. Models are returned as views, or
+        converted with the function model
+        """
+        row=self._row_key(key)
+        extras=self._extras.get(key)
+        if name=='index':
+            if (extras is not None) and ('index' in extras):
+                return extras['index']
+            return key
+        if name=='coordinates':
+            kind=self._coordkind[row]
+            if kind==_ABSENT:
+                raise AttributeError(name)
+            if kind==_NONE:
+                return None
+            if kind==_OBJECT:
+                return extras['coordinates']
+            coordinates=np.array([self._x[row], self._y[row]])
+            return coordinates.astype('int64') if kind==_INT else coordinates
+        if name=='spectrum':
+            if self._speckind[row]==_SPECTRUM_REFERENCE:
+                return self._get_reference(row).get()
+            return self._get_spectrum(row, key)
+        if name=='_spectrum':
+            return self._get_spectrum(row, key)
+        if name=='reference':
+            return self._get_reference(row)
+        if name in self.model_attributes:
+            return self._get_models(row, key, name, model)
+        if (name in self._columns) and (name!='source'):
+            return self._columns[name].get(row)
+        if (extras is not None) and (name in extras):
+            return extras[name]
+        raise AttributeError(name)
+
+    def _set_attribute(self, key, name, value):
+        """
+        Sets an attribute of a spectrum through a view
+        """
+        row=self._row_key(key)
+        if (value is None) and (name in self._columns) and (self._columns[name].is_none(row)):
+            # e.g. clearing the guesses of every spectrum before a refit
+            return
+        memo={}
+        self._set(row, key, name, value, memo)
+        self._register(memo, value)
+        self._touch(key)
+
+    def _get_state(self, key, model=None):
+        """
+        Returns the attributes of a spectrum
+        """
+        state={}
+        for name in ('index', 'coordinates', '_spectrum', 'reference')+tuple(self._columns):
+            if name=='source':
+                continue
+            try:
+                state[name]=self._get(key, name, model)
+            except AttributeError:
+                pass
+        for name, value in self._extras.get(key, {}).items():
+            if name not in state:
+                state[name]=value
+        if self._speckind[self._row_key(key)]==_SPECTRUM_BLOCK:
+            state['_spectrum']=state['_spectrum'].copy()
+        return state
+
+    def detach(self, key):
+        """
+        Returns a standalone copy of a spectrum (and its models), independent
+        of the store
+        """
+        memo={}
+        state=self._get_state(key, model=lambda mid: self._detach_model(mid, memo))
+        cls=self._classes[self._cls[self._row_key(key)]]
+        spectrum=cls.__new__(cls)
+        spectrum.__dict__.update(state)
+        return spectrum
+
+    #--------------------------------------------------------------------------#
+    # models
+    #--------------------------------------------------------------------------#
+
+    def _reserve_models(self, n):
+        if n <= self._mcapacity:
+            return
+        capacity=max(n, 2*self._mcapacity, 16)
+        self._owner=_grow(self._owner, capacity, -1)
+        self._mcls=_grow(self._mcls, capacity, 0)
+        for column in self._mcolumns.values():
+            column.reserve(capacity)
+        self._mcapacity=capacity
+
+    def _add_model(self, model, owner, memo):
+        """
+        Copies a model into the model table
+        """
+        state, cls = _get_state(model)
+        self._reserve_models(self._nmodels+1)
+        mid=self._nmodels
+        self._nmodels+=1
+        self._owner[mid]=owner
+        self._mcls[mid]=self._get_class(self._mclasses, cls)
+        memo[_memo_key(model)]=mid
+        for name, value in state.items():
+            self._set_model(mid, name, value)
+        return mid
+
+    def _set_model(self, mid, name, value):
+        if name in self._mcolumns:
+            self._mcolumns[name].set(mid, value)
+        else:
+            self._mextras.setdefault(mid, {})[name]=value
+
+    def _get_model(self, mid, name):
+        if name in self._mcolumns:
+            return self._mcolumns[name].get(mid)
+        extras=self._mextras.get(mid)
+        if (extras is not None) and (name in extras):
+            return extras[name]
+        raise AttributeError(name)
+
+    def _set_model_attribute(self, mid, name, value):
+        """
+        Sets an attribute of a model through a view
+        """
+        self._set_model(mid, name, value)
+        self._touch(int(self._owner[mid]))
+
+    def _get_model_state(self, mid):
+        state={}
+        for name in self._mcolumns:
+            try:
+                state[name]=self._get_model(mid, name)
+            except AttributeError:
+                pass
+        state.update(self._mextras.get(mid, {}))
+        return state
+
+    def _detach_model(self, mid, memo):
+        if mid not in memo:
+            cls=self._mclasses[self._mcls[mid]]
+            model=cls.__new__(cls)
+            model.__dict__.update(self._get_model_state(mid))
+            memo[mid]=model
+        return memo[mid]
+
+    def _get_model_id(self, model, owner, memo):
+        """
+        Returns the id of a model in the model table, copying it in if
+        necessary. -1 for None
+        """
+        if model is None:
+            return -1
+        if isinstance(model, _ModelView) and (model._store is self):
+            return model._mid
+        if _memo_key(model) in memo:
+            return memo[_memo_key(model)]
+        try:
+            if model in self._ingested:
+                return self._ingested[model]
+        except TypeError:
+            pass
+        return self._add_model(model, owner, memo)
+
+    def _get_model_ids(self, value, owner, memo):
+        """
+        Converts a model, or a list of models, to model ids
+        """
+        if isinstance(value, (list, tuple, _ModelList)):
+            return [self._get_model_id(model, owner, memo) for model in value]
+        return self._get_model_id(value, owner, memo)
+
+    def _register(self, memo, value):
+        """
+        Records the standalone models assigned through a view, such that
+        assigning them again (e.g. to model and model_from_spatial) refers to
+        the same model
+        """
+        models=value if isinstance(value, (list, tuple)) else [value]
+        for model in models:
+            if (model is not None) and (id(model) in memo) and not isinstance(model, _ModelView):
+                try:
+                    self._ingested[model]=memo[id(model)]
+                except TypeError:
+                    pass
+
+    def _get_models(self, row, key, name, model=None):
+        column=self._columns[name]
+        kind=column.kind[row]
+        if kind==_ABSENT:
+            raise AttributeError(name)
+        value=column.get(row)
+        if kind==_ILIST:
+            if model is None:
+                return _ModelList(self, key, name)
+            return [None if mid < 0 else model(mid) for mid in value]
+        if kind==_INT:
+            if value < 0:
+                return None
+            return _ModelView(self, value) if model is None else model(value)
+        return value
+
+    def _append_model(self, key, name, value):
+        """
+        Appends a model to a list of models of a spectrum
+        """
+        row=self._row_key(key)
+        memo={}
+        mids=self._columns[name].get(row)+[self._get_model_id(value, key, memo)]
+        self._columns[name].set(row, mids)
+        self._register(memo, value)
+        self._touch(key)
+
+    def _set_model_list(self, key, name, mids):
+        self._columns[name].set(self._row_key(key), list(mids))
+        self._touch(key)
+
+    #--------------------------------------------------------------------------#
+    # columns
+    #--------------------------------------------------------------------------#
+
+    def _get_class(self, classes, cls):
+        if cls not in classes:
+            classes.append(cls)
+        return classes.index(cls)
+
+    def _cached(self, name, function):
+        if name not in self._cache:
+            self._cache[name]=function()
+        return self._cache[name]
+
+    @property
+    def _best(self):
+        """
+        The id of the best-fitting model of each row (-1 if None)
+        """
+        def best():
+            column=self._columns['model']
+            kind=column.kind[:self._n]
+            values=column.values(np.arange(self._n))
+            return np.where(kind==_INT, values, -1).astype('int64')
+        return self._cached('best', best)
+
+    def _gather(self, name):
+        """
+        A column of the best-fitting models, NaN where there is no model
+        """
+        def gather():
+            best=self._best
+            has=best >= 0
+            values=np.full(self._n, np.nan)
+            values[has]=self._mcolumns[name].values(best[has])
+            return values
+        return self._cached(name, gather)
+
+    def _gather_labels(self, column, ids):
+        labels=np.full(np.size(ids), '', dtype=object)
+        valid=ids >= 0
+        labels[valid]=column.labels(ids[valid])
+        return labels.astype('str')
+
+    @property
+    def index(self):
+        return self._index[:self._n]
+
+    @property
+    def x(self):
+        return self._cached('x', lambda: _to_coordinates(self._x[:self._n]))
+
+    @property
+    def y(self):
+        return self._cached('y', lambda: _to_coordinates(self._y[:self._n]))
+
+    @property
+    def specrms(self):
+        return self._cached('specrms', lambda: self._columns['rms'].values(np.arange(self._n)))
+
+    @property
+    def decision(self):
+        return self._cached('decision', lambda: self._gather_labels(self._columns['decision'], np.arange(self._n)))
+
+    @property
+    def has_model(self):
+        return self._best >= 0
+
+    @property
+    def fittype(self):
+        return self._cached('fittype', lambda: self._gather_labels(self._mcolumns['fittype'], self._best))
+
+    @property
+    def method(self):
+        return self._cached('method', lambda: self._gather_labels(self._mcolumns['method'], self._best))
+
+    ncomps=property(lambda self: self._gather('ncomps'))
+    rms=property(lambda self: self._gather('rms'))
+    residstd=property(lambda self: self._gather('residstd'))
+    chisq=property(lambda self: self._gather('chisq'))
+    dof=property(lambda self: self._gather('dof'))
+    redchisq=property(lambda self: self._gather('redchisq'))
+    AIC=property(lambda self: self._gather('AIC'))
+
+    @property
+    def fitconverge(self):
+        return np.nan_to_num(self._gather('fitconverge'))!=0
+
+    @property
+    def parnames(self):
+        """
+        The parameter names of the first best-fitting model which has them
+        """
+        def parnames():
+            column=self._mcolumns['parnames']
+            best=self._best[self._best >= 0]
+            codes=column.codes[best]
+            codes=codes[codes >= 0]
+            return None if np.size(codes)==0 else list(column.table[codes[0]])
+        return self._cached('parnames', parnames)
+
+    @property
+    def nparams(self):
+        """
+        Number of parameters per component
+        """
+        return 1 if self.parnames is None else len(self.parnames)
+
+    @property
+    def fitted(self):
+        """
+        Mask of the spectra with a best-fitting model containing at least one
+        component
+        """
+        return self.has_model & (self.ncomps != 0.0)
+
+    def get_parameters(self, rows, name='params'):
+        """
+        Returns the parameters (or errors) of the best-fitting models of the
+        given rows
+
+        Parameters
+        ----------
+        rows : ndarray
+            rows with a best-fitting model
+        name : string
+            'params' or 'errors'
+
+        Returns
+        -------
+        offsets : ndarray
+            the values of rows[i] are located at values[offsets[i]:offsets[i+1]]
+        values : ndarray
+            the concatenated values
+
+        """
+        column=self._mcolumns[name]
+        best=self._best[np.asarray(rows, dtype='int64')]
+        lengths=np.where((best >= 0) & np.isin(column.kind[best], (_FLIST, _ILIST, _FARRAY, _IARRAY)),
+                         column.length[best], 0)
+        offsets=np.zeros(np.size(best)+1, dtype='int64')
+        np.cumsum(lengths, out=offsets[1:])
+        return offsets, column.data[_ragged_elements(column.start[best], lengths)]
+
+    def get_map(self, name, fill_value=np.nan, mask=None):
+        """
+        Returns a 2D map of a given column
+
+        Parameters
+        ----------
+        name : string
+            name of the column, e.g. 'rms', 'residstd', 'ncomps', 'AIC'
+        fill_value : number
+            value of pixels without a model
+        mask : ndarray, optional
+            only include the rows within this mask. Default is all rows with a
+            model
+
+        """
+        column=np.asarray(getattr(self, name), dtype='float64')
+        if mask is None:
+            mask=self.has_model
+        _map=np.full(self.shape, fill_value, dtype='float64')
+        _map[self.y[mask], self.x[mask]]=column[mask]
+        return _map
+
+    def get_components(self, mask=None, include_empty=False, rows=None):
+        """
+        Returns the parameters and errors of each component
+
+        Parameters
+        ----------
+        mask : ndarray, optional
+            only include the rows within this mask. Default is all rows with a
+            model
+        include_empty : bool
+            if True, models with zero components contribute a single row
+            containing their first set of parameters (as in the output tables)
+        rows : ndarray, optional
+            the (sorted) rows to include, as an alternative to mask
+
+        Returns
+        -------
+        rows : ndarray
+            the row of the store to which each component belongs
+        params : ndarray
+            the parameters, shape (ncomponents, nparams)
+        errors : ndarray
+            the uncertainties, shape (ncomponents, nparams)
+
+        """
+        nparams=self.nparams
+        if rows is not None:
+            ids=np.asarray(rows, dtype='int64')
+        else:
+            if mask is None:
+                mask=self.has_model
+            ids=np.flatnonzero(mask)
+
+        ncomps=np.nan_to_num(self.ncomps[ids]).astype('int64')
+        if include_empty:
+            ncomps=np.maximum(ncomps, 1)
+        rows=np.repeat(ids, ncomps)
+        component=np.arange(np.size(rows))-np.repeat(np.cumsum(ncomps)-ncomps, ncomps)
+
+        values=[]
+        for name in ['params', 'errors']:
+            offsets, data = self.get_parameters(ids, name=name)
+            # location of each parameter in the ragged arrays
+            start=np.repeat(offsets[:-1], ncomps)+component*nparams
+            elements=start[:,np.newaxis]+np.arange(nparams)[np.newaxis,:]
+            inside=elements < np.repeat(offsets[1:], ncomps)[:,np.newaxis]
+            elements=np.where(inside, elements, 0)
+            values.append(np.where(inside, data[elements] if np.size(data)!=0 else np.nan, np.nan))
+
+        return rows, values[0], values[1]
+
+    def get_component_cubes(self, sortby=None, descending=False, mask=None):
+        """
+        Returns the parameters and errors of the components as cubes, with
+        one plane per component
+
+        Parameters
+        ----------
+        sortby : string or int, optional
+            name (or position) of the parameter by which the components of
+            each spectrum are ordered, e.g. 'shift' or 'amplitude'. Default
+            is the order of the fit
+        descending : bool
+            order the components in descending order of sortby
+        mask : ndarray, optional
+            only include the rows within this mask. Default is all rows with a
+            model
+
+        Returns
+        -------
+        params : ndarray
+            the parameters, shape (nparams, ncomp_max, ny, nx). NaN where a
+            spectrum has fewer components
+        errors : ndarray
+            the uncertainties, shape (nparams, ncomp_max, ny, nx)
+
+        """
+        rows, params, errors = self.get_components(mask=mask)
+        parnames=self.parnames
+
+        if sortby is not None:
+            if isinstance(sortby, str):
+                if (parnames is None) or (sortby not in parnames):
+                    raise ValueError("Unknown parameter: {0}".format(sortby))
+                sortby=parnames.index(sortby)
+            key=params[:,sortby]
+            if descending:
+                key=-key
+            # rows are sorted, components are ordered within each row. The
+            # rank of each key is combined with its row into a single integer
+            # key, which sorts considerably faster than np.lexsort
+            rank=np.empty(np.size(key), dtype='int64')
+            rank[np.argsort(key, kind='stable')]=np.arange(np.size(key))
+            order=np.argsort(rows*np.size(key)+rank)
+            rows, params, errors = rows[order], params[order], errors[order]
+
+        # position of each component within its spectrum
+        unique, starts, counts = np.unique(rows, return_index=True, return_counts=True)
+        component=np.arange(np.size(rows))-np.repeat(starts, counts)
+        ncomp_max=int(np.max(counts)) if np.size(counts)!=0 else 0
+
+        shape=(self.nparams, ncomp_max)+self.shape
+        paramcube=np.full(shape, np.nan)
+        errorcube=np.full(shape, np.nan)
+        # flattened position within each plane
+        position=component*(self.shape[0]*self.shape[1])+self.y[rows]*self.shape[1]+self.x[rows]
+        for j in range(self.nparams):
+            paramcube[j].reshape(-1)[position]=params[:,j]
+            errorcube[j].reshape(-1)[position]=errors[:,j]
+
+        return paramcube, errorcube
+
+    #--------------------------------------------------------------------------#
+    # persistence
+    #--------------------------------------------------------------------------#
+
+    def write(self, path):
+        """
+        Writes the store to a directory. Models which are no longer referenced
+        by any spectrum are dropped
+
+        Parameters
+        ----------
+        path : string
+            output directory
+
+        """
+        os.makedirs(path)
+        n=self._n
+        rows=np.arange(n)
+        columns={'index': self._index[:n], 'x': self._x[:n], 'y': self._y[:n],
+                 'coordkind': self._coordkind[:n], 'speckind': self._speckind[:n],
+                 'refkey': self._refkey[:n], 'cls': self._cls[:n]}
+        objects={}
+
+        # the models referenced by the spectra, renumbered
+        referenced=[]
+        for name in self.model_attributes:
+            column=self._columns[name]
+            length, kind, data = column.compact(rows)
+            referenced.append(data[np.repeat(np.isin(kind, (_INT, _ILIST)), length)])
+        referenced=np.concatenate(referenced).astype('int64')
+        keep=np.unique(referenced[referenced >= 0])
+        renumber=np.full(self._nmodels+1, -1, dtype='int64')
+        renumber[keep]=np.arange(np.size(keep))
+
+        for name, column in self._columns.items():
+            state=column.get_columns(rows)
+            if name in self.model_attributes:
+                ids=np.repeat(np.isin(state['kind'], (_INT, _ILIST)), state['length'])
+                state['data'][ids]=renumber[state['data'][ids].astype('int64')]
+            objects[name]=state.pop('objects')
+            for field, value in state.items():
+                columns['s_'+name+'_'+field]=value
+
+        columns['owner']=self._owner[keep]
+        columns['mcls']=self._mcls[keep]
+        for name, column in self._mcolumns.items():
+            state=column.get_columns(keep)
+            objects['m_'+name]=state.pop('objects')
+            for field, value in state.items():
+                columns['m_'+name+'_'+field]=value
+
+        # the spectra held in the block, in order of row
+        block=np.flatnonzero(self._speckind[:n]==_SPECTRUM_BLOCK)
+        specrow=np.full(n, -1, dtype='int64')
+        specrow[block]=np.arange(np.size(block))
+        columns['specrow']=specrow
+        if self._spectra is not None:
+            np.save(os.path.join(path, _spectrafile), self._spectra[self._specrow[block]])
+
+        np.savez(os.path.join(path, _storefile), **columns)
+        with open(os.path.join(path, _objectfile), 'wb') as fh:
+            pickle.dump({'shape': self.shape, 'extras': self._extras,
+                         'mextras': {int(renumber[mid]): extras for mid, extras in self._mextras.items()
+                                     if renumber[mid] >= 0},
+                         'classes': self._classes, 'mclasses': self._mclasses,
+                         'objects': objects}, fh, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def read(cls, path, journal=None):
+        """
+        Reads a store written by write
+
+        Parameters
+        ----------
+        path : string
+            the directory written by write
+        journal : dictionary, optional
+            pickled spectra which supersede those on disk, keyed by index (None
+            for deleted spectra). See chunked.load_stage
+
+        """
+        with open(os.path.join(path, _objectfile), 'rb') as fh:
+            header=pickle.load(fh)
+        store=cls(header['shape'])
+        with np.load(os.path.join(path, _storefile)) as npz:
+            columns={name: npz[name] for name in npz.files}
+
+        n=np.size(columns['index'])
+        store._reserve(n)
+        store._n=n
+        for name in ['index', 'x', 'y', 'coordkind', 'speckind', 'refkey', 'specrow', 'cls']:
+            getattr(store, '_'+name)[:n]=columns[name]
+        for name, column in store._columns.items():
+            column.set_columns(_get_fields(columns, 's_'+name+'_'), header['objects'][name], n)
+        if n!=0:
+            store._rowmap=np.full(int(np.max(store._index[:n]))+1, -1, dtype='int64')
+            store._rowmap[store._index[:n]]=np.arange(n)
+
+        nmodels=np.size(columns['owner'])
+        store._reserve_models(nmodels)
+        store._nmodels=nmodels
+        store._owner[:nmodels]=columns['owner']
+        store._mcls[:nmodels]=columns['mcls']
+        for name, column in store._mcolumns.items():
+            column.set_columns(_get_fields(columns, 'm_'+name+'_'), header['objects']['m_'+name], nmodels)
+
+        if os.path.exists(os.path.join(path, _spectrafile)):
+            store._spectra=np.load(os.path.join(path, _spectrafile))
+            store._nspectra=store._spectra.shape[0]
+
+        store._extras=header['extras']
+        store._mextras=header['mextras']
+        store._classes=header['classes']
+        store._mclasses=header['mclasses']
+
+        if journal is not None:
+            for key, data in journal.items():
+                if data is None:
+                    if key in store:
+                        del store[key]
+                else:
+                    store[key]=pickle.loads(data)
+        store._path=os.path.normpath(path)
+        return store
+
+    def get_changes(self):
+        """
+        Returns the spectra which have changed since the store was loaded or
+        last saved
+
+        Returns
+        -------
+        updated : dictionary
+            the pickled standalone copies of the new and modified spectra
+        deleted : list
+            the deleted keys
+
+        """
+        updated={key: pickle.dumps(self.detach(key), protocol=pickle.HIGHEST_PROTOCOL)
+                 for key in sorted(self._dirty) if key in self}
+        deleted=[key for key in self._deleted if key not in self]
+        return updated, deleted
+
+    def _mark_saved(self, path=None):
+        """
+        Records that the store has been saved (to path, if given)
+        """
+        if path is not None:
+            self._path=os.path.normpath(path)
+        self._dirty=set()
+        self._deleted=set()
+
+def _get_state(obj):
+    """
+    Returns the attributes and the class of a spectrum or model
+    """
+    if isinstance(obj, _SpectrumView):
+        return obj._store._get_state(obj._key), individual_spectrum
+    if isinstance(obj, _ModelView):
+        return obj._store._get_model_state(obj._mid), indivmodel
+    if hasattr(obj, '__dict__'):
+        return dict(obj.__dict__), type(obj)
+    # e.g. the compact models of SharedModels
+    state={name: getattr(obj, name) for name in getattr(type(obj), '__slots__', ())
+           if hasattr(obj, name)}
+    return state, indivmodel
+
+def _reduce(obj):
+    """
+    Views are pickled and copied as the standalone objects they stand for
+    """
+    return (_restore, (type(obj), obj.__dict__))
+
+def _restore(cls, state):
+    obj=cls.__new__(cls)
+    obj.__dict__.update(state)
+    return obj
+
+def _memo_key(model):
+    """
+    Identifies a model while it is copied into a store
+    """
+    if isinstance(model, _ModelView):
+        return (id(model._store), model._mid)
+    return id(model)
+
+def _get_fields(columns, prefix):
+    return {name[len(prefix):]: value for name, value in columns.items() if name.startswith(prefix)}
+
+def _grow(array, capacity, fill):
+    """
+    Returns a copy of an array enlarged along its first axis
+    """
+    new=np.full((capacity,)+array.shape[1:], fill, dtype=array.dtype)
+    new[:array.shape[0]]=array
+    return new
+
+def _ragged_elements(starts, lengths):
+    """
+    Returns the positions of the elements of the ragged rows defined by starts
+    and lengths
+    """
+    total=int(np.sum(lengths))
+    if total==0:
+        return np.zeros(0, dtype='int64')
+    ends=np.cumsum(lengths)
+    return np.arange(total)-np.repeat(ends-lengths, lengths)+np.repeat(starts, lengths)
+
+def _to_coordinates(values):
+    values=np.asarray(values, dtype='float64')
+    if np.all(values==np.round(values)):
+        return values.astype('int64')
+    return values
+
+def _encode(value):
+    """
+    Returns the kind of a value and its numbers, if it can be held as numbers
+    """
+    if value is None:
+        return _NONE, None
+    cls=type(value)
+    if (cls is float) or (cls is np.float64):
+        return _FLOAT, (value,)
+    if cls is int:
+        return _INT, (value,)
+    if isinstance(value, (bool, np.bool_)):
+        return _BOOL, [float(value)]
+    if isinstance(value, (int, np.integer)):
+        return _INT, [float(value)]
+    if isinstance(value, (float, np.floating)):
+        return _FLOAT, [float(value)]
+    if cls is list:
+        if all((type(v) is int) or isinstance(v, np.integer) for v in value):
+            return _ILIST, value
+        if all(isinstance(v, (int, float, np.integer, np.floating)) and not isinstance(v, (bool, np.bool_)) for v in value):
+            return _FLIST, value
+    elif (cls is np.ndarray) and (value.ndim==1):
+        if value.dtype==np.float64:
+            return _FARRAY, value
+        if value.dtype==np.int64:
+            return _IARRAY, value
+        if value.dtype==np.bool_:
+            return _BARRAY, value
+    return _OBJECT, None
+
+def _decode(kind, values):
+    if kind==_FLOAT:
+        return np.float64(values[0])
+    if kind==_INT:
+        return int(values[0])
+    if kind==_BOOL:
+        return bool(values[0])
+    if kind==_FLIST:
+        return values.tolist()
+    if kind==_ILIST:
+        return values.astype('int64').tolist()
+    if kind==_FARRAY:
+        return values.copy()
+    if kind==_IARRAY:
+        return values.astype('int64')
+    if kind==_BARRAY:
+        return values.astype('bool')
+    return None
+
+class _Scalar(object):
+    """
+    A column of numbers (or None). Other values are held as objects
+    """
+    def __init__(self):
+        self.value=np.zeros(0, dtype='float64')
+        self.kind=np.zeros(0, dtype='int8')
+        self.objects={}
+
+    def reserve(self, capacity):
+        self.value=_grow(self.value, capacity, np.nan)
+        self.kind=_grow(self.kind, capacity, _ABSENT)
+
+    def clear(self, row):
+        self.kind[row]=_ABSENT
+        self.objects.pop(row, None)
+
+    def is_none(self, row):
+        return self.kind[row]==_NONE
+
+    def set(self, row, value):
+        kind, values = _encode(value)
+        self.objects.pop(row, None)
+        if kind in (_NONE, _FLOAT, _INT, _BOOL):
+            self.value[row]=np.nan if values is None else values[0]
+        else:
+            kind=_OBJECT
+            self.value[row]=np.nan
+            self.objects[row]=value
+        self.kind[row]=kind
+
+    def get(self, row):
+        kind=self.kind[row]
+        if kind==_ABSENT:
+            raise AttributeError
+        if kind==_OBJECT:
+            return self.objects[row]
+        if kind==_NONE:
+            return None
+        return _decode(kind, self.value[row:row+1])
+
+    def values(self, rows):
+        return self.value[rows]
+
+    def trim(self, n):
+        self.value=self.value[:n].copy()
+        self.kind=self.kind[:n].copy()
+
+    def take(self, rows):
+        n=np.size(rows)
+        self.value[:n]=self.value[rows]
+        self.kind[:n]=self.kind[rows]
+        self.objects=_remap(self.objects, rows)
+
+    def get_columns(self, rows):
+        return {'value': self.value[rows], 'kind': self.kind[rows],
+                'objects': _remap(self.objects, rows)}
+
+    def set_columns(self, fields, objects, n):
+        self.value[:n]=fields['value']
+        self.kind[:n]=fields['kind']
+        self.objects=objects
+
+class _Label(object):
+    """
+    A column of strings (mode 'str'), lists of strings ('list') or shared
+    objects ('object'), held as codes into a table of the unique values. Other
+    values are held as objects
+    """
+    def __init__(self, mode='str'):
+        self.mode=mode
+        self.codes=np.zeros(0, dtype='int32')
+        self.table=[]
+        self.lookup={}
+        self.objects={}
+
+    def reserve(self, capacity):
+        self.codes=_grow(self.codes, capacity, -2)
+
+    def clear(self, row):
+        self.codes[row]=-2
+        self.objects.pop(row, None)
+
+    def is_none(self, row):
+        return self.codes[row]==-1
+
+    def _key(self, value):
+        if self.mode=='object':
+            return id(value)
+        if self.mode=='list':
+            if (type(value) is list) and all(isinstance(v, str) for v in value):
+                return tuple(value)
+            return None
+        return value if isinstance(value, str) else None
+
+    def set(self, row, value):
+        self.objects.pop(row, None)
+        if value is None:
+            self.codes[row]=-1
+            return
+        key=self._key(value)
+        if key is None:
+            self.codes[row]=-3
+            self.objects[row]=value
+            return
+        if key not in self.lookup:
+            self.lookup[key]=len(self.table)
+            self.table.append(value if self.mode=='object' else key)
+        self.codes[row]=self.lookup[key]
+
+    def get(self, row):
+        code=self.codes[row]
+        if code==-2:
+            raise AttributeError
+        if code==-1:
+            return None
+        if code==-3:
+            return self.objects[row]
+        value=self.table[code]
+        return list(value) if self.mode=='list' else value
+
+    def labels(self, rows):
+        """
+        The values of the given rows as strings ('' for None)
+        """
+        table=np.array([str(value) for value in self.table]+['', ''], dtype=object)
+        codes=self.codes[rows]
+        labels=table[np.where(codes >= 0, codes, len(self.table))]
+        for i in np.flatnonzero(codes==-3):
+            labels[i]=str(self.objects[int(rows[i])])
+        return labels
+
+    def trim(self, n):
+        self.codes=self.codes[:n].copy()
+
+    def take(self, rows):
+        n=np.size(rows)
+        self.codes[:n]=self.codes[rows]
+        self.objects=_remap(self.objects, rows)
+
+    def get_columns(self, rows):
+        return {'codes': self.codes[rows], 'objects': (self.table, _remap(self.objects, rows))}
+
+    def set_columns(self, fields, objects, n):
+        self.codes[:n]=fields['codes']
+        self.table, self.objects = objects
+        if self.mode=='object':
+            self.lookup={id(value): code for code, value in enumerate(self.table)}
+        else:
+            self.lookup={value: code for code, value in enumerate(self.table)}
+
+    def __getstate__(self):
+        state=self.__dict__.copy()
+        del state['lookup']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.set_columns({'codes': self.codes}, (self.table, self.objects), np.size(self.codes))
+
+class _Ragged(object):
+    """
+    A column of variable-length values (None, numbers, lists or arrays of
+    numbers) held in a single buffer. Other values are held as objects
+    """
+    def __init__(self):
+        self.start=np.zeros(0, dtype='int64')
+        self.length=np.zeros(0, dtype='int64')
+        self.kind=np.zeros(0, dtype='int8')
+        self.data=np.zeros(0, dtype='float64')
+        self.size=0
+        self.objects={}
+
+    def reserve(self, capacity):
+        self.start=_grow(self.start, capacity, 0)
+        self.length=_grow(self.length, capacity, 0)
+        self.kind=_grow(self.kind, capacity, _ABSENT)
+
+    def clear(self, row):
+        self.kind[row]=_ABSENT
+        self.length[row]=0
+        self.objects.pop(row, None)
+
+    def is_none(self, row):
+        return self.kind[row]==_NONE
+
+    def set(self, row, value):
+        kind, values = _encode(value)
+        self.objects.pop(row, None)
+        if kind==_OBJECT:
+            self.objects[row]=value
+        n=0 if values is None else len(values)
+        if n > self.length[row]:
+            # the previous values are abandoned until the column is compacted
+            if self.size+n > np.size(self.data):
+                self.data=_grow(self.data, max(self.size+n, 2*np.size(self.data), 64), np.nan)
+            self.start[row]=self.size
+            self.size+=n
+        if n!=0:
+            self.data[self.start[row]:self.start[row]+n]=values
+        self.length[row]=n
+        self.kind[row]=kind
+
+    def get(self, row):
+        kind=self.kind[row]
+        if kind==_ABSENT:
+            raise AttributeError
+        if kind==_OBJECT:
+            return self.objects[row]
+        if kind==_NONE:
+            return None
+        return _decode(kind, self.data[self.start[row]:self.start[row]+self.length[row]])
+
+    def values(self, rows):
+        """
+        The first number of each row (NaN if empty)
+        """
+        rows=np.asarray(rows, dtype='int64')
+        values=np.full(np.size(rows), np.nan)
+        valid=self.length[rows] > 0
+        values[valid]=self.data[self.start[rows[valid]]]
+        return values
+
+    def take(self, rows):
+        n=np.size(rows)
+        for name in ['start', 'length', 'kind']:
+            column=getattr(self, name)
+            column[:n]=column[rows]
+        self.objects=_remap(self.objects, rows)
+
+    def trim(self, n):
+        self.length, self.kind, self.data = self.compact(np.arange(n))
+        self.start=np.cumsum(self.length)-self.length
+        self.size=np.size(self.data)
+
+    def compact(self, rows):
+        """
+        Returns the lengths, kinds and contiguous values of the given rows
+        """
+        return self.length[rows], self.kind[rows], self.data[_ragged_elements(self.start[rows], self.length[rows])]
+
+    def get_columns(self, rows):
+        length, kind, data = self.compact(rows)
+        return {'length': length, 'kind': kind, 'data': data, 'objects': _remap(self.objects, rows)}
+
+    def set_columns(self, fields, objects, n):
+        self.length[:n]=fields['length']
+        self.kind[:n]=fields['kind']
+        self.start[:n]=np.cumsum(fields['length'])-fields['length']
+        self.data=np.asarray(fields['data'], dtype='float64').copy()
+        self.size=np.size(self.data)
+        self.objects=objects
+
+def _remap(objects, rows):
+    """
+    Renumbers the objects of a column after the rows are taken
+    """
+    if len(objects)==0:
+        return {}
+    new=np.full(max(objects)+1, -1, dtype='int64')
+    valid=np.asarray(rows) <= max(objects)
+    rows=np.asarray(rows)
+    new[rows[valid]]=np.flatnonzero(valid)
+    return {int(new[row]): obj for row, obj in objects.items() if new[row] >= 0}
+
+class _SpectrumView(individual_spectrum):
+    """
+    View of a spectrum in a ResultStore. Behaves as an individual_spectrum:
+    attributes are read from and written to the store. Pickling or copying a
+    view produces a standalone individual_spectrum
+    """
+    __slots__ = ('_store', '_key')
+
+    def __init__(self, store, key):
+        object.__setattr__(self, '_store', store)
+        object.__setattr__(self, '_key', key)
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        try:
+            return self._store._get(self._key, name)
+        except AttributeError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        self._store._set_attribute(self._key, name, value)
+
+    def __eq__(self, other):
+        if isinstance(other, _SpectrumView):
+            return (self._store is other._store) and (self._key==other._key)
+        return NotImplemented
+
+    def __hash__(self):
+        return hash((id(self._store), self._key))
+
+    def __reduce_ex__(self, protocol):
+        return _reduce(self._store.detach(self._key))
+
+    @property
+    def spectrum(self):
+        return self._store._get(self._key, 'spectrum')
+
+    @spectrum.setter
+    def spectrum(self, spectrum):
+        self._store._set_attribute(self._key, 'spectrum', spectrum)
+
+class _ModelView(indivmodel):
+    """
+    View of a model in a ResultStore. Behaves as an indivmodel: attributes are
+    read from and written to the store. Pickling or copying a view produces a
+    standalone indivmodel
+    """
+    __slots__ = ('_store', '_mid')
+
+    def __init__(self, store, mid):
+        object.__setattr__(self, '_store', store)
+        object.__setattr__(self, '_mid', int(mid))
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        try:
+            return self._store._get_model(self._mid, name)
+        except AttributeError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        self._store._set_model_attribute(self._mid, name, value)
+
+    def __eq__(self, other):
+        if isinstance(other, _ModelView) and (self._store is other._store):
+            return self._mid==other._mid
+        return NotImplemented
+
+    def __hash__(self):
+        return hash((id(self._store), self._mid))
+
+    def __reduce_ex__(self, protocol):
+        return _reduce(self._store._detach_model(self._mid, {}))
+
+class _ModelList(object):
+    """
+    View of a list of models of a spectrum (e.g. model_from_parent). Appending
+    to it updates the store. Copying it produces a list
+    """
+    __slots__ = ('_store', '_key', '_name')
+
+    def __init__(self, store, key, name):
+        self._store=store
+        self._key=key
+        self._name=name
+
+    def _ids(self):
+        return self._store._columns[self._name].get(self._store._row_key(self._key))
+
+    def _view(self, mid):
+        return None if mid < 0 else _ModelView(self._store, mid)
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def __len__(self):
+        return len(self._ids())
+
+    def __iter__(self):
+        return iter([self._view(mid) for mid in self._ids()])
+
+    def __getitem__(self, i):
+        ids=self._ids()
+        if isinstance(i, slice):
+            return [self._view(mid) for mid in ids[i]]
+        return self._view(ids[i])
+
+    def __setitem__(self, i, model):
+        ids=self._ids()
+        memo={}
+        ids[i]=self._store._get_model_id(model, self._key, memo)
+        self._store._set_model_list(self._key, self._name, ids)
+
+    def __delitem__(self, i):
+        ids=self._ids()
+        del ids[i]
+        self._store._set_model_list(self._key, self._name, ids)
+
+    def __contains__(self, model):
+        if model is None:
+            return -1 in self._ids()
+        if isinstance(model, _ModelView) and (model._store is self._store):
+            return model._mid in self._ids()
+        return any(model is view or model==view for view in self)
+
+    def __eq__(self, other):
+        return list(self)==list(other)
+
+    def __ne__(self, other):
+        return not self==other
+
+    def append(self, model):
+        self._store._append_model(self._key, self._name, model)
+
+    def extend(self, models):
+        for model in models:
+            self.append(model)
+
+    def remove(self, model):
+        for i, view in enumerate(self):
+            if (view is model) or (view==model):
+                del self[i]
+                return
+        raise ValueError("model not in list")
+
+    def index(self, model):
+        for i, view in enumerate(self):
+            if (view is model) or (view==model):
+                return i
+        raise ValueError("model not in list")
+
+    def __copy__(self):
+        return list(self)
+
+    def __deepcopy__(self, memo):
+        models={}
+        return [None if mid < 0 else self._store._detach_model(mid, models) for mid in self._ids()]
+
+    def __reduce_ex__(self, protocol):
+        return (list, (self.__deepcopy__({}),))
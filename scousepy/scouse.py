@@ -71,6 +71,10 @@ class scouse(object):
         Verbose output to terminal
     autosave : bool
         Save the output at each stage of the process.
+    reference_mode : bool
+        If true, SAAs and individual spectra hold references to their spectra
+        rather than copies. The SAA spectra are kept in a single array per
+        wsaa and the individual spectra are read from the cube when needed.
 
     Global attributes - scouse defined attributes
     ---------------------------------------------
@@ -85,6 +89,9 @@ class scouse(object):
         If true, scouse will write fits files of the moment maps
     save_fig : bool, optional
         If true, scouse will output a figure of the coverage
+    noise_params : dictionary, optional
+        Keyword arguments passed to the noise estimator (see noisy.getnoise),
+        e.g. p_limit, pad_channels, n_mad. Defaults are used if None
     coverage_config_file_path : string
         File path for coverage configuration file
     nrefine : number
@@ -133,8 +140,21 @@ class scouse(object):
         of SAAs if spacing: 'nyquist' is selected.
     saa_dict : dictionary
         A dictionary containing all of the SAA spectra in scouse format
+    saa_spectra : dictionary
+        In reference mode, the averaged spectra of the SAAs. One (nsaa, nchan)
+        array per wsaa, written alongside the stage 1 output
     rms_approx : number
         An estimate of the mean rms across the map
+    saa_membership : dictionary
+        Sparse (nsaa, npix) matrices describing which pixels are contained
+        within each SAA. One matrix per wsaa, written alongside the stage 1
+        output
+    rms_map : ndarray
+        Map of the rms noise of every spectrum in the cube. Computed once
+        during stage 1 and written alongside the stage 1 output
+    rms_map_key : string
+        Identifies the cube, vel_range and noise_params used to compute
+        rms_map. The map is recomputed if these change
     x : ndarray
         The spectral axis
     xtrim : ndarray
@@ -197,6 +217,10 @@ class scouse(object):
              average of the two components and use this as a new guess
     njobs : int, optional
         Used for parallelised fitting
+    backend : string, optional
+        The fitter used in stage 3. Either 'pyspeckit' (default) or 'native'.
+        The native fitter fits stacks of spectra simultaneously and is only
+        available for fittype='gaussian'
 
     stage 3 - scouse defined attributes
     -----------------------------------
@@ -216,6 +240,7 @@ class scouse(object):
         self.fittype=None
         self.verbose=None
         self.autosave=None
+        self.reference_mode=None
         # global -- scousepy
         self.cube=None
         self.completed_stages = []
@@ -223,6 +248,7 @@ class scouse(object):
         # stage 1 -- user
         self.write_moments=None
         self.save_fig=None
+        self.noise_params=None
         # stage 1 -- scousepy coverage
         self.coverage_config_file_path=None
         self.nrefine=None
@@ -241,6 +267,10 @@ class scouse(object):
         # stage 1 -- scousepy SAAs
         self.lenspec=None
         self.saa_dict=None
+        self.saa_spectra=None
+        self.saa_membership=None
+        self.rms_map=None
+        self.rms_map_key=None
         self.rms_approx=None
         self.x=None
         self.xtrim=None
@@ -259,6 +289,7 @@ class scouse(object):
         # stage 3 -- user
         self.tol=None
         self.njobs=None
+        self.backend=None
 
         # stage 5 -- scousepy
         self.check_spec_indices=[]
@@ -306,6 +337,8 @@ class scouse(object):
 
         # Import
         from .stage_1 import generate_SAAs, plot_coverage, compute_noise, get_x_axis
+        from .stage_1 import get_saa_membership, save_saa_membership, save_saa_spectra
+        from .stage_1 import get_rms_map, save_rms_map
         from .io import import_from_config
         from .verbose_output import print_to_terminal
         from scousepy.scousecoverage import ScouseCoverage
@@ -387,6 +420,8 @@ class scouse(object):
         self.rms_approx = compute_noise(self)
         # Generate the x axis common to the fitting process
         self.x, self.xtrim, self.trimids = get_x_axis(self)
+        # Compute the noise of every spectrum in the map
+        get_rms_map(self)
 
         # Generate the SAAs
         with warnings.catch_warnings():
@@ -396,6 +431,9 @@ class scouse(object):
             generate_SAAs(self, coverageobject)
             log.setLevel(old_log)
 
+        # Index the pixels contained within each SAA
+        get_saa_membership(self)
+
         # Saving figures
         if self.save_fig:
             coverage_plot_filename=os.path.join(self.outputdirectory,self.filename,'stage_1','coverage.pdf')
@@ -406,6 +444,10 @@ class scouse(object):
             momentoutputdir=os.path.join(self.outputdirectory,self.filename,'stage_1/')
             from .io import output_moments
             output_moments(self.cube.header,coverageobject.moments,momentoutputdir,self.filename)
+            from .io import output_rms_map
+            # trimmed to match the moment maps
+            rms_map=self.rms_map[coverageobject.ymin:coverageobject.ymax,coverageobject.xmin:coverageobject.xmax]
+            output_rms_map(self.cube.header,coverageobject.moments,rms_map,momentoutputdir,self.filename)
 
         if nchunks is not None:
             if np.size(coverageobject.wsaa) > 1:
@@ -426,58 +468,67 @@ class scouse(object):
 
         # Save the scouse object automatically
         if self.autosave:
-            import pickle
+            from .chunked import save_stage
+            save_rms_map(self, self.outputdirectory+self.filename+'/stage_1/')
             if nchunks is not None:
                 for key in saa_dict_chunks.keys():
                     saa_dict={}
                     saa_dict[0]=saa_dict_chunks[key]
-                    with open(self.outputdirectory+self.filename+'/stage_1/s1.'+str(key)+'.scousepy', 'wb') as fh:
-                        pickle.dump((self.completed_stages,
-                                     self.coverage_config_file_path,
-                                     self.lenspec,
-                                     saa_dict,
-                                     self.x,
-                                     self.xtrim,
-                                     self.trimids,
-                                     self.rms_approx), fh, protocol=proto)
+                    save_stage(self.outputdirectory+self.filename+'/stage_1/s1.'+str(key)+'.scousepy',
+                               (self.completed_stages,
+                                self.coverage_config_file_path,
+                                self.lenspec,
+                                saa_dict,
+                                self.x,
+                                self.xtrim,
+                                self.trimids,
+                                self.rms_approx))
+                    save_saa_spectra(self, self.outputdirectory+self.filename+'/stage_1/s1.'+str(key)+'.scousepy')
             else:
                 if s1file is not None:
-                    with open(self.outputdirectory+self.filename+'/stage_1/'+s1file, 'wb') as fh:
-                        pickle.dump((self.completed_stages,
-                                     self.coverage_config_file_path,
-                                     self.lenspec,
-                                     self.saa_dict,
-                                     self.x,
-                                     self.xtrim,
-                                     self.trimids,
-                                     self.rms_approx), fh, protocol=proto)
+                    save_stage(self.outputdirectory+self.filename+'/stage_1/'+s1file,
+                               (self.completed_stages,
+                                self.coverage_config_file_path,
+                                self.lenspec,
+                                self.saa_dict,
+                                self.x,
+                                self.xtrim,
+                                self.trimids,
+                                self.rms_approx))
                 else:
-                    with open(self.outputdirectory+self.filename+'/stage_1/s1.scousepy', 'wb') as fh:
-                        pickle.dump((self.completed_stages,
-                                     self.coverage_config_file_path,
-                                     self.lenspec,
-                                     self.saa_dict,
-                                     self.x,
-                                     self.xtrim,
-                                     self.trimids,
-                                     self.rms_approx), fh, protocol=proto)
+                    save_stage(self.outputdirectory+self.filename+'/stage_1/s1.scousepy',
+                               (self.completed_stages,
+                                self.coverage_config_file_path,
+                                self.lenspec,
+                                self.saa_dict,
+                                self.x,
+                                self.xtrim,
+                                self.trimids,
+                                self.rms_approx))
+                save_saa_membership(self, s1path)
+                save_saa_spectra(self, s1path)
 
         return self
 
     def load_stage_1(self,fn):
         """
-        Method used to load in the progress of stage 1
+        Method used to load in the progress of stage 1. The SAAs are loaded
+        lazily
         """
-        import pickle
-        with open(fn, 'rb') as fh:
-            self.completed_stages,\
-            self.coverage_config_file_path,\
-            self.lenspec,\
-            self.saa_dict,\
-            self.x,\
-            self.xtrim,\
-            self.trimids,\
-            self.rms_approx=pickle.load(fh)
+        from .chunked import load_stage
+        self.completed_stages,\
+        self.coverage_config_file_path,\
+        self.lenspec,\
+        self.saa_dict,\
+        self.x,\
+        self.xtrim,\
+        self.trimids,\
+        self.rms_approx=load_stage(fn)
+
+        from .stage_1 import load_saa_membership, load_saa_spectra, load_rms_map
+        load_saa_membership(self, fn)
+        load_saa_spectra(self, fn)
+        load_rms_map(self, os.path.dirname(fn))
 
     def chunk_saas(self, nchunks):
         """
@@ -663,29 +714,32 @@ class scouse(object):
             self.completed_stages.append('s2')
 
         if self.autosave:
-            import pickle
+            from .chunked import save_stage
             if s2file is not None:
-                with open(self.outputdirectory+self.filename+'/stage_2/'+s2file, 'wb') as fh:
-                    pickle.dump((self.completed_stages,
-                                self.saa_dict,
-                                self.fitcount,
-                                self.modelstore), fh, protocol=proto)
+                save_stage(self.outputdirectory+self.filename+'/stage_2/'+s2file,
+                           (self.completed_stages,
+                            self.saa_dict,
+                            self.fitcount,
+                            self.modelstore))
             else:
-                with open(self.outputdirectory+self.filename+'/stage_2/s2.scousepy', 'wb') as fh:
-                    pickle.dump((self.completed_stages,
-                                self.saa_dict,
-                                self.fitcount,
-                                self.modelstore), fh, protocol=proto)
+                save_stage(self.outputdirectory+self.filename+'/stage_2/s2.scousepy',
+                           (self.completed_stages,
+                            self.saa_dict,
+                            self.fitcount,
+                            self.modelstore))
 
         return self
 
     def load_stage_2(self, fn):
-        import pickle
-        with open(fn, 'rb') as fh:
-            self.completed_stages,\
-            self.saa_dict, \
-            self.fitcount, \
-            self.modelstore = pickle.load(fh)
+        """
+        Method used to load in the progress of stage 2. The SAAs and the
+        model store are loaded lazily
+        """
+        from .chunked import load_stage
+        self.completed_stages,\
+        self.saa_dict, \
+        self.fitcount, \
+        self.modelstore = load_stage(fn)
 
     def stage_3(config='', verbose=None, s1file=None, s2file=None, s3file=None):
         """
@@ -799,6 +853,8 @@ class scouse(object):
         # now compile the spectra
         starttimecompile=time.time()
         compile_spectra(self, indivspec_list_completed)
+        # the spectra are now held by indiv_dict
+        del indivspec_list, indivspec_list_completed
         endtimecompile=time.time()
         if self.verbose:
             progress_bar = print_to_terminal(stage='s3', step='compileend',
@@ -811,6 +867,8 @@ class scouse(object):
         # select the best model out of those available - i.e. that with the
         # lowest aic value
         model_selection(self)
+        # release the room reserved while the spectra and models were added
+        self.indiv_dict.trim()
         endtimemodelselection = time.time()
         if self.verbose:
             progress_bar = print_to_terminal(stage='s3', step='modelselectend',
@@ -826,27 +884,26 @@ class scouse(object):
 
         # Save the scouse object automatically
         if self.autosave:
-            import pickle
+            from .chunked import save_stage
             if s3file is not None:
-                if os.path.exists(self.outputdirectory+self.filename+'/stage_3/'+s3file):
-                    os.rename(self.outputdirectory+self.filename+'/stage_3/'+s3file,self.outputdirectory+self.filename+'/stage_3/'+s3file+'.bk')
-
-                with open(self.outputdirectory+self.filename+'/stage_3/'+s3file, 'wb') as fh:
-                    pickle.dump((self.completed_stages, self.indiv_dict), fh, protocol=proto)
+                save_stage(self.outputdirectory+self.filename+'/stage_3/'+s3file,
+                           (self.completed_stages, self.indiv_dict), backup=True, journal=True)
             else:
-                if os.path.exists(self.outputdirectory+self.filename+'/stage_3/s3.scousepy'):
-                    os.rename(self.outputdirectory+self.filename+'/stage_3/s3.scousepy',self.outputdirectory+self.filename+'/stage_3/s3.scousepy.bk')
-
-                with open(self.outputdirectory+self.filename+'/stage_3/s3.scousepy', 'wb') as fh:
-                    pickle.dump((self.completed_stages, self.indiv_dict), fh, protocol=proto)
+                save_stage(self.outputdirectory+self.filename+'/stage_3/s3.scousepy',
+                           (self.completed_stages, self.indiv_dict), backup=True, journal=True)
 
         return self
 
     def load_stage_3(self, fn):
-        import pickle
-        with open(fn, 'rb') as fh:
-            self.completed_stages,\
-            self.indiv_dict = pickle.load(fh)
+        """
+        Method used to load in the progress of stage 3. Stage files written by
+        earlier versions of scousepy are converted to a ResultStore
+        """
+        from .chunked import load_stage
+        from .result_store import ResultStore
+        self.completed_stages,\
+        self.indiv_dict = load_stage(fn)
+        self.indiv_dict = ResultStore.from_indiv_dict(self.indiv_dict)
 
     def stage_4(config='', bitesize=False, verbose=None, nocheck=False,
                 s1file = None, s2file = None, s3file=None, s4file=None,
@@ -861,6 +918,7 @@ class scouse(object):
         from .io import import_from_config
         from .verbose_output import print_to_terminal
         from scousepy.scousefitchecker import ScouseFitChecker
+        from .result_store import ResultStore
 
         # Check input
         if os.path.exists(config):
@@ -962,11 +1020,14 @@ class scouse(object):
 
         # print('')
 
-        sorteddict={}
-        for sortedkey in sorted(self.indiv_dict.keys()):
-            sorteddict[sortedkey]=self.indiv_dict[sortedkey]
+        if isinstance(self.indiv_dict, ResultStore):
+            self.indiv_dict.sort()
+        else:
+            sorteddict={}
+            for sortedkey in sorted(self.indiv_dict.keys()):
+                sorteddict[sortedkey]=self.indiv_dict[sortedkey]
 
-        self.indiv_dict=sorteddict
+            self.indiv_dict=sorteddict
 
         # for key in self.indiv_dict.keys():
         #     print(key, self.indiv_dict[key])
@@ -984,26 +1045,25 @@ class scouse(object):
 
         # Save the scouse object automatically
         if self.autosave:
-            import pickle
+            from .chunked import save_stage
             if s4file is not None:
-                if os.path.exists(self.outputdirectory+self.filename+'/stage_4/'+s4file):
-                    os.rename(self.outputdirectory+self.filename+'/stage_4/'+s4file,self.outputdirectory+self.filename+'/stage_4/'+s4file+'.bk')
-
-                with open(self.outputdirectory+self.filename+'/stage_4/'+s4file, 'wb') as fh:
-                    pickle.dump((self.completed_stages,self.check_spec_indices,self.indiv_dict), fh, protocol=proto)
+                save_stage(self.outputdirectory+self.filename+'/stage_4/'+s4file,
+                           (self.completed_stages,self.check_spec_indices,self.indiv_dict), backup=True, journal=True)
             else:
-                if os.path.exists(self.outputdirectory+self.filename+'/stage_4/s4.scousepy'):
-                    os.rename(self.outputdirectory+self.filename+'/stage_4/s4.scousepy',self.outputdirectory+self.filename+'/stage_4/s4.scousepy.bk')
-
-                with open(self.outputdirectory+self.filename+'/stage_4/s4.scousepy', 'wb') as fh:
-                    pickle.dump((self.completed_stages,self.check_spec_indices,self.indiv_dict), fh, protocol=proto)
+                save_stage(self.outputdirectory+self.filename+'/stage_4/s4.scousepy',
+                           (self.completed_stages,self.check_spec_indices,self.indiv_dict), backup=True, journal=True)
 
         return self
 
     def load_stage_4(self, fn):
-        import pickle
-        with open(fn, 'rb') as fh:
-            self.completed_stages, self.check_spec_indices, self.indiv_dict = pickle.load(fh)
+        """
+        Method used to load in the progress of stage 4. Stage files written by
+        earlier versions of scousepy are converted to a ResultStore
+        """
+        from .chunked import load_stage
+        from .result_store import ResultStore
+        self.completed_stages, self.check_spec_indices, self.indiv_dict = load_stage(fn)
+        self.indiv_dict = ResultStore.from_indiv_dict(self.indiv_dict)
 
 #==============================================================================#
 # io
@@ -1085,10 +1145,11 @@ class scouse(object):
             old_log = log.level
             log.setLevel('ERROR')
 
-            # Read in the datacube
+            # Read in the datacube. Cubes read from file are cached for the
+            # session (see cube_cache)
             if cube is None:
-                _cube = SpectralCube.read(fitsfile).with_spectral_unit(u.km/u.s,
-                                                    velocity_convention='radio')
+                from .cube_cache import read_cube
+                _cube = read_cube(fitsfile)
             else:
                 _cube = cube
 
@@ -1103,6 +1164,10 @@ class scouse(object):
             self.cube = _cube
             log.setLevel(old_log)
 
+        # individual spectra created in reference mode are read from the cube
+        from .model_housing import register_spectrum_source, get_cube_source
+        register_spectrum_source(get_cube_source(self), _cube)
+
         return _cube
 
     def save_to(self, filename):
@@ -1206,28 +1271,38 @@ class scouse(object):
                     saa_dicts1[0][key]=saa
 
         self.saa_dict=saa_dicts1
+        # the membership matrices of the individual chunks are superseded
+        self.saa_membership=None
 
-        import pickle
+        from .chunked import save_stage
         if s1file is not None:
-            with open(self.outputdirectory+self.filename+'/stage_1/'+s1file, 'wb') as fh:
-                pickle.dump((self.completed_stages,
-                             self.coverage_config_file_path,
-                             self.lenspec,
-                             self.saa_dict,
-                             self.x,
-                             self.xtrim,
-                             self.trimids,
-                             self.rms_approx), fh, protocol=proto)
+            save_stage(self.outputdirectory+self.filename+'/stage_1/'+s1file,
+                       (self.completed_stages,
+                        self.coverage_config_file_path,
+                        self.lenspec,
+                        self.saa_dict,
+                        self.x,
+                        self.xtrim,
+                        self.trimids,
+                        self.rms_approx))
         else:
-            with open(self.outputdirectory+self.filename+'/stage_1/s1.combine.scousepy', 'wb') as fh:
-                pickle.dump((self.completed_stages,
-                             self.coverage_config_file_path,
-                             self.lenspec,
-                             self.saa_dict,
-                             self.x,
-                             self.xtrim,
-                             self.trimids,
-                             self.rms_approx), fh, protocol=proto)
+            save_stage(self.outputdirectory+self.filename+'/stage_1/s1.combine.scousepy',
+                       (self.completed_stages,
+                        self.coverage_config_file_path,
+                        self.lenspec,
+                        self.saa_dict,
+                        self.x,
+                        self.xtrim,
+                        self.trimids,
+                        self.rms_approx))
+
+        from .stage_1 import save_saa_membership, save_saa_spectra
+        if s1file is not None:
+            save_saa_membership(self, self.outputdirectory+self.filename+'/stage_1/'+s1file)
+            save_saa_spectra(self, self.outputdirectory+self.filename+'/stage_1/'+s1file)
+        else:
+            save_saa_membership(self, self.outputdirectory+self.filename+'/stage_1/s1.combine.scousepy')
+            save_saa_spectra(self, self.outputdirectory+self.filename+'/stage_1/s1.combine.scousepy')
 
 
         # save a combined s2 next
@@ -1289,17 +1364,17 @@ class scouse(object):
         self.fitcount=np.ones(np.size(list(self.modelstore.keys())), dtype='bool')
 
         if s2file is not None:
-            with open(self.outputdirectory+self.filename+'/stage_2/'+s2file, 'wb') as fh:
-                pickle.dump((self.completed_stages,
-                            self.saa_dict,
-                            self.fitcount,
-                            self.modelstore), fh, protocol=proto)
+            save_stage(self.outputdirectory+self.filename+'/stage_2/'+s2file,
+                       (self.completed_stages,
+                        self.saa_dict,
+                        self.fitcount,
+                        self.modelstore))
         else:
-            with open(self.outputdirectory+self.filename+'/stage_2/s2.combine.scousepy', 'wb') as fh:
-                pickle.dump((self.completed_stages,
-                            self.saa_dict,
-                            self.fitcount,
-                            self.modelstore), fh, protocol=proto)
+            save_stage(self.outputdirectory+self.filename+'/stage_2/s2.combine.scousepy',
+                       (self.completed_stages,
+                        self.saa_dict,
+                        self.fitcount,
+                        self.modelstore))
 
         return self
 
@@ -1420,11 +1495,14 @@ class scouse(object):
         # copy
         import copy
         s3copy=copy.deepcopy(s3template)
-        # update the dictionary with the new fits
-        setattr(s3copy,'indiv_dict',indiv_dict_combine)
+        # update the dictionary with the new fits. The spectra are copied from
+        # the stores of each run into a new store
+        from .result_store import ResultStore
+        shape=getattr(indiv_dicts[0], 'shape', None)
+        setattr(s3copy,'indiv_dict',ResultStore.from_indiv_dict(indiv_dict_combine, shape))
         # save as a new file
-        import pickle
-        with open(s3copy.outputdirectory+s3copy.filename+'/stage_3/s3.scousepy.combined', 'wb') as fh:
-            pickle.dump((s3copy.completed_stages, s3copy.indiv_dict), fh, protocol=proto)
+        from .chunked import save_stage
+        save_stage(s3copy.outputdirectory+s3copy.filename+'/stage_3/s3.scousepy.combined',
+                   (s3copy.completed_stages, s3copy.indiv_dict))
 
         return s3copy
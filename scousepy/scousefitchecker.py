@@ -524,20 +524,25 @@ class ScouseFitChecker(object):
     def get_spectral_info(self):
         from .model_housing import individual_spectrum, indivmodel
         from .stage_3 import create_a_dud
+        from .stage_1 import get_rms_map
 
         if self.speckey not in self.scouseobject.indiv_dict.keys():
             # handles when the user clicks on a spectrum that was rejected during
-            # stage 1. Create a spectrum and a dud model.
+            # stage 1. Create a spectrum and a dud model. The rms is taken from
+            # the rms map.
+            get_rms_map(self.scouseobject)
             index=np.unravel_index(self.speckey,self.scouseobject.cube.shape[1:])
-            self.my_spectrum=individual_spectrum(np.array([index[1],index[0]]),self.scouseobject.cube.filled_data[:,index[0],index[1]].value,index=self.speckey,
+            my_spectrum=individual_spectrum(np.array([index[1],index[0]]),self.scouseobject.cube.filled_data[:,index[0],index[1]].value,index=self.speckey,
                                 scouseobject=self.scouseobject, saa_dict_index=None,
                                 saaindex=None)
-            self.scouseobject.indiv_dict[self.speckey]=self.my_spectrum
-            setattr(self.my_spectrum,'model_from_parent',[None],)
+            setattr(my_spectrum,'model_from_parent',[None],)
             # create and add the dud
-            modeldict = create_a_dud(self.my_spectrum)
+            modeldict = create_a_dud(my_spectrum)
             bfmodel = indivmodel(modeldict)
-            setattr(self.my_spectrum, 'model', bfmodel)
+            setattr(my_spectrum, 'model', bfmodel)
+            # the spectrum is copied into indiv_dict, and is then edited there
+            self.scouseobject.indiv_dict[self.speckey]=my_spectrum
+            self.my_spectrum=self.scouseobject.indiv_dict[self.speckey]
         else:
             self.my_spectrum=self.scouseobject.indiv_dict[self.speckey]
 
@@ -990,6 +995,7 @@ def compute_diagnostic_plots(self,):
     """
     from astropy import units as u
     from .verbose_output import print_to_terminal
+    from .result_store import ResultStore
 
     # we output the maps as fits files so first check if they exist. If they
     # do then load them rather than create them twice
@@ -1000,38 +1006,32 @@ def compute_diagnostic_plots(self,):
     else:
         if self.verbose:
             progress_bar = print_to_terminal(stage='s4', step='diagnosticsinit')
-        diagnostics=[generate_2d_parametermap(self, mapname) for mapname in self.maps]
+        results=ResultStore.from_scouseobject(self.scouseobject)
+        diagnostics=[generate_2d_parametermap(self, mapname, results=results) for mapname in self.maps]
         if self.verbose:
             print("")
 
     return diagnostics
 
-def generate_2d_parametermap(self, spectrum_parameter):
+def generate_2d_parametermap(self, spectrum_parameter, results=None):
     """
     Create a 2D map of a given spectral parameter
 
     Parameters
     ----------
     scouseobject : Instance of the scousepy class
+    spectrum_parameter : string
+        the model attribute to map
+    results : instance of the ResultStore class, optional
+        the best-fitting solutions. Created from indiv_dict if not provided
 
     """
-    from .verbose_output import print_to_terminal
-    map = np.zeros(self.scouseobject.cube.shape[1:])
-    map[:] = np.nan
-
-    if self.verbose:
-        progress_bar = print_to_terminal(stage='s4', step='diagnostics',length=len(self.scouseobject.indiv_dict.keys()))
-
-    for key,spectrum in self.scouseobject.indiv_dict.items():
-        cx,cy = spectrum.coordinates
-        #if getattr(spectrum.model, 'ncomps') != 0:
-        map[cy, cx] = getattr(spectrum.model, spectrum_parameter)
-        #else:
-        #    map[cy, cx] = np.nan
-        if self.verbose:
-            progress_bar.update()
+    from .result_store import ResultStore
+
+    if results is None:
+        results=ResultStore.from_scouseobject(self.scouseobject)
 
-    return map
+    return results.get_map(spectrum_parameter)
 
 def save_maps(self, diagnostics, overwrite=True):
     """
@@ -1045,21 +1045,65 @@ def save_maps(self, diagnostics, overwrite=True):
         optional overwrite
 
     """
-    from astropy.io import fits
-    savedir=self.scouseobject.outputdirectory+self.scouseobject.filename+'/stage_4/'
-    for index,mapname in enumerate(self.maps):
-        fh = fits.PrimaryHDU(data=diagnostics[index], header=self.scouseobject.cube[0,:,:].header)
-        fh.writeto(os.path.join(savedir, "stage_4_"+mapname+".fits"), overwrite=overwrite)
+    save_map_files(self.scouseobject, self.maps, diagnostics, overwrite=overwrite)
 
 def load_maps(self):
     """
     Procedure to load the maps
 
+    """
+    return load_map_files(self.scouseobject, self.maps)
+
+def get_map_directory(scouseobject):
+    """
+    Returns the directory in which the stage 4 maps are saved
+    """
+    return scouseobject.outputdirectory+scouseobject.filename+'/stage_4/'
+
+def save_map_files(scouseobject, mapnames, maps, savedir=None, overwrite=True):
+    """
+    Saves a list of maps as stage_4_<mapname>.fits, using the spatial header
+    of the cube
+
+    Parameters
+    ----------
+    scouseobject : Instance of the scousepy class
+    mapnames : list
+        names of the maps
+    maps : list
+        the maps, in the order of mapnames
+    savedir : string, optional
+        output directory. Default is the stage 4 directory
+    overwrite : bool
+        optional overwrite
+
+    """
+    from astropy.io import fits
+    if savedir is None:
+        savedir=get_map_directory(scouseobject)
+    header=scouseobject.cube[0,:,:].header
+    for index,mapname in enumerate(mapnames):
+        fh = fits.PrimaryHDU(data=maps[index], header=header)
+        fh.writeto(os.path.join(savedir, "stage_4_"+mapname+".fits"), overwrite=overwrite)
+
+def load_map_files(scouseobject, mapnames, savedir=None):
+    """
+    Loads a list of maps saved with save_map_files
+
+    Parameters
+    ----------
+    scouseobject : Instance of the scousepy class
+    mapnames : list
+        names of the maps
+    savedir : string, optional
+        directory containing the maps. Default is the stage 4 directory
+
     """
     from astropy.io import fits
-    savedir=self.scouseobject.outputdirectory+self.scouseobject.filename+'/stage_4/'
+    if savedir is None:
+        savedir=get_map_directory(scouseobject)
 
-    return [fits.getdata(savedir+'stage_4_'+mapname+'.fits') for mapname in self.maps]
+    return [fits.getdata(os.path.join(savedir, 'stage_4_'+mapname+'.fits')) for mapname in mapnames]
 
 def get_mycmap(self):
     import matplotlib as mpl
@@ -1110,12 +1154,11 @@ def get_neighbours(self):
         y position of the selected pixel
 
     """
+    from .neighbours import get_window
     shape=self.scouseobject.cube.shape[1:]
-    neighboursx=np.arange(self.xpos-(self.blocksize-1)/2,(self.xpos+(self.blocksize-1)/2)+1,dtype='int' )
-    neighboursx=[x if (x>=0) & (x<=shape[1]-1) else np.nan for x in neighboursx ]
-    neighboursy=np.arange(self.ypos-(self.blocksize-1)/2,(self.ypos+(self.blocksize-1)/2)+1,dtype='int' )
-    neighboursy=[y if (y>=0) & (y<=shape[0]-1) else np.nan for y in neighboursy ]
-    keys=[np.ravel_multi_index([y,x], shape)  if np.all(np.isfinite(np.asarray([y,x]))) else np.nan for y in neighboursy for x in neighboursx]
+    indices=get_window(self.xpos, self.ypos, self.blocksize, shape)
+    # pixels outside the map are set to nan for plotting
+    keys=[index if index >= 0 else np.nan for index in indices.tolist()]
 
     return keys
 
@@ -80,11 +80,10 @@ def get_properties(self):
     noise, amplitude, velocity, and dispersion (determined using moments)
 
     """
-    from scousepy.noisy import getnoise
+    from scousepy.noisy import getnoise_batch
     from scousepy.SpectralDecomposer import Decomposer
 
-    rms=[getnoise(self.specx, spectrum).rms
-         for i, spectrum in enumerate(self.spectra)]
+    rms=getnoise_batch(self.specx, self.spectra)
 
     decomposers=[Decomposer(self.specx, spectrum, rms[i])
                  for i,spectrum in enumerate(self.spectra)]
@@ -7,8 +7,7 @@ import sys
 import warnings
 from astropy import wcs
 from astropy import log
-from .parallel_map import *
-from tqdm import tqdm
+from .executor import get_executor
 warnings.simplefilter('ignore', wcs.FITSFixedWarning)
 
 # add Python 2 xrange compatibility, to be removed
@@ -66,6 +65,7 @@ class ScouseSpatial(object):
         self.flag_njumps=flag_njumps
         self.flag_nstddev=flag_nstddev
         self.flag_dict={}
+        self.keygrid=None
         from scousepy import scouse
         # load the cube
         fitsfile = os.path.join(scouseobject.datadirectory, scouseobject.filename+'.fits')
@@ -101,22 +101,32 @@ class ScouseSpatial(object):
         spectrum : instance of scousepy's spectrum class
 
         """
-        if spectrum is None:
-            spectrumlist=[spectrum for index, spectrum in indiv_dict.items()]
+        from .shared_data import SharedModels
+        from .neighbours import KeyGrid
+        from .flagging import flag_spectra
+
+        if spectrum is not None:
+            if self.keygrid is None:
+                self.keygrid=KeyGrid.from_dict(indiv_dict, self.cubeshape[1:])
+            results=[flagging_method([self, indiv_dict, spectrum])]
         else:
-            spectrumlist=[spectrum]
-
-        flagobjectlist = [self, indiv_dict]
-        inputlist = [flagobjectlist+[spectrum] for spectrum in spectrumlist]
-
-        # if njobs > 1 run in parallel else in series
-        if self.njobs > 1:
-            results=parallel_map(flagging_method, inputlist, numcores=self.njobs, verbose=self.verbose)
-        else:
-            if self.verbose:
-                results=[flagging_method(input) for input in tqdm(inputlist)]
-            else:
-                results=[flagging_method(input) for input in inputlist]
+            # the models are placed in shared memory so that the workers only
+            # need the pixel indices
+            models=SharedModels(indiv_dict, self.cubeshape[1:])
+            self.keygrid=KeyGrid.from_dict(models, self.cubeshape[1:])
+            flagobjectlist = [self, models]
+            try:
+                # flag the whole map at once. The executor is only needed if
+                # the model parameters are not recognised by the flagging
+                # engine
+                results=flag_spectra(self, models, np.fromiter(indiv_dict.keys(), dtype='int64'))
+                if results is None:
+                    # if njobs > 1 run in parallel else in series
+                    executor=get_executor(self.njobs)
+                    results=executor.map(flagging_task, list(indiv_dict.keys()),
+                                         context=flagobjectlist, verbose=self.verbose)
+            finally:
+                models.release()
 
         for result in results:
             self.flag_dict[result[0]]={'flag':result[1], 'compflag': result[2], 'paramflag': result[3]}
@@ -137,19 +147,17 @@ class ScouseSpatial(object):
 
         """
         self.flagmap=np.zeros(self.cubeshape[1:])*np.nan
-        for key,spectrum in indiv_dict.items():
-            cx,cy = spectrum.coordinates
-            if key in self.flag_dict:
-                if np.any(self.flag_dict[key]['flag']):
-                    index = np.where(np.asarray(self.flag_dict[key]['flag']))[0]
-                    if 7 in index:
-                        self.flagmap[cy, cx]=7
-                    else:
-                        self.flagmap[cy, cx]=index[0]
-                else:
-                    self.flagmap[cy, cx]=0
-            else:
-                self.flagmap[cy, cx]=0
+        keys=np.fromiter(indiv_dict.keys(), dtype='int64')
+        # pixels which are not flagged are 0
+        values=np.zeros(np.size(keys))
+        flagged=[(i, flags['flag']) for i, flags in enumerate(self.flag_dict.get(key) for key in keys.tolist())
+                 if flags is not None and np.any(flags['flag'])]
+        if len(flagged)!=0:
+            rows=np.asarray([i for i, _ in flagged])
+            flags=np.asarray([flag for _, flag in flagged], dtype='bool')
+            # flag 7 takes precedence over the others
+            values[rows]=np.where(flags[:,7], 7, np.argmax(flags, axis=1))
+        self.flagmap.ravel()[keys]=values
 
         if save_map:
             self.save_map_to_fits(outputfits)
@@ -169,21 +177,37 @@ class ScouseSpatial(object):
         fh = fits.PrimaryHDU(data=self.flagmap, header=self.header)
         fh.writeto(os.path.join(savedir, outputfits), overwrite=True)
 
-    def spatial_refit(self, scouseobject, refitfile=None, tol=None):
+    def spatial_refit(self, scouseobject, refitfile=None, tol=None, batchsize=None,
+                      tilesize=None):
         """
-        Method for spatial refitting. Refitting is handled in a while loop which
-        continuously modifies neighbour models as fitting is improved. Continues
-        to loop until no more satisfactory fits can be identified. satisfactory
-        here means fits which satisfy the flagging criteria
+        Method for spatial refitting. The flagged spectra are held in a
+        priority queue ordered by the number of non-flagged neighbours, such
+        that those with the most reliable neighbours are refit first. When a
+        satisfactory fit is found (one which satisfies the flagging criteria)
+        only the flagged pixels neighbouring the refit pixel are updated and
+        queued to be refit. Continues until no more satisfactory fits can be
+        identified.
+
+        If tilesize is given the map is instead divided into tiles which are
+        refit independently and in parallel (see refit_tiles).
 
         Parameters
         ----------
         scouseobject : instance of the scousepy class
+        refitfile : string, optional
+            name of the output file
+        tol : list, optional
+            tolerance values for the fitting. Default is that of scouseobject
+        batchsize : int, optional
+            number of pixels taken from the queue and refit in parallel at a
+            time. Default is 1 if njobs is 1 and 64*njobs otherwise. Not used
+            if tilesize is given
+        tilesize : int, optional
+            size of the tiles in pixels
 
         """
-        from .model_housing import individual_spectrum
-        from copy import deepcopy
-        import time
+        from .shared_data import SharedModels
+        from .neighbours import KeyGrid
 
         if tol is None:
             self.tol=scouseobject.tol
@@ -192,95 +216,308 @@ class ScouseSpatial(object):
 
         indiv_dict = scouseobject.indiv_dict
         # create a list of flagged spectra
-        flag = [spectrum for key, spectrum in indiv_dict.items() if key in self.flag_dict and np.any(self.flag_dict[key]['flag'])]
-        lenflag = np.size(flag)
+        flag = [key for key, spectrum in indiv_dict.items() if key in self.flag_dict and np.any(self.flag_dict[key]['flag'])]
         # remove guesses from flagged spectra
         [setattr(spectrum,'guesses_updated',None) for key, spectrum in indiv_dict.items()]
-        # stopping criteria
-        stop=False
-
-        while stop==False:
-            # sort the list of flagged spectra according to the number of flag-free
-            # neighbours
-            sortedflag, sortednumneighbours = self.sortflag(flag, indiv_dict)
-            # prepare the newflag list with spectra whose neighbours are all flagged
-            newflag = [spectrum for key, spectrum in enumerate(sortedflag) if sortednumneighbours[key]==0.0]
-            # remove spectra where all neighbours are flagged from the sortedflag list
-            # this is our working list
-            sortedflag = [spectrum for key, spectrum in enumerate(sortedflag) if sortednumneighbours[key]!=0.0]
+
+        if tilesize is not None:
+            self.keygrid=KeyGrid.from_dict(indiv_dict, self.cubeshape[1:])
+            self.refit_tiles(indiv_dict, flag, tilesize)
+        else:
+            if batchsize is None:
+                batchsize=1 if (self.njobs is None or self.njobs <= 1) else 64*self.njobs
+            # the best-fitting models are placed in shared memory so that the
+            # workers only need the pixel indices
+            models=SharedModels(indiv_dict, self.cubeshape[1:])
+            self.keygrid=KeyGrid.from_dict(models, self.cubeshape[1:])
+            try:
+                self.refit_queue(indiv_dict, models, flag, batchsize=batchsize,
+                                 executor=get_executor(self.njobs))
+            finally:
+                models.release()
+
+        # Save the scouse object automatically
+        if scouseobject.autosave:
+            from .chunked import save_stage
+            if refitfile is not None:
+                save_stage(scouseobject.outputdirectory+scouseobject.filename+'/stage_4/'+refitfile,
+                           (scouseobject.completed_stages,scouseobject.check_spec_indices,indiv_dict), backup=True, journal=True)
+            else:
+                save_stage(scouseobject.outputdirectory+scouseobject.filename+'/stage_4/s4.refit.scousepy',
+                           (scouseobject.completed_stages,scouseobject.check_spec_indices, indiv_dict), backup=True, journal=True)
+
+
+    def refit_queue(self, indiv_dict, models, flag, pending=None, batchsize=1,
+                    executor=None, numneighbours=None):
+        """
+        Refits flagged pixels in order of their number of non-flagged
+        neighbours. See spatial_refit
+
+        Parameters
+        ----------
+        indiv_dict : dictionary
+            dictionary containing best-fitting solutions of a scousepy
+            decomposition. Updated with the accepted models
+        models : instance of the SharedModels class or dictionary
+            the models from which the neighbours are taken. Updated with the
+            accepted models if it is not indiv_dict
+        flag : list
+            the keys of the flagged pixels which may be refit
+        pending : list, optional
+            the keys of the flagged pixels to refit initially. The others are
+            only refit once one of their neighbours changes. Default is all
+        batchsize : int
+            number of pixels taken from the queue and refit at a time
+        executor : optional
+            if given the pixels of each batch are refit in parallel
+        numneighbours : list, optional
+            the number of non-flagged neighbours of each pixel of flag.
+            Default is computed from flag_dict
+
+        Returns
+        -------
+        accepted : list
+            [index, model, flag results] of each accepted refit, in order
+        guesses : dictionary
+            the updated guesses of the pixels for which a refit was rejected
+
+        """
+        from copy import copy
+        import heapq
+
+        accepted=[]
+        guesses={}
+
+        # the number of non-flagged neighbours of each flagged pixel
+        if numneighbours is None:
+            numneighbours=self.count_unflagged_neighbours(flag, self.get_unflagged_mask()).tolist()
+        numneighbours=dict(zip(flag, numneighbours))
+        if pending is None:
+            pending=flag
+        # the queue holds (-numneighbours, order, index). Entries are not
+        # removed when a priority changes; instead a new entry is added and
+        # the outdated one is skipped when popped. Pixels whose neighbours are
+        # all flagged wait until one of their neighbours is refit
+        queue=[(-numneighbours[key], order, key) for order, key in enumerate(pending) if numneighbours[key]!=0]
+        heapq.heapify(queue)
+        queued=set(key for _, _, key in queue)
+        order=len(queue)
+        # the workers are forked for the first batch, and are kept for the
+        # following batches as the flags which change are sent with the
+        # tasks and the models are held in shared memory. They are forked
+        # again if the shared models are resized or the key grid changes
+        refresh=True
+        maxparams=getattr(models, 'maxparams', None)
+
+        while len(queue)!=0:
+            # take the pixels with the most non-flagged neighbours
+            batch=[]
+            while len(queue)!=0 and len(batch) < batchsize:
+                priority, _, key = heapq.heappop(queue)
+                if (key in queued) and (-priority==numneighbours[key]):
+                    queued.discard(key)
+                    batch.append(indiv_dict[key])
+            if len(batch)==0:
+                break
 
             # method for checking model bank and refitting
-            fittinglist=[self, indiv_dict]
-            inputlist=[fittinglist+[spectrum] for spectrum in sortedflag]
-            # if njobs > 1 run in parallel else in series
-            if self.njobs > 1:
-                fitresults = parallel_map(decomposition_method, inputlist, numcores=self.njobs, verbose=self.verbose)
+            if executor is not None:
+                # if njobs > 1 run in parallel else in series. The spectra and
+                # the current flags of their neighbours are sent with the
+                # tasks, as these change from one batch to the next
+                fittinglist=[self, models]
+                tasks=[[spectrum, self.get_window_flags(spectrum)] for spectrum in batch]
+                fitresults=executor.map(refit_task, tasks, context=fittinglist,
+                                        verbose=False, refresh=refresh)
+                refresh=False
             else:
-                if self.verbose:
-                    fitresults=[decomposition_method(input) for input in tqdm(inputlist)]
-                else:
-                    fitresults=[decomposition_method(input) for input in inputlist]
-
-            # now add model solutions to the relevant spectra and add remaining
-            # spectra to an output list
-            count=0.0
-            for i, fitresult in enumerate(fitresults):
-                model=fitresult[0]
-                guesses_updated=fitresult[1]
-                spectrum=sortedflag[i]
-
-                # any spectra for which an alternative solution cannot be
-                # determined are appended to newflag
+                fitresults=[decomposition_method([self, models, spectrum]) for spectrum in batch]
+
+            # now add model solutions to the relevant spectra
+            for spectrum, (model, guesses_updated) in zip(batch, fitresults):
                 if model is not None:
-                    # deep copy spectrum
-                    spectrum_=deepcopy(spectrum)
-                    setattr(spectrum_, 'model', model)
                     # check if flagging satisfied
-                    inputlist = [self, indiv_dict, spectrum_]
-                    results=flagging_method(inputlist)
-
-                    if np.all(np.invert(results[1])):
-                        if spectrum.model not in spectrum.model_from_parent:
-                            spectrum.model_from_parent.append(spectrum.model)
-
-                        setattr(spectrum, 'model', model)
-                        if model.method=='spatial':
-                            individual_spectrum.add_model(spectrum, model)
-                        self.flag_dict[results[0]]={'flag':results[1], 'compflag': results[2], 'paramflag': results[3]}
-                    else:
-                        # update the guesses and pass it back through
-                        setattr(spectrum,'guesses_updated',guesses_updated,)
-                        newflag.append(spectrum)
+                    spectrum_=copy(spectrum)
+                    setattr(spectrum_, 'model', model)
+                    results=flagging_method([self, models, spectrum_])
+                    satisfied=np.all(np.invert(results[1]))
                 else:
-                    # update the guesses and pass it back through
+                    satisfied=False
+
+                if not satisfied:
+                    # update the guesses. The spectrum is refit once its
+                    # neighbours change
                     setattr(spectrum,'guesses_updated',guesses_updated,)
-                    newflag.append(spectrum)
+                    guesses[spectrum.index]=guesses_updated
+                    continue
+
+                if spectrum.index not in self.keygrid:
+                    refresh=True
+                self.accept_model(indiv_dict, spectrum, model, results)
+                if models is not indiv_dict:
+                    models.set_model(spectrum.index, model)
+                accepted.append([spectrum.index, model, results])
+                del numneighbours[spectrum.index]
+                queued.discard(spectrum.index)
+
+                # the flagged pixels neighbouring this one gain a non-flagged
+                # neighbour and are queued to be refit
+                xpos, ypos = spectrum.coordinates
+                for key in self.keygrid.containing(xpos, ypos, self.blocksize).tolist():
+                    if key in numneighbours:
+                        numneighbours[key]+=1
+                        heapq.heappush(queue, (-numneighbours[key], order, key))
+                        queued.add(key)
+                        order+=1
+
+            if getattr(models, 'maxparams', None)!=maxparams:
+                # workers forked before the resize cannot see the new arrays
+                refresh=True
+                maxparams=models.maxparams
+
+        return accepted, guesses
+
+    def get_window_flags(self, spectrum):
+        """
+        Returns the entries of flag_dict of a pixel and of its neighbours
+        """
+        keys=self.get_neighbours(spectrum.coordinates[0], spectrum.coordinates[1])
+        return {key: self.flag_dict[key] for key in keys[keys >= 0].tolist() if key in self.flag_dict}
 
-            # stopping criteria - will break out of the loop when the length of
-            # the flag and newflag lists are the same - indicating no more
-            # suitable fits have been identified
-            if len(newflag)==lenflag:
-                stop=True
-            else:
-                flag = newflag
-                lenflag=len(flag)
+    def accept_model(self, indiv_dict, spectrum, model, results):
+        """
+        Replaces the best-fitting model of a spectrum with a refit which
+        satisfies the flagging criteria
 
-        # Save the scouse object automatically
-        if scouseobject.autosave:
-            import pickle
-            if refitfile is not None:
-                if os.path.exists(scouseobject.outputdirectory+scouseobject.filename+'/stage_4/'+refitfile):
-                    os.rename(scouseobject.outputdirectory+scouseobject.filename+'/stage_4/'+refitfile,scouseobject.outputdirectory+scouseobject.filename+'/stage_4/'+refitfile+'.bk')
+        Parameters
+        ----------
+        indiv_dict : dictionary
+            dictionary containing best-fitting solutions of a scousepy
+            decomposition
+        spectrum : instance of scousepy's spectrum class
+        model : instance of scousepy's indivmodel class
+            the accepted model
+        results : list
+            the output of flagging_method for the accepted model
 
-                with open(scouseobject.outputdirectory+scouseobject.filename+'/stage_4/'+refitfile, 'wb') as fh:
-                    pickle.dump((scouseobject.completed_stages,scouseobject.check_spec_indices,indiv_dict), fh, protocol=proto)
-            else:
-                if os.path.exists(scouseobject.outputdirectory+scouseobject.filename+'/stage_4/s4.refit.scousepy'):
-                    os.rename(scouseobject.outputdirectory+scouseobject.filename+'/stage_4/s4.scousepy',scouseobject.outputdirectory+scouseobject.filename+'/stage_4/s4.refit.scousepy.bk')
+        """
+        from .model_housing import individual_spectrum
 
-                with open(scouseobject.outputdirectory+scouseobject.filename+'/stage_4/s4.refit.scousepy', 'wb') as fh:
-                    pickle.dump((scouseobject.completed_stages,scouseobject.check_spec_indices, indiv_dict), fh, protocol=proto)
+        if spectrum.model not in spectrum.model_from_parent:
+            spectrum.model_from_parent.append(spectrum.model)
 
+        setattr(spectrum, 'model', model)
+        if spectrum.index not in self.keygrid:
+            self.keygrid.add(spectrum.index)
+        if model.method=='spatial':
+            individual_spectrum.add_model(spectrum, model)
+        self.flag_dict[results[0]]={'flag':results[1], 'compflag': results[2], 'paramflag': results[3]}
+
+    def refit_tiles(self, indiv_dict, flag, tilesize):
+        """
+        Spatial refitting by tiles. The map is divided into tiles of tilesize x
+        tilesize pixels, and the flagged pixels of each tile are refit (see
+        refit_queue) independently and in parallel, using the models of the
+        pixels within the tile and a halo of blocksize//2 pixels around it as
+        they were at the start of the sweep. Each worker returns only its
+        accepted models and updated guesses, which are then applied to
+        indiv_dict. Flagged pixels whose neighbours in the halo of another
+        tile have changed are refit in the next sweep, until no more
+        satisfactory fits can be identified.
+
+        The workers are forked at the first sweep, and are kept for the
+        following sweeps unless the key grid changes. The spectra and flags
+        which have changed since are sent with the tasks of the tiles they
+        neighbour.
+
+        Parameters
+        ----------
+        indiv_dict : dictionary
+            dictionary containing best-fitting solutions of a scousepy
+            decomposition
+        flag : list
+            the keys of the flagged pixels
+        tilesize : int
+            size of the tiles in pixels
+
+        """
+        from .verbose_output import print_to_terminal
+
+        nx=self.cubeshape[2]
+        ntilesx=int(np.ceil(nx/tilesize))
+
+        ntilesy=int(np.ceil(self.cubeshape[1]/tilesize))
+        # number of tiles spanned by the halo
+        reach=int(np.ceil((self.blocksize//2)/tilesize))
+
+        def get_tile(key):
+            ypos, xpos = divmod(key, nx)
+            return (ypos//tilesize)*ntilesx+(xpos//tilesize)
+
+        def get_surrounding_tiles(tile):
+            ty, tx = divmod(tile, ntilesx)
+            return [y*ntilesx+x for y in range(max(ty-reach, 0), min(ty+reach+1, ntilesy))
+                                for x in range(max(tx-reach, 0), min(tx+reach+1, ntilesx))]
+
+        # the flagged pixels of each tile
+        tiles={}
+        for key in flag:
+            tiles.setdefault(get_tile(key), []).append(key)
+        pending=dict(tiles)
+        unflagged=self.get_unflagged_mask()
+        # the keys accepted in each tile since the workers were forked
+        updated={}
+
+        nsweep=0
+        refresh=True
+        while len(pending)!=0:
+            nsweep+=1
+            tilelist=sorted(pending)
+            tasks=[]
+            for tile in tilelist:
+                # the flagged spectra of the tile, with their current guesses,
+                # and the spectra accepted in and around the tile
+                keys=[key for surrounding in get_surrounding_tiles(tile) for key in updated.get(surrounding, [])]
+                spectra={key: indiv_dict[key] for key in tiles[tile]+keys}
+                flags={key: self.flag_dict[key] for key in keys}
+                numneighbours=self.count_unflagged_neighbours(tiles[tile], unflagged).tolist()
+                tasks.append([tiles[tile], pending[tile], numneighbours, spectra, flags])
+            # if njobs > 1 run in parallel else in series. The changes to
+            # indiv_dict and flag_dict since the workers were forked are sent
+            # with the tasks
+            executor=get_executor(self.njobs)
+            tileresults=executor.map(refit_tile_task, tasks, context=[self, indiv_dict],
+                                     verbose=False, refresh=refresh)
+            refresh=False
+
+            # apply the results of each tile
+            changed=[]
+            for tile, (accepted, guesses) in zip(tilelist, tileresults):
+                for key, guesses_updated in guesses.items():
+                    setattr(indiv_dict[key], 'guesses_updated', guesses_updated)
+                for key, model, results in accepted:
+                    if key not in self.keygrid:
+                        refresh=True
+                    self.accept_model(indiv_dict, indiv_dict[key], model, results)
+                    unflagged[key]=True
+                    changed.append(key)
+                    updated.setdefault(tile, []).append(key)
+                tiles[tile]=[key for key in tiles[tile] if not unflagged[key]]
+
+            # halo exchange: the flagged pixels whose neighbours in another tile
+            # have changed are refit in the next sweep
+            pending={}
+            for key in changed:
+                ypos, xpos = divmod(key, nx)
+                tile=get_tile(key)
+                for neighbour in self.keygrid.containing(xpos, ypos, self.blocksize).tolist():
+                    if (get_tile(neighbour)!=tile) and (neighbour in self.flag_dict) and not unflagged[neighbour]:
+                        pending.setdefault(get_tile(neighbour), set()).add(neighbour)
+            pending={tile:sorted(keys) for tile, keys in pending.items()}
+
+            if self.verbose:
+                print_to_terminal(stage='s4', step='refit',
+                                  var=[nsweep, len(tasks), len(changed)])
 
     def sortflag(self, flag, indiv_dict):
         """
@@ -298,19 +535,40 @@ class ScouseSpatial(object):
             decomposition
 
         """
-        numneighbours=[]
         flag = np.asarray(flag)
-        for index, spectrum in enumerate(flag):
-            # get the non-flagged neighbours
-            nfneighbours = self.get_non_flagged_neighbours(spectrum, indiv_dict)
-            numneighbours.append(np.size(nfneighbours))
+        if np.size(flag)==0:
+            return flag, np.zeros(0, dtype='int64')
+
+        indices=[spectrum.index for spectrum in flag]
+        numneighbours=self.count_unflagged_neighbours(indices, self.get_unflagged_mask())
 
-        numneighbours=np.asarray(numneighbours)
         sortedids = np.argsort(numneighbours)[::-1]
         sortedflag, sortednumneighbours=flag[sortedids], numneighbours[sortedids]
 
         return sortedflag, sortednumneighbours
 
+    def count_unflagged_neighbours(self, indices, unflagged):
+        """
+        Returns the number of non-flagged neighbours of each of a set of pixels
+
+        Parameters
+        ----------
+        indices : list
+            the flattened indices of the pixels
+        unflagged : ndarray
+            flattened mask of the non-flagged pixels (see get_unflagged_mask)
+
+        """
+        indices=np.asarray(indices, dtype='int64')
+        if np.size(indices)==0:
+            return np.zeros(0, dtype='int64')
+        # gather the neighbours of all pixels at once
+        ypos, xpos = np.divmod(indices, self.cubeshape[2])
+        keys=self.keygrid.window(xpos, ypos, self.blocksize)
+        # count those that are not themselves flagged
+        good=(keys >= 0) & (keys != indices[:,np.newaxis]) & unflagged[np.maximum(keys, 0)]
+        return np.sum(good, axis=1)
+
     def get_non_flagged_neighbours(self, spectrum, indiv_dict):
         """
         Method to identify the non-flagged neighbours surrounding a reference
@@ -326,18 +584,25 @@ class ScouseSpatial(object):
         # get the coordinates of the spectrum
         xpos=spectrum.coordinates[0]
         ypos=spectrum.coordinates[1]
-        # get the neighbours
+        # get the neighbours, excluding the spectrum itself
         keys=self.get_neighbours(xpos, ypos)
+        keys=keys[(keys >= 0) & (keys != spectrum.index)]
 
         # get a list of neighbour spectra that they themselves are not flagged
-        nfneighbours=[indiv_dict[key] for key in keys if key in indiv_dict.keys() and key in self.flag_dict and key is not np.nan and np.invert(np.any(self.flag_dict[key]['flag']))]
-        # check to see if the spectrum is in our neighbour list and remove it
-        if spectrum.index in [nfneighbour.index for nfneighbour in nfneighbours]:
-            idspec=np.where([(spectrum.index == nfneighbour.index) for nfneighbour in nfneighbours])[0]
-            del nfneighbours[idspec[0]]
+        nfneighbours=[indiv_dict[key] for key in keys.tolist() if key in self.flag_dict and np.invert(np.any(self.flag_dict[key]['flag']))]
 
         return nfneighbours
 
+    def get_unflagged_mask(self):
+        """
+        Returns a flattened mask of the pixels which have been through the
+        flagging and were not flagged
+        """
+        unflagged=np.zeros(int(np.prod(self.cubeshape[1:])), dtype='bool')
+        keys=[key for key, flags in self.flag_dict.items() if not np.any(flags['flag'])]
+        unflagged[np.asarray(keys, dtype='int64')]=True
+        return unflagged
+
     def check_model_bank(self, spectrum, fitncomps, indiv_dict):
         """
         Method used to search within scousepy's model bank to find alternative
@@ -475,23 +740,18 @@ class ScouseSpatial(object):
 
     def get_neighbours(self, xpos, ypos):
         """
-        Returns a list of flattened indices for a given spectrum and its neighbours
+        Returns an array of the keys of a given spectrum and its neighbours,
+        taken from the key grid. Pixels without a model, or outside the map,
+        are -1
 
         Parameters
         ----------
-        xpos : int
-            x position of the reference pixel
-        ypos : int
-            y position of the reference pixel
+        xpos : int or ndarray
+            x position of the reference pixel(s)
+        ypos : int or ndarray
+            y position of the reference pixel(s)
         """
-        shape=self.cubeshape[1:]
-        neighboursx=np.arange(xpos-(self.blocksize-1)/2,(xpos+(self.blocksize-1)/2)+1,dtype='int' )
-        neighboursx=[x if (x>=0) & (x<=shape[1]-1) else np.nan for x in neighboursx ]
-        neighboursy=np.arange(ypos-(self.blocksize-1)/2,(ypos+(self.blocksize-1)/2)+1,dtype='int' )
-        neighboursy=[y if (y>=0) & (y<=shape[0]-1) else np.nan for y in neighboursy ]
-        keys=[np.ravel_multi_index([y,x], shape)  if np.all(np.isfinite(np.asarray([y,x]))) else np.nan for y in neighboursy for x in neighboursx]
-
-        return keys
+        return self.keygrid.window(xpos, ypos, self.blocksize)
 
     def get_weights(self, spectrum, neighbours):
         """
@@ -505,33 +765,27 @@ class ScouseSpatial(object):
             A list of the neighbouring spectra
 
         """
-        # get the central coordinate
-        coord=spectrum.coordinates
-        # get the coordinates of the neighbours
-        neighbour_coords=np.asarray([neighbour.coordinates for neighbour in neighbours])
-        # compute the distances between the central pixel and the neighbours
-        distances=[np.linalg.norm(coord-neighbour_coord) for neighbour_coord in neighbour_coords]
-
-        # create a gaussian kernel of sigma=1 and size blocksize
-        from astropy.convolution import Gaussian2DKernel
-        gaussian_2D_kernel = Gaussian2DKernel(1, x_size=self.blocksize, y_size=self.blocksize)
-        # get the kernel values and normalise to the second highest value (highest is central pixel)
-        kernel_values=gaussian_2D_kernel.array/sorted(gaussian_2D_kernel.array.flatten())[-2]
-
-        # kernel centre coord
-        kernel_centre=np.asarray([self.blocksize//2, self.blocksize//2])
-        # get the kernel coords
-        kernel_coords=np.transpose(np.where(gaussian_2D_kernel.array))
-        # calculate the distances between the kernel centre and all other pixels in the kernel
-        kernel_distances=[np.linalg.norm(kernel_centre-kernel_coord) for kernel_coord in kernel_coords]
-
-        # get the weights associated with each coordinate
-        kernel_weights=[kernel_values[kernel_coords[i,0], kernel_coords[i,1]] for i in range(len(kernel_coords[:,0]))]
-
-        # tag the kernel weights to the distances of the neighbours in our data
-        weights=[kernel_weights[id] for id in np.asarray([np.where(kernel_distances==distance)[0][0] for distance in distances])]
-
-        return weights
+        # offsets of the neighbours from the central pixel
+        coords=np.asarray([neighbour.coordinates for neighbour in neighbours], dtype='int64').reshape(-1,2)
+        dx=coords[:,0]-int(spectrum.coordinates[0])
+        dy=coords[:,1]-int(spectrum.coordinates[1])
+
+        return list(self.get_offset_weights(dy, dx))
+
+    def get_offset_weights(self, dy, dx):
+        """
+        Returns the spatial weights of neighbours at given (y, x) offsets from
+        the reference pixel. The weights are taken from a 2D Gaussian kernel
+        which is computed once per blocksize
+
+        Parameters
+        ----------
+        dy, dx : ndarray
+            offsets of the neighbours
+
+        """
+        from .neighbours import get_offset_weights
+        return get_offset_weights(self.blocksize, dy, dx)
 
     def weighted_median(self, data, weights):
         """
@@ -550,8 +804,12 @@ class ScouseSpatial(object):
         data=np.asarray(data)
         weights=np.asarray(weights)
 
-        sorted_data, sorted_weights = map(np.array, zip(*sorted(zip(data, weights))))
+        # sort by data, then by weight
+        order=np.lexsort((weights, data))
+        sorted_data, sorted_weights = data[order], weights[order]
 
+        # the builtin sum adds the weights in turn. np.sum sums pairwise and
+        # can differ in the last bit, which changes the median at ties
         midpoint = 0.5 * sum(sorted_weights)
 
         if any(weights > midpoint):
@@ -935,14 +1193,11 @@ def flagging_method(input):
     # get the coordinates of the spectrum
     xpos=spectrum.coordinates[0]
     ypos=spectrum.coordinates[1]
-    # get the neighbours
+    # get the neighbours, excluding the spectrum itself
     keys=self.get_neighbours(xpos,ypos)
+    keys=keys[(keys >= 0) & (keys != spectrum.index)]
     # get a list of neighbour spectra
-    neighbours=[indiv_dict[key] for key in keys if key in indiv_dict.keys() and key is not np.nan and indiv_dict[key].model.ncomps != 0.0]
-    # check to see if the spectrum is in our neighbour list and remove it
-    if spectrum.index in [neighbour.index for neighbour in neighbours]:
-        idspec=np.where([(spectrum.index == neighbour.index) for neighbour in neighbours])[0]
-        del neighbours[idspec[0]]
+    neighbours=[indiv_dict[key] for key in keys.tolist() if indiv_dict[key].model.ncomps != 0.0]
 
     neighbours_ncomps=[neighbour.model.ncomps for neighbour in neighbours]
     # get weights
@@ -1003,6 +1258,63 @@ def flagging_method(input):
 
     return [spectrum.index, flag, compflag, paramflag]
 
+def flagging_task(input):
+    """
+    Flags the spectrum of a given pixel. Parallelised.
+
+    Parameters
+    ----------
+    input : list
+        list containing an instance of the ScouseSpatial class, an instance of
+        the SharedModels class, and the index of the pixel.
+    """
+    self, models, index = input
+    return flagging_method([self, models, models[index]])
+
+def refit_task(input):
+    """
+    Refits the spectrum of a given pixel. Parallelised.
+
+    Parameters
+    ----------
+    input : list
+        list containing an instance of the ScouseSpatial class, an instance of
+        the SharedModels class, and a list of the spectrum and the entries of
+        flag_dict of the pixel and its neighbours.
+    """
+    self, models, (spectrum, flags) = input
+    # the flags may have changed since the worker was forked
+    self.flag_dict.update(flags)
+    return decomposition_method([self, models, spectrum])
+
+def refit_tile_task(input):
+    """
+    Refits the flagged pixels of a tile. Parallelised. The task has no side
+    effects: the accepted models and updated guesses are returned and applied
+    by the parent once all tiles of a sweep have been refit
+
+    Parameters
+    ----------
+    input : list
+        list containing an instance of the ScouseSpatial class, the
+        indiv_dict, and a list of the keys of the flagged pixels of the tile,
+        the keys of those to be refit, their numbers of non-flagged
+        neighbours, and the spectra and entries of flag_dict which have
+        changed since the worker was forked.
+    """
+    from copy import copy, deepcopy
+    from collections import ChainMap
+
+    self, indiv_dict, (flag, pending, numneighbours, spectra, flags) = input
+    # the task runs in the parent itself if njobs is 1 (or a single tile is
+    # refit), so the refits are made against copies of the flagged spectra of
+    # the tile and a local layer over flag_dict
+    tileself=copy(self)
+    tileself.flag_dict=ChainMap({}, flags, self.flag_dict)
+    tiledict=ChainMap({key: deepcopy(spectra[key]) for key in flag}, spectra, indiv_dict)
+    return tileself.refit_queue(tiledict, tiledict, flag, pending=pending,
+                                numneighbours=numneighbours)
+
 def decomposition_method(input):
     """
     Method used for refitting the data
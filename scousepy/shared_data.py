@@ -0,0 +1,407 @@
+# Licensed under an MIT open source license - see LICENSE
+
+"""
+Shared-memory data plane for the parallel stages.
+
+Rather than shipping spectra, the scouse object or indiv_dict with each task,
+the data required by the workers are packed into numpy arrays held in shared
+memory. Tasks then only need to carry pixel indices.
+"""
+
+import numpy as np
+from collections.abc import Mapping
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # python < 3.8. Arrays are then inherited by forked workers instead.
+    shared_memory=None
+
+__all__ = ('SharedArray', 'MappedArray', 'SharedCube', 'SharedModels')
+
+class SharedArray(object):
+    """
+    A numpy array held in shared memory. Instances are pickled by reference so
+    that workers attach to the same block of memory instead of receiving a
+    copy of the data.
+
+    Parameters
+    ----------
+    shape : tuple
+        shape of the array
+    dtype : numpy dtype
+        data type of the array
+    fill_value : number, optional
+        initial value of the array elements
+
+    """
+    def __init__(self, shape, dtype='float64', fill_value=None):
+
+        self.shape=tuple(int(n) for n in np.atleast_1d(shape))
+        self.dtype=np.dtype(dtype)
+        self.shm=None
+        self.owner=True
+
+        nbytes=int(np.prod(self.shape))*self.dtype.itemsize
+        if (shared_memory is not None) and (nbytes > 0):
+            self.shm=shared_memory.SharedMemory(create=True, size=nbytes)
+            self.array=np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+        else:
+            self.array=np.empty(self.shape, dtype=self.dtype)
+
+        if fill_value is not None:
+            self.array.fill(fill_value)
+
+    def __repr__(self):
+        """
+        Return a nice printable format for the object.
+        """
+        return "<< scousepy shared array; shape={0}, dtype={1} >>".format(self.shape, self.dtype)
+
+    @classmethod
+    def from_array(cls, data):
+        """
+        Creates a shared copy of an array
+        """
+        data=np.asarray(data)
+        shared=cls(data.shape, dtype=data.dtype)
+        shared.array[...]=data
+        return shared
+
+    def __getstate__(self):
+        if self.shm is None:
+            return {'name': None, 'shape': self.shape, 'dtype': self.dtype.str,
+                    'array': self.array}
+        return {'name': self.shm.name, 'shape': self.shape, 'dtype': self.dtype.str}
+
+    def __setstate__(self, state):
+        self.shape=state['shape']
+        self.dtype=np.dtype(state['dtype'])
+        self.owner=False
+        if state['name'] is None:
+            self.shm=None
+            self.array=state['array']
+        else:
+            try:
+                # the block belongs to the parent process, which will unlink it
+                self.shm=shared_memory.SharedMemory(name=state['name'], track=False)
+            except TypeError:
+                # python < 3.13. Workers share the resource tracker of the
+                # parent so attaching again is harmless
+                self.shm=shared_memory.SharedMemory(name=state['name'])
+            self.array=np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+
+    def release(self):
+        """
+        Releases the shared memory. The block is freed once released by its
+        owner.
+        """
+        self.array=None
+        if self.shm is not None:
+            if self.owner:
+                self.shm.unlink()
+            try:
+                self.shm.close()
+            except BufferError:
+                # views of the array are still in use. The memory is freed
+                # once these are garbage collected
+                pass
+            self.shm=None
+
+class MappedArray(object):
+    """
+    A read-only array memory mapped from a .npy file. Provides the same
+    interface as SharedArray. Instances are pickled by filename so that
+    workers map the same file instead of receiving a copy of the data.
+
+    Parameters
+    ----------
+    filename : string
+        the .npy file
+
+    """
+    def __init__(self, filename):
+
+        self.filename=filename
+        self.array=np.load(filename, mmap_mode='r')
+        self.shape=self.array.shape
+        self.dtype=self.array.dtype
+
+    def __repr__(self):
+        """
+        Return a nice printable format for the object.
+        """
+        return "<< scousepy mapped array; shape={0}, dtype={1} >>".format(self.shape, self.dtype)
+
+    def __getstate__(self):
+        return {'filename': self.filename}
+
+    def __setstate__(self, state):
+        self.__init__(state['filename'])
+
+    def release(self):
+        """
+        Releases the memory map
+        """
+        self.array=None
+
+class SharedCube(object):
+    """
+    Holds the trimmed spectra and their rms values in shared memory. Where
+    available, the trimmed spectra of the cube cache are memory mapped instead
+    (see cube_cache.get_trimmed_spectra)
+
+    Parameters
+    ----------
+    scouseobject : Instance of the scousepy class
+    indices : ndarray, optional
+        flattened indices of the pixels to include. Default is all pixels
+    nchanblock : int
+        number of channels read from the cube at a time
+
+    """
+    def __init__(self, scouseobject, indices=None, nchanblock=64):
+        from .stage_1 import get_rms_map
+        from .model_housing import lookup_rms
+        from .cube_cache import get_trimmed_spectra, extract_spectra
+
+        cube=scouseobject.cube
+        self.shape=tuple(cube.shape[1:])
+        npix=int(np.prod(self.shape))
+        if indices is None:
+            self.indices=None
+            nrows=npix
+        else:
+            self.indices=SharedArray.from_array(np.unique(np.asarray(indices, dtype='int64')))
+            nrows=self.indices.shape[0]
+
+        # channels within vel_range
+        channels=np.where(scouseobject.trimids)[0]
+        nchan=np.size(channels)
+
+        filename=get_trimmed_spectra(scouseobject, nchanblock=nchanblock)
+        if filename is not None:
+            # the spectra of all pixels, indexed by pixel
+            self.mapped=True
+            self.spectra=MappedArray(filename)
+        else:
+            self.mapped=False
+            dtype=np.result_type(cube.unmasked_data[0:1,0:1,0:1].dtype, np.float32)
+            self.spectra=SharedArray((nrows, nchan), dtype=dtype)
+            extract_spectra(cube, indices=None if self.indices is None else self.indices.array,
+                            channels=channels, out=self.spectra.array, filled=False,
+                            nchanblock=nchanblock)
+
+        # the rms values as they would be assigned to individual spectra
+        get_rms_map(scouseobject)
+        pixels=np.arange(npix) if self.indices is None else self.indices.array
+        rms=lookup_rms(scouseobject, pixels)
+        if rms is None:
+            rms=np.full(nrows, scouseobject.rms_approx)
+        self.rms_values=SharedArray.from_array(np.asarray(rms, dtype='float64'))
+
+    def __repr__(self):
+        """
+        Return a nice printable format for the object.
+        """
+        return "<< scousepy shared cube; nspec={0} >>".format(self.rms_values.shape[0])
+
+    def row(self, index):
+        """
+        Returns the row of the data arrays corresponding to a given pixel
+        """
+        if self.indices is None:
+            return index
+        row=np.searchsorted(self.indices.array, index)
+        if (row >= self.indices.shape[0]) or (self.indices.array[row] != index):
+            raise KeyError(index)
+        return row
+
+    def spectrum(self, index):
+        """
+        Returns the trimmed spectrum of a given pixel
+        """
+        if self.mapped:
+            self.row(index)
+            return self.spectra.array[index]
+        return self.spectra.array[self.row(index)]
+
+    def get_spectra(self, indices):
+        """
+        Returns the trimmed spectra and the rms values of a list of pixels
+        """
+        rows=[self.row(index) for index in indices]
+        spectra=self.spectra.array[list(indices) if self.mapped else rows]
+        return spectra, self.rms_values.array[rows]
+
+    def rms(self, index):
+        """
+        Returns the rms of a given pixel
+        """
+        return self.rms_values.array[self.row(index)]
+
+    def release(self):
+        """
+        Releases the shared memory
+        """
+        for array in [self.spectra, self.rms_values, self.indices]:
+            if array is not None:
+                array.release()
+
+class SharedModels(Mapping):
+    """
+    A compact copy of the best-fitting models held in indiv_dict. Behaves like
+    a read-only indiv_dict: indexing with a pixel index returns a lightweight
+    spectrum exposing the index, coordinates and model (ncomps, params,
+    errors, parnames) of that pixel. It can therefore be used in place of
+    indiv_dict wherever only the best-fitting models are needed.
+
+    Parameters
+    ----------
+    indiv_dict : dictionary
+        dictionary of individual spectra
+    shape : tuple
+        the (y, x) shape of the map
+
+    """
+    def __init__(self, indiv_dict, shape):
+        from .result_store import ResultStore
+
+        self.shape=tuple(shape)
+        npix=int(np.prod(self.shape))
+
+        if isinstance(indiv_dict, ResultStore):
+            # the models are copied from the columns of the store
+            rows=np.flatnonzero(indiv_dict.has_model)
+            self.parnames=indiv_dict.parnames
+            ncomps=np.nan_to_num(indiv_dict.ncomps[rows]).astype('int64')
+            maxcomps=int(np.max(ncomps)) if np.size(ncomps)!=0 else 0
+        else:
+            models=[spectrum.model for spectrum in indiv_dict.values()
+                    if spectrum.model is not None]
+            self.parnames=None
+            for model in models:
+                if getattr(model, 'parnames', None) is not None:
+                    self.parnames=list(model.parnames)
+                    break
+            maxcomps=int(np.max([model.ncomps for model in models])) if len(models)!=0 else 0
+        nparams=1 if self.parnames is None else len(self.parnames)
+        maxcomps=max(maxcomps, 1)
+        self.maxparams=maxcomps*nparams
+
+        self.has_model=SharedArray(npix, dtype='bool', fill_value=False)
+        self.ncomps=SharedArray(npix, dtype='int32', fill_value=0)
+        self.params=SharedArray((npix, self.maxparams), dtype='float64', fill_value=np.nan)
+        self.errors=SharedArray((npix, self.maxparams), dtype='float64', fill_value=np.nan)
+
+        if isinstance(indiv_dict, ResultStore):
+            keys=indiv_dict.index[rows]
+            self.has_model.array[keys]=True
+            self.ncomps.array[keys]=ncomps
+            for name in ['params', 'errors']:
+                offsets, values = indiv_dict.get_parameters(rows, name=name)
+                # only the parameters of the ncomps components are used
+                lengths=np.minimum(np.diff(offsets), ncomps*nparams)
+                column=np.arange(np.sum(lengths))-np.repeat(np.cumsum(lengths)-lengths, lengths)
+                elements=np.repeat(offsets[:-1], lengths)+column
+                getattr(self, name).array[np.repeat(keys, lengths), column]=values[elements]
+        else:
+            for key, spectrum in indiv_dict.items():
+                if spectrum.model is not None:
+                    self.set_model(key, spectrum.model)
+
+    def __repr__(self):
+        """
+        Return a nice printable format for the object.
+        """
+        return "<< scousepy shared models; nspec={0} >>".format(len(self))
+
+    def set_model(self, index, model):
+        """
+        Updates the model of a given pixel
+        """
+        if (self.parnames is None) and (getattr(model, 'parnames', None) is not None):
+            self.parnames=list(model.parnames)
+        n=int(model.ncomps)*(1 if self.parnames is None else len(self.parnames))
+        if n > self.maxparams:
+            self._resize(n)
+        self.has_model.array[index]=True
+        self.ncomps.array[index]=model.ncomps
+        self.params.array[index]=np.nan
+        self.errors.array[index]=np.nan
+        if n > 0:
+            self.params.array[index,:n]=np.asarray(model.params, dtype='float64')[:n]
+            self.errors.array[index,:n]=np.asarray(model.errors, dtype='float64')[:n]
+
+    def _resize(self, maxparams):
+        """
+        Enlarges the parameter arrays. Workers forked before the resize will
+        not see the new arrays.
+        """
+        for name in ['params', 'errors']:
+            old=getattr(self, name)
+            new=SharedArray((old.shape[0], maxparams), dtype='float64', fill_value=np.nan)
+            new.array[:,:self.maxparams]=old.array
+            old.release()
+            setattr(self, name, new)
+        self.maxparams=maxparams
+
+    def _check_key(self, key):
+        try:
+            index=int(key)
+        except (TypeError, ValueError):
+            return None
+        if (index < 0) or (index >= self.has_model.shape[0]) or (index != key):
+            return None
+        return index
+
+    def __contains__(self, key):
+        index=self._check_key(key)
+        return (index is not None) and bool(self.has_model.array[index])
+
+    def __getitem__(self, key):
+        index=self._check_key(key)
+        if (index is None) or (not self.has_model.array[index]):
+            raise KeyError(key)
+        ncomps=int(self.ncomps.array[index])
+        n=ncomps*(1 if self.parnames is None else len(self.parnames))
+        model=_CompactModel(ncomps, self.params.array[index,:n],
+                            self.errors.array[index,:n], self.parnames)
+        y, x=np.unravel_index(index, self.shape)
+        return _CompactSpectrum(index, np.array([x, y]), model)
+
+    def __iter__(self):
+        return iter(np.flatnonzero(self.has_model.array).tolist())
+
+    def __len__(self):
+        return int(np.count_nonzero(self.has_model.array))
+
+    def release(self):
+        """
+        Releases the shared memory
+        """
+        for array in [self.has_model, self.ncomps, self.params, self.errors]:
+            array.release()
+
+class _CompactSpectrum(object):
+    """
+    Lightweight stand-in for individual_spectrum returned by SharedModels
+    """
+    __slots__ = ('index', 'coordinates', 'model')
+
+    def __init__(self, index, coordinates, model):
+        self.index=index
+        self.coordinates=coordinates
+        self.model=model
+
+class _CompactModel(object):
+    """
+    Lightweight stand-in for indivmodel returned by SharedModels
+    """
+    __slots__ = ('ncomps', 'params', 'errors', 'parnames')
+
+    def __init__(self, ncomps, params, errors, parnames):
+        self.ncomps=ncomps
+        self.params=params
+        self.errors=errors
+        self.parnames=parnames
@@ -5,7 +5,7 @@ import sys
 from astropy.stats import mad_std
 
 from .io import *
-from .parallel_map import *
+from .executor import get_executor
 
 def compute_noise(scouseobject):
     """
@@ -100,6 +100,167 @@ def calc_rms(spectrum):
 
     return rms
 
+def get_noise_params(scouseobject):
+    """
+    Returns the keyword arguments passed to the noise estimator
+    """
+    noise_params=getattr(scouseobject, 'noise_params', None)
+    if noise_params is None:
+        return {}
+    return dict(noise_params)
+
+def get_rms_map_key(scouseobject):
+    """
+    Generates a key identifying the inputs to the rms map, namely the cube, the
+    velocity range and the noise parameters. If any of these change, the key
+    changes and the rms map is recomputed.
+
+    Parameters
+    ----------
+    scouseobject : Instance of the scousepy class
+
+    Returns
+    -------
+    key : string
+        md5 checksum of the inputs. None if the cube is not loaded
+
+    """
+    import os
+    import hashlib
+
+    cube=scouseobject.cube
+    if cube is None:
+        return None
+
+    md5=hashlib.md5()
+    md5.update(repr(cube.shape).encode())
+    md5.update(cube.header.tostring().encode())
+    md5.update(np.asarray(cube.spectral_axis.value).tobytes())
+    if (scouseobject.datadirectory is not None) and (scouseobject.filename is not None):
+        fitsfile=os.path.join(scouseobject.datadirectory, scouseobject.filename+'.fits')
+        if os.path.exists(fitsfile):
+            md5.update(repr(os.path.getmtime(fitsfile)).encode())
+    md5.update(repr(scouseobject.vel_range).encode())
+    md5.update(repr(sorted(get_noise_params(scouseobject).items())).encode())
+    # the rms is measured from cube[:, y, x].value, i.e. without the mask
+    md5.update(b'unmasked')
+    return md5.hexdigest()
+
+def get_rms_map(scouseobject):
+    """
+    Returns the rms map, computing it if it does not yet exist or if it is no
+    longer valid for the current cube, velocity range and noise parameters
+
+    Parameters
+    ----------
+    scouseobject : Instance of the scousepy class
+
+    Returns
+    -------
+    rms_map : ndarray
+        2D map of the rms noise. Pixels for which the noise could not be
+        determined are nan
+
+    """
+    key=get_rms_map_key(scouseobject)
+    if key is None:
+        # the cube is not available so we cannot check the map
+        return getattr(scouseobject, 'rms_map', None)
+
+    if (getattr(scouseobject, 'rms_map', None) is None) or \
+       (getattr(scouseobject, 'rms_map_key', None)!=key):
+        scouseobject.rms_map=compute_rms_map(scouseobject)
+        scouseobject.rms_map_key=key
+
+    return scouseobject.rms_map
+
+def compute_rms_map(scouseobject, tilesize=16384):
+    """
+    Computes the rms of every spectrum in the cube. The map is divided into
+    tiles of rows which are processed in parallel.
+
+    Parameters
+    ----------
+    scouseobject : Instance of the scousepy class
+    tilesize : int
+        Approximate number of spectra in each tile
+
+    Returns
+    -------
+    rms_map : ndarray
+        2D map of the rms noise
+
+    """
+    ny, nx=scouseobject.cube.shape[1:]
+    nrows=int(np.clip(tilesize//max(nx, 1), 1, ny))
+    inputs=[[y0, min(y0+nrows, ny)] for y0 in range(0, ny, nrows)]
+
+    njobs=getattr(scouseobject, 'njobs', None)
+    executor=get_executor(njobs if njobs is not None else 1)
+    tiles=executor.map(compute_rms_tile, inputs, context=[scouseobject])
+
+    return np.concatenate([np.asarray(tile, dtype='float64') for tile in tiles], axis=0)
+
+def compute_rms_tile(input):
+    """
+    Computes the rms of the spectra in rows y0 to y1 of the cube. Parallelised.
+
+    Parameters
+    ----------
+    input : list
+        contains the scouseobject and the first and last (exclusive) rows of
+        the tile
+
+    """
+    from scousepy.noisy import getnoise_batch
+
+    scouseobject, (y0, y1) = input
+    # the unmasked data, as used for the rms of the individual spectra
+    data=scouseobject.cube.unmasked_data[:, y0:y1, :].value
+    nchan, ny, nx=data.shape
+    spectra=data.reshape(nchan, ny*nx).T
+    rms=getnoise_batch(scouseobject.x, spectra, **get_noise_params(scouseobject))
+    return rms.reshape(ny, nx)
+
+def save_rms_map(scouseobject, s1dir):
+    """
+    Writes the rms map and its key to the stage 1 directory
+
+    Parameters
+    ----------
+    scouseobject : Instance of the scousepy class
+    s1dir : string
+        stage 1 output directory
+
+    """
+    import os
+    if getattr(scouseobject, 'rms_map', None) is None:
+        return
+    np.savez(os.path.join(s1dir, 'rms_map.npz'), rms_map=scouseobject.rms_map,
+             key=str(scouseobject.rms_map_key))
+
+def load_rms_map(scouseobject, s1dir):
+    """
+    Reads the rms map from the stage 1 directory. Its validity is checked
+    against the cube when it is next requested via get_rms_map.
+
+    Parameters
+    ----------
+    scouseobject : Instance of the scousepy class
+    s1dir : string
+        stage 1 output directory
+
+    """
+    import os
+    fn=os.path.join(s1dir, 'rms_map.npz')
+    if os.path.exists(fn):
+        with np.load(fn) as data:
+            scouseobject.rms_map=data['rms_map']
+            scouseobject.rms_map_key=str(data['key'])
+    else:
+        scouseobject.rms_map=None
+        scouseobject.rms_map_key=None
+
 def map_locations(shape):
     """
     Returns the pixel locations for all pixels in a map
@@ -139,14 +300,22 @@ def generate_SAAs(scouseobject, coverageobject):
     scouseobject : Instance of the scousepy class
     coverage object : Instance of the ScouseCoverage class
 
+    Notes
+    -----
+    The SAA footprints are established from a small window of pixels around
+    each SAA rather than the full map. The averaged spectra are then extracted
+    from summed-area tables of the cube (see compute_saa_spectra) such that the
+    cost of each spectrum is independent of the size of the SAA.
+
     """
-    from tqdm import tqdm
     from .verbose_output import print_to_terminal
+    from .model_housing import saa, SpectrumReference, register_spectrum_source, get_saa_source
 
-    # get the locations of all pixels in the map
-    maploc=map_locations((np.shape(coverageobject.moments[6])[0],np.shape(coverageobject.moments[6])[1]))
+    momentmask=coverageobject.moments[6]
+    cubeshape=scouseobject.cube.shape
 
     scouseobject.lenspec=0.0
+    scouseobject.saa_spectra={} if scouseobject.reference_mode else None
     for i, w in enumerate(coverageobject.wsaa, start=0):
         # Create individual dictionaries for each wsaa
         scouseobject.saa_dict[i] = {}
@@ -155,23 +324,34 @@ def generate_SAAs(scouseobject, coverageobject):
         if scouseobject.verbose:
             progress_bar = print_to_terminal(stage='s1', step='coverage', var=w)
 
-        inputlist=[[j]+[w, maploc, coverage, coverageobject.moments[6], scouseobject] for j in range(len(coverage[:,0]))]
-
-        if scouseobject.njobs > 1:
-            # if __name__ == 'scousepy.stage_1':
-            #     print(__name__)
-                results = list(parallel_map(create_saa, inputlist, numcores=scouseobject.njobs, verbose=scouseobject.verbose))
-        else:
-            if scouseobject.verbose:
-                results=[create_saa(input) for input in tqdm(inputlist)]
-            else:
-                results=[create_saa(input) for input in inputlist]
+        # get the pixels contained within each SAA and their bounding boxes
+        indices, boxes = get_saa_footprints(coverage, w, momentmask, cubeshape[1:],
+                                            scouseobject.x_range, scouseobject.y_range)
+        # generate all of the averaged spectra in one go
+        saaspectra = compute_saa_spectra(scouseobject.cube, boxes)
+        if scouseobject.reference_mode:
+            # the SAAs refer to the rows of a single array
+            scouseobject.saa_spectra[i]=saaspectra
+            register_spectrum_source(get_saa_source(scouseobject, i), saaspectra)
 
         if scouseobject.verbose:
             progress_bar = print_to_terminal(stage='s1', step='coverageend', length=len(coverage[:,0]),var=w)
 
         for j in range(len(coverage[:,0])):
-            SAA=results[j]
+            if coverage[j,2]==1:
+                to_be_fit=True
+            else:
+                to_be_fit=False
+
+            if scouseobject.reference_mode:
+                spectrum=SpectrumReference(get_saa_source(scouseobject, i), j)
+            else:
+                spectrum=saaspectra[j,:]
+
+            # generate the SAA
+            SAA = saa(np.array([coverage[j,0],coverage[j,1]]), spectrum, index=j, to_be_fit=to_be_fit, scouseobject=scouseobject)
+            # add the locations of the unmasked data
+            SAA.add_indices(indices[j], cubeshape[1:])
             scouseobject.saa_dict[i][j] = SAA
 
             if SAA.to_be_fit:
@@ -183,6 +363,339 @@ def generate_SAAs(scouseobject, coverageobject):
         if scouseobject.verbose:
             progress_bar.close()
 
+def get_saa_footprints(coverage, wsaa, momentmask, shape, x_range, y_range):
+    """
+    Returns the indices of the pixels contained within each SAA together with
+    the bounding box of those pixels. Equivalent to generate_saamask followed by
+    generate_cubemask but only the pixels in the vicinity of each SAA are
+    tested against the SAA path.
+
+    Parameters
+    ----------
+    coverage : ndarray
+        the coverage array
+    wsaa : number
+        size of the SAA
+    momentmask : ndarray
+        a mask of the moment 0 map
+    shape : tuple
+        the (y, x) shape of the cube
+    x_range : list
+        range in x pixels after trimming during coverage
+    y_range : list
+        range in y pixels after trimming during coverage
+
+    Returns
+    -------
+    indices : list
+        A list of (N, 2) arrays containing the (y, x) indices of the pixels
+        within each SAA. Ordered as in create_saa.
+    boxes : ndarray
+        An (nsaa, 4) array containing the bounding box of each SAA in the
+        form [ymin, ymax+1, xmin, xmax+1]. Empty SAAs are given a box of -1.
+
+    """
+    import matplotlib.patches as patches
+    import matplotlib.path as path
+
+    momentmask=np.asarray(momentmask).astype('bool')
+    # offsets required to embed the moment mask within the cube
+    newx0=np.min(x_range)
+    newy0=np.min(y_range)
+    # the cube may be smaller than the moment map at the edges
+    ylim=min(momentmask.shape[0], shape[0]-newy0)
+    xlim=min(momentmask.shape[1], shape[1]-newx0)
+
+    indices=[]
+    boxes=np.full((len(coverage[:,0]), 4), -1, dtype='int')
+    for j in range(len(coverage[:,0])):
+        # Identify the bottom left corner of the SAA.
+        bl=(coverage[j,0]-wsaa/2., coverage[j,1]-wsaa/2.)
+        # create a patch and obtain the path
+        saapatch=patches.Rectangle(bl,wsaa,wsaa)
+        saapath=path.Path(saapatch.get_verts(),closed=True)
+
+        # a window of pixels that safely encloses the SAA
+        x0=max(int(np.floor(bl[0]))-1, 0)
+        x1=min(int(np.ceil(bl[0]+wsaa))+2, xlim)
+        y0=max(int(np.floor(bl[1]))-1, 0)
+        y1=min(int(np.ceil(bl[1]+wsaa))+2, ylim)
+
+        if (x1<=x0) or (y1<=y0):
+            indices.append(np.empty((0,2), dtype='int'))
+            continue
+
+        _xx,_yy=np.meshgrid(np.arange(x0,x1),np.arange(y0,y1))
+        locations=np.array([np.ravel(_xx),np.ravel(_yy)]).T
+        localmask=np.reshape(saapath.contains_points(locations), _xx.shape)
+        localmask&=momentmask[y0:y1,x0:x1]
+
+        # np.where on the transpose preserves the x-major ordering of
+        # map_locations_unmasked
+        idx,idy=np.where(localmask.T)
+        idx=idx+x0+newx0
+        idy=idy+y0+newy0
+        indices.append(np.vstack((idy,idx)).T)
+
+        if np.size(idx)!=0:
+            boxes[j,:]=[np.min(idy), np.max(idy)+1, np.min(idx), np.max(idx)+1]
+
+    return indices, boxes
+
+def summed_area_table(data):
+    """
+    Returns the summed-area table (integral image) of each channel of a cube,
+    padded with a leading row and column of zeros such that the sum over
+    data[:, y0:y1, x0:x1] is given by
+
+        sat[:,y1,x1] - sat[:,y0,x1] - sat[:,y1,x0] + sat[:,y0,x0]
+
+    Parameters
+    ----------
+    data : ndarray
+        A (nchan, ny, nx) array
+
+    """
+    if data.dtype==bool:
+        dtype='int64'
+    else:
+        dtype='float64'
+    sat=np.zeros((data.shape[0], data.shape[1]+1, data.shape[2]+1), dtype=dtype)
+    np.cumsum(data, axis=1, dtype=dtype, out=sat[:,1:,1:])
+    np.cumsum(sat[:,1:,1:], axis=2, out=sat[:,1:,1:])
+    return sat
+
+def compute_saa_spectra(cube, boxes, nchanblock=64):
+    """
+    Computes the average spectrum within the bounding box of each SAA using
+    summed-area tables of the NaN-filled data and of the number of finite
+    pixels. This is equivalent to taking the nanmean over the sub-cube defined
+    by each box. The cube is processed in blocks of channels to limit memory
+    usage.
+
+    Parameters
+    ----------
+    cube : spectral cube
+    boxes : ndarray
+        An (nsaa, 4) array containing the boxes output from get_saa_footprints
+    nchanblock : int
+        number of channels processed at once
+
+    Returns
+    -------
+    spectra : ndarray
+        An (nsaa, nchan) array of averaged spectra. Empty SAAs are NaN
+
+    """
+    nchan=cube.shape[0]
+    valid=boxes[:,0]>=0
+    y0,y1,x0,x1=boxes[valid].T
+
+    spectra=None
+    for c0 in range(0, nchan, nchanblock):
+        block=np.asarray(cube.filled_data[c0:c0+nchanblock].value)
+        if spectra is None:
+            # retain the precision of the data as np.nanmean would
+            if np.issubdtype(block.dtype, np.floating):
+                dtype=block.dtype
+            else:
+                dtype='float64'
+            spectra=np.full((np.shape(boxes)[0], nchan), np.nan, dtype=dtype)
+
+        finite=np.isfinite(block)
+        sat=summed_area_table(np.where(finite, block, 0.0))
+        total=sat[:,y1,x1]-sat[:,y0,x1]-sat[:,y1,x0]+sat[:,y0,x0]
+        sat=summed_area_table(finite)
+        npix=sat[:,y1,x1]-sat[:,y0,x1]-sat[:,y1,x0]+sat[:,y0,x0]
+        del sat
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean=np.where(npix>0, total/npix, np.nan)
+        spectra[valid, c0:c0+np.shape(block)[0]]=mean.T
+
+    return spectra
+
+def build_saa_membership(saa_dict, shape):
+    """
+    Builds a sparse matrix describing which pixels are contained within each
+    SAA of a given saa_dict (i.e. a single wsaa). Row j of the matrix holds
+    the flattened indices of the pixels in the SAA with index j, stored in the
+    same order as SAA.indices_flat.
+
+    Parameters
+    ----------
+    saa_dict : dictionary
+        dictionary of SAAs for a single wsaa
+    shape : tuple
+        the (y, x) shape of the cube
+
+    Returns
+    -------
+    membership : scipy.sparse.csr_matrix
+        An (nsaa, npix) membership matrix
+
+    """
+    from scipy.sparse import csr_matrix
+
+    if len(saa_dict)==0:
+        nsaa=0
+    else:
+        nsaa=int(np.max([SAA.index for SAA in saa_dict.values()]))+1
+
+    counts=np.zeros(nsaa, dtype='int64')
+    for SAA in saa_dict.values():
+        counts[SAA.index]=np.size(SAA.indices_flat)
+    indptr=np.concatenate(([0], np.cumsum(counts)))
+
+    indices=np.empty(indptr[-1], dtype='int64')
+    for SAA in saa_dict.values():
+        indices[indptr[SAA.index]:indptr[SAA.index+1]]=SAA.indices_flat
+
+    data=np.ones(np.size(indices), dtype='int8')
+    return csr_matrix((data, indices, indptr), shape=(nsaa, int(np.prod(shape))))
+
+def get_saa_membership(scouseobject):
+    """
+    Returns the membership matrices for each wsaa, building them from the
+    saa_dict if they have not already been generated or loaded from disk
+
+    Parameters
+    ----------
+    scouseobject : Instance of the scousepy class
+
+    Returns
+    -------
+    saa_membership : dictionary
+        A dictionary of (nsaa, npix) membership matrices, one per wsaa
+
+    """
+    if getattr(scouseobject, 'saa_membership', None) is None:
+        shape=get_map_shape(scouseobject)
+        scouseobject.saa_membership={key: build_saa_membership(saa_dict, shape)
+                                     for key, saa_dict in scouseobject.saa_dict.items()}
+
+    return scouseobject.saa_membership
+
+def get_map_shape(scouseobject):
+    """
+    Returns the (y, x) shape of the map without needing the cube to be loaded
+    """
+    if scouseobject.cube is not None:
+        return scouseobject.cube.shape[1:]
+    for saa_dict in scouseobject.saa_dict.values():
+        for SAA in saa_dict.values():
+            if getattr(SAA, 'indices_shape', None) is not None:
+                return SAA.indices_shape
+    raise ValueError("Could not determine the shape of the map.")
+
+def save_saa_membership(scouseobject, s1path):
+    """
+    Writes the membership matrices next to a stage 1 output file
+
+    Parameters
+    ----------
+    scouseobject : Instance of the scousepy class
+    s1path : string
+        path to the stage 1 output file
+
+    """
+    from scipy.sparse import save_npz
+    for key, membership in get_saa_membership(scouseobject).items():
+        save_npz(get_membership_filename(s1path, key), membership)
+
+def load_saa_membership(scouseobject, s1path):
+    """
+    Reads the membership matrices written alongside a stage 1 output file. If
+    they are not available, or do not match the saa_dict (number of SAAs and
+    shape of the map), they will be regenerated when first requested.
+
+    Parameters
+    ----------
+    scouseobject : Instance of the scousepy class
+    s1path : string
+        path to the stage 1 output file
+
+    """
+    import os
+    from scipy.sparse import load_npz
+
+    scouseobject.saa_membership=None
+
+    try:
+        npix=int(np.prod(get_map_shape(scouseobject)))
+    except ValueError:
+        npix=None
+
+    saa_membership={}
+    for key, saa_dict in scouseobject.saa_dict.items():
+        fn=get_membership_filename(s1path, key)
+        if not os.path.exists(fn):
+            return
+        membership=load_npz(fn).tocsr()
+        nsaa=int(np.max([SAA.index for SAA in saa_dict.values()]))+1 if len(saa_dict)!=0 else 0
+        if (membership.shape[0]!=nsaa) or ((npix is not None) and (membership.shape[1]!=npix)):
+            # written for a different set of SAAs or a different map
+            return
+        saa_membership[key]=membership
+    scouseobject.saa_membership=saa_membership
+
+def save_saa_spectra(scouseobject, s1path):
+    """
+    Writes the SAA spectra of reference mode next to a stage 1 output file
+
+    Parameters
+    ----------
+    scouseobject : Instance of the scousepy class
+    s1path : string
+        path to the stage 1 output file
+
+    """
+    if scouseobject.saa_spectra is None:
+        return
+    for key, spectra in scouseobject.saa_spectra.items():
+        np.save(get_saa_spectra_filename(s1path, key), spectra)
+
+def load_saa_spectra(scouseobject, s1path):
+    """
+    Reads the SAA spectra written alongside a stage 1 output file in reference
+    mode. The spectra are memory mapped rather than read in full.
+
+    Parameters
+    ----------
+    scouseobject : Instance of the scousepy class
+    s1path : string
+        path to the stage 1 output file
+
+    """
+    import os
+    from .model_housing import register_spectrum_source, get_saa_source
+
+    scouseobject.saa_spectra=None
+
+    saa_spectra={}
+    for key in scouseobject.saa_dict.keys():
+        fn=get_saa_spectra_filename(s1path, key)
+        if not os.path.exists(fn):
+            continue
+        saa_spectra[key]=np.load(fn, mmap_mode='r')
+        register_spectrum_source(get_saa_source(scouseobject, key), saa_spectra[key])
+    if len(saa_spectra)!=0:
+        scouseobject.saa_spectra=saa_spectra
+
+def get_saa_spectra_filename(s1path, key):
+    """
+    Filename of the SAA spectra for a given wsaa
+    """
+    import os
+    return os.path.splitext(s1path)[0]+'.saa_spectra_'+str(key)+'.npy'
+
+def get_membership_filename(s1path, key):
+    """
+    Filename of the membership matrix for a given wsaa
+    """
+    import os
+    return os.path.splitext(s1path)[0]+'.membership_'+str(key)+'.npz'
+
 def create_saa(input):
     """
     Method used to create a spectral averaging area. Parallelised.
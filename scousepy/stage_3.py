@@ -2,7 +2,7 @@
 
 import numpy as np
 import sys
-from .parallel_map import *
+from .executor import get_executor
 
 def initialise_fitting(scouseobject):
     """
@@ -20,49 +20,85 @@ def initialise_fitting(scouseobject):
     -------
         A list of all spectra to be fit
 
+    Notes
+    -----
+    Unless running in reference mode, the spectra of all of the pixels to be
+    fit are extracted from the cube in bulk (see cube_cache.extract_spectra).
+    Pixels shared by several SAAs share the same spectrum.
+
     """
-    from .model_housing import individual_spectrum
+    from .model_housing import individual_spectrum, lookup_rms, SpectrumReference, get_cube_source
     from .verbose_output import print_to_terminal
+    from .stage_1 import get_saa_membership, get_rms_map
+    from .cube_cache import extract_spectra
     import time
 
-    if scouseobject.verbose:
-        progress_bar = print_to_terminal(stage='s3', step='init',length=scouseobject.lenspec)
-
     # create the list that will contain all of the spectra
     indivspec_list=[]
     # generate a template spectrum for the fitter
     template=gen_template(scouseobject)
-    # begin by looping through the SAA dictionaries
+    # make sure the rms map is up to date
+    get_rms_map(scouseobject)
+    # pixel membership of each SAA
+    saa_membership=get_saa_membership(scouseobject)
+    shape=scouseobject.cube.shape[1:]
+
+    # get the indices of the pixels contained within the SAAs to be fit
+    saas=[]
     for i in range(len(scouseobject.wsaa)):
-        saa_dict=scouseobject.saa_dict[i]
-
-        # loop over the items in the dictionary
-        for j, SAA in saa_dict.items():
-            # determine whether the SAA is to be fit or not
+        membership=saa_membership[i]
+        for j, SAA in scouseobject.saa_dict[i].items():
             if SAA.to_be_fit:
-                # get the indices of the pixels contained within the SAA
-                indices=SAA.indices
-                indices_flat=SAA.indices_flat
-
-                # loop over these and for each one create an instance of the
-                # individual_spectrum class
-                for k in range(len(indices_flat)):
-                    # parameters for the individual_spectrum class
-                    index=indices_flat[k]
-                    coordinates=np.array([indices[k,1],indices[k,0]])
-                    spectrum=scouseobject.cube[:,indices[k,0],indices[k,1]].value
-                    # create the spectrum
-                    indivspec=individual_spectrum(coordinates,spectrum,index=index,
-                                        scouseobject=scouseobject, saa_dict_index=i,
-                                        saaindex=SAA.index)
-
-                    # add the template
-                    setattr(indivspec, 'template', template)
-                    setattr(indivspec, 'guesses_from_parent', SAA.model.params)
-                    # append the model to the list
-                    indivspec_list.append(indivspec)
-                    if scouseobject.verbose:
-                        progress_bar.update()
+                indices_flat=membership.indices[membership.indptr[SAA.index]:membership.indptr[SAA.index+1]]
+                saas.append((i, SAA, indices_flat))
+
+    if not scouseobject.reference_mode:
+        # extract the spectra of all of these pixels in one go. The pixels are
+        # sorted such that the cube is read in memory order
+        starttime=time.time()
+        if len(saas)!=0:
+            pixels=np.unique(np.concatenate([indices_flat for i, SAA, indices_flat in saas]))
+        else:
+            pixels=np.zeros(0, dtype='int')
+        spectra=extract_spectra(scouseobject.cube, indices=pixels, filled=False)
+        endtime=time.time()
+        if scouseobject.verbose:
+            progress_bar = print_to_terminal(stage='s3', step='extract',
+                                             length=np.size(pixels),
+                                             t1=starttime, t2=endtime)
+
+    if scouseobject.verbose:
+        progress_bar = print_to_terminal(stage='s3', step='init',length=scouseobject.lenspec)
+
+    for i, SAA, indices_flat in saas:
+        indices=np.transpose(np.unravel_index(indices_flat, shape))
+        # look up the noise of each spectrum
+        rms=lookup_rms(scouseobject, indices_flat)
+        if not scouseobject.reference_mode:
+            rows=np.searchsorted(pixels, indices_flat)
+
+        # loop over these and for each one create an instance of the
+        # individual_spectrum class
+        for k in range(len(indices_flat)):
+            # parameters for the individual_spectrum class
+            index=indices_flat[k]
+            coordinates=np.array([indices[k,1],indices[k,0]])
+            if scouseobject.reference_mode:
+                spectrum=SpectrumReference(get_cube_source(scouseobject), index)
+            else:
+                spectrum=spectra[rows[k]]
+            # create the spectrum
+            indivspec=individual_spectrum(coordinates,spectrum,index=index,
+                                scouseobject=scouseobject, saa_dict_index=i,
+                                saaindex=SAA.index, rms=rms[k])
+
+            # add the template
+            setattr(indivspec, 'template', template)
+            setattr(indivspec, 'guesses_from_parent', SAA.model.params)
+            # append the model to the list
+            indivspec_list.append(indivspec)
+            if scouseobject.verbose:
+                progress_bar.update()
 
     if scouseobject.verbose:
         progress_bar.close()
@@ -113,68 +149,255 @@ def autonomous_decomposition(scouseobject, indivspec_list):
 
     Returns
     -------
-        list of modelled spectra
+        list of modelled spectra. Spectra which were scheduled more than once
+        with the same guesses are only fit once and share the result
 
     """
-    from tqdm import tqdm
-    from .model_housing import individual_spectrum
     from .verbose_output import print_to_terminal
+    from .shared_data import SharedCube
 
     indivspec_list_completed=[]
     
     if scouseobject.verbose:
         progress_bar = print_to_terminal(stage='s3', step='fitinit')
 
-    global scouseobjectlist
-    scouseobjectlist=[scouseobject.xtrim,scouseobject.trimids,scouseobject.fittype,
-                      scouseobject.tol,scouseobject.cube.header['CDELT3']]
+    if len(indivspec_list)==0:
+        return indivspec_list_completed
 
-    # loop over the list of spectra removing elements along the way as they
-    # are successfully modelled.
+    # pixels covered by several SAAs are often scheduled with identical
+    # guesses. These are only fit once.
+    unique_list, fitids = deduplicate_fits(indivspec_list, scouseobject.fittype,
+                                           scouseobject.tol)
+    if scouseobject.verbose:
+        progress_bar = print_to_terminal(stage='s3', step='dedup',
+                                         length=len(indivspec_list),
+                                         var=len(indivspec_list)-len(unique_list))
+
+    # the spectra and their rms values are placed in shared memory so that
+    # only pixel indices and guesses need to be sent to the workers
+    sharedcube=SharedCube(scouseobject, indices=[indivspec.index for indivspec in unique_list])
+
+    # information common to all spectra. The template is shared by all spectra
+    # and so is passed here rather than with each spectrum
+    template=indivspec_list[0].template
+    scouseobjectlist=[scouseobject.xtrim,scouseobject.fittype,scouseobject.tol,
+                      scouseobject.cube.header['CDELT3'],template,sharedcube]
+    for indivspec in indivspec_list:
+        setattr(indivspec,'template',None)
+
+    # the session pool of workers
+    executor=get_executor(scouseobject.njobs)
+
+    # the native fitter fits stacks of spectra simultaneously
+    native=get_backend(scouseobject)=='native'
+
+    try:
+        _decompose(scouseobject, unique_list, executor, scouseobjectlist,
+                   native=native)
+    finally:
+        sharedcube.release()
+
+    # duplicates inherit the outcome of the fit
+    for indivspec, j in zip(indivspec_list, fitids):
+        fitted=unique_list[j]
+        if indivspec is not fitted:
+            add_decomposition_result(indivspec, [fitted.model_from_parent,
+                                                 fitted.guesses_updated,
+                                                 fitted.nretries])
+    indivspec_list_completed=indivspec_list
 
-    while np.size(np.asarray(indivspec_list) != 0.0):
-        #inputlist=[scouseobjectlist+[indivspec] for indivspec in indivspec_list]
-        inputlist=[indivspec for indivspec in indivspec_list]
+    return indivspec_list_completed
 
-        # if njobs > 1 run in parallel else in series
-        if scouseobject.njobs > 1:
-            results = parallel_map(decomposition_method, inputlist, numcores=scouseobject.njobs, verbose=scouseobject.verbose)
-        else:
-            if scouseobject.verbose:
-                results=[decomposition_method(input) for input in tqdm(inputlist)]
-            else:
-                results=[decomposition_method(input) for input in inputlist]
-
-        # now add model solutions to the relevant spectra and add completed
-        # spectra to an output list
-        for i, result in enumerate(results):
-            model=result[0]
-            guesses_updated=result[1]
-            indivspec=indivspec_list[i]
-            # remove the template
-            setattr(indivspec,'template',None)
-
-            if model is None:
-                if np.size(guesses_updated) == 0.0:
-                    # if the guesses reduces to zero then we consider the
-                    # modelling complete as the fit has failed. So update the
-                    # completed list.
-                    indivspec_list_completed.append(indivspec)
-                    indivspec_list[i]=None
-                else:
-                    # if the model is none but the number of guesses is not zero
-                    # then we will try fit this spectrum again with some new
-                    # initial guesses.
-                    setattr(indivspec,'guesses_updated',guesses_updated,)
-            else:
-                # if a model has been found - update the completed list
-                individual_spectrum.add_model(indivspec, model)
-                indivspec_list_completed.append(indivspec)
-                indivspec_list[i]=None
+def get_fit_key(indivspec, fittype, tol, decimals=6):
+    """
+    Returns the key identifying the fit of a spectrum. Fits with the same key
+    are duplicates.
 
-        indivspec_list = [indivspec for indivspec in indivspec_list if indivspec != None]
+    Parameters
+    ----------
+    indivspec : instance of the individual_spectrum class
+    fittype : string
+        the type of fit scouse will attempt to perform
+    tol : list
+        the tolerance values for comparison with the parent saa spectrum
+    decimals : int
+        number of decimals to which the guesses are rounded
 
-    return indivspec_list_completed
+    """
+    if np.size(indivspec.guesses_updated)<=1:
+        guesses=indivspec.guesses_from_parent
+    else:
+        guesses=indivspec.guesses_updated
+    guesses=np.around(np.asarray(guesses, dtype='float64'), decimals=decimals)
+    return (int(indivspec.index), tuple(guesses.tolist()), str(fittype),
+            tuple(np.asarray(tol, dtype='float64').tolist()))
+
+def deduplicate_fits(indivspec_list, fittype, tol, decimals=6):
+    """
+    Identifies duplicate fits, i.e. the same pixel scheduled more than once
+    with the same guesses
+
+    Parameters
+    ----------
+    indivspec_list : list
+        A list of individual spectra to be fit
+    fittype : string
+        the type of fit scouse will attempt to perform
+    tol : list
+        the tolerance values for comparison with the parent saa spectrum
+    decimals : int
+        number of decimals to which the guesses are rounded
+
+    Returns
+    -------
+    unique_list : list
+        The spectra that need to be fit. The first occurrence of each fit
+    fitids : list
+        For each spectrum in indivspec_list, the position in unique_list of
+        the spectrum whose fit it shares
+
+    """
+    unique_list=[]
+    fitids=[]
+    cache={}
+    for indivspec in indivspec_list:
+        key=get_fit_key(indivspec, fittype, tol, decimals=decimals)
+        if key not in cache:
+            cache[key]=len(unique_list)
+            unique_list.append(indivspec)
+        fitids.append(cache[key])
+
+    return unique_list, fitids
+
+def get_backend(scouseobject):
+    """
+    Returns the fitting backend to be used in stage 3. The native fitter is
+    only available for Gaussian fitting. For other models scouse falls back
+    to pyspeckit.
+
+    Parameters
+    ----------
+    scouseobject : Instance of the scousepy class
+
+    """
+    import warnings
+
+    backend=getattr(scouseobject, 'backend', None)
+    if backend is None:
+        backend='pyspeckit'
+    if backend not in ['pyspeckit', 'native']:
+        raise ValueError("backend must be either 'pyspeckit' or 'native'")
+    if (backend=='native') and (str(scouseobject.fittype).lower()!='gaussian'):
+        warnings.warn("The native fitter is only available for fittype='gaussian'. "
+                      "Using pyspeckit instead.")
+        backend='pyspeckit'
+    return backend
+
+def stack_tasks(inputlist, njobs, maxstack=128):
+    """
+    Groups the fitting tasks into stacks of spectra with the same number of
+    guesses, such that each stack can be fit simultaneously.
+
+    Parameters
+    ----------
+    inputlist : list
+        list of tasks ([index, guesses_from_parent, guesses_updated])
+    njobs : int
+        number of workers. Stacks are kept small enough to give each worker
+        several of them
+    maxstack : int
+        maximum number of spectra in a stack
+
+    Returns
+    -------
+    stacks : list
+        list of arrays containing the positions of the tasks in inputlist
+
+    """
+    nguesses=np.array([np.size(task[1]) if np.size(task[2])<=1 else np.size(task[2])
+                       for task in inputlist])
+    njobs=1 if njobs is None else max(int(njobs), 1)
+    stacksize=int(np.clip(np.ceil(len(inputlist)/(4*njobs)), 1, maxstack))
+
+    stacks=[]
+    for n in np.unique(nguesses):
+        ids=np.flatnonzero(nguesses==n)
+        stacks.extend(np.array_split(ids, int(np.ceil(np.size(ids)/stacksize))))
+    return stacks
+
+def _decompose(scouseobject, indivspec_list, executor, scouseobjectlist, native=False):
+    """
+    Distributes the spectra over the workers. Each spectrum is refit with
+    updated guesses inside the worker until it has either been modelled or its
+    guesses have been exhausted, and the results are collected as they
+    complete. See autonomous_decomposition.
+    """
+    inputlist=[[indivspec.index,indivspec.guesses_from_parent,indivspec.guesses_updated]
+               for indivspec in indivspec_list]
+
+    if native:
+        # the native fitter fits stacks of spectra simultaneously
+        stacks=stack_tasks(inputlist, scouseobject.njobs)
+        for k, stackresult in executor.imap(decomposition_method_stack,
+                                            [[inputlist[i] for i in stack] for stack in stacks],
+                                            context=scouseobjectlist, verbose=scouseobject.verbose):
+            for i, result in zip(stacks[k], stackresult):
+                add_decomposition_result(indivspec_list[i], result)
+    else:
+        for i, result in executor.imap(decomposition_task, inputlist,
+                                       context=scouseobjectlist, verbose=scouseobject.verbose):
+            add_decomposition_result(indivspec_list[i], result)
+
+    # every spectrum is now complete. The list retains the input order
+    return indivspec_list
+
+def add_decomposition_result(indivspec, result):
+    """
+    Adds the outcome of the fitting to an individual spectrum
+
+    Parameters
+    ----------
+    indivspec : instance of the individual_spectrum class
+    result : list
+        the model (None if the fit failed), the updated guesses used for the
+        final attempt, and the number of retries
+
+    """
+    from .model_housing import individual_spectrum
+
+    model, guesses_updated, nretries = result
+    setattr(indivspec,'guesses_updated',guesses_updated)
+    setattr(indivspec,'nretries',nretries)
+    if model is not None:
+        individual_spectrum.add_model(indivspec, model)
+
+def decomposition_task(input):
+    """
+    Fits a spectrum using decomposition_method. If the fit fails but the
+    guesses have been updated, the spectrum is refit with the new guesses
+    until either a model is found or the guesses are exhausted.
+
+    Parameters
+    ----------
+    input : list
+        see decomposition_method
+
+    Returns
+    -------
+        A list containing the model (None if the spectrum could not be fit),
+        the updated guesses used for the final attempt, and the number of
+        retries
+
+    """
+    index,guesses_from_parent,guesses_updated = input[-1]
+    nretries=0
+    while True:
+        task=[index,guesses_from_parent,guesses_updated]
+        model, guesses_new = decomposition_method(list(input[:-1])+[task])
+        if (model is not None) or (np.size(guesses_new) == 0.0):
+            return [model, guesses_updated, nretries]
+        guesses_updated=guesses_new
+        nretries+=1
 
 def decomposition_method(input):
     """
@@ -187,11 +410,13 @@ def decomposition_method(input):
         A list which contains the following:
 
         spectral_axis : an array of the spectral axis
-        specids : a mask over which the spectrum will be fitted
         fittype : the type of fit scouse will attempt to perform
         tol : the tolerance values for comparison with the parent saa spectrum
         res : the channel spacing of the data
-        indivspec : an instance of the individual_spectrum class
+        template : a template pyspeckit spectrum
+        sharedcube : an instance of the SharedCube class holding the spectra
+        task : the index of the spectrum, the guesses from the parent SAA
+               and the updated guesses (if any)
 
     Returns
     -------
@@ -201,25 +426,24 @@ def decomposition_method(input):
     from .SpectralDecomposer import Decomposer
     from .model_housing import indivmodel
 
-    spectral_axis,specids,fittype,tol,res, = scouseobjectlist
-
     # unpack the inputs
-    indivspec = input
-    spectrum=indivspec.spectrum[specids]
-    rms=indivspec.rms
+    spectral_axis,fittype,tol,res,template,sharedcube,task = input
+    index,guesses_from_parent,guesses_updated = task
+    spectrum=np.array(sharedcube.spectrum(index))
+    rms=sharedcube.rms(index)
 
     # set up the decomposer
     decomposer=Decomposer(spectral_axis,spectrum,rms)
-    setattr(decomposer,'psktemplate',indivspec.template,)
+    setattr(decomposer,'psktemplate',template,)
 
     # inputs to initiate the fitter
-    if np.size(indivspec.guesses_updated)<=1:
-        guesses=indivspec.guesses_from_parent
+    if np.size(guesses_updated)<=1:
+        guesses=guesses_from_parent
     else:
-        guesses=indivspec.guesses_updated
+        guesses=guesses_updated
 
     # always pass the parent SAA parameters for comparison
-    guesses_parent=indivspec.guesses_from_parent
+    guesses_parent=guesses_from_parent
 
     # fit the spectrum
     Decomposer.fit_spectrum_from_parent(decomposer,guesses,guesses_parent,tol,res,fittype=fittype,)
@@ -232,13 +456,76 @@ def decomposition_method(input):
 
     return [model,decomposer.guesses_updated]
 
+def decomposition_method_stack(input):
+    """
+    As decomposition_task but for a stack of spectra. Spectra with the same
+    number of guesses are fit simultaneously using the native Gaussian fitter.
+    Those that fail with updated guesses are restacked and refit.
+
+    Parameters
+    ----------
+    input : list
+        As decomposition_method but where the final element is a list of tasks
+
+    Returns
+    -------
+        A list containing the result of each spectrum. See decomposition_task
+
+    """
+    from .SpectralDecomposer import Decomposer
+    from .model_housing import indivmodel
+    from .gaussfit import fit_gaussians
+
+    # unpack the inputs
+    spectral_axis,fittype,tol,res,template,sharedcube,tasks = input
+    spectra, rms = sharedcube.get_spectra([task[0] for task in tasks])
+    guesses_updated=[task[2] for task in tasks]
+    nretries=[0]*len(tasks)
+
+    results=[None]*len(tasks)
+    pending=list(range(len(tasks)))
+    while len(pending)!=0:
+        guesses=[tasks[i][1] if np.size(guesses_updated[i])<=1 else guesses_updated[i]
+                 for i in pending]
+        nguesses=np.array([np.size(guess) for guess in guesses])
+        for n in np.unique(nguesses):
+            ids=np.flatnonzero(nguesses==n)
+            group=[pending[j] for j in ids]
+            groupguesses=np.array([guesses[j] for j in ids], dtype='float64')
+
+            # fit all spectra in the group at once
+            fit=fit_gaussians(spectral_axis, spectra[group], rms[group], groupguesses)
+
+            for k, i in enumerate(group):
+                decomposer=Decomposer(spectral_axis,np.array(spectra[i]),rms[i])
+                setattr(decomposer,'backend','native')
+                nativefit={key: value[k] for key, value in fit.items()}
+                Decomposer.fit_spectrum_from_parent(decomposer,groupguesses[k],tasks[i][1],
+                                                    tol,res,fittype=fittype,nativefit=nativefit)
+                if decomposer.validfit:
+                    results[i]=[indivmodel(decomposer.modeldict),guesses_updated[i],nretries[i]]
+                elif np.size(decomposer.guesses_updated) == 0.0:
+                    results[i]=[None,guesses_updated[i],nretries[i]]
+                else:
+                    # try again with the updated guesses
+                    guesses_updated[i]=decomposer.guesses_updated
+                    nretries[i]+=1
+
+        pending=[i for i in pending if results[i] is None]
+
+    return results
+
 def compile_spectra(scouseobject, indivspec_list_completed):
     """
     Because there are multiple SAAs, at this point there are potentially
     multiple solutions to individual spectra. Here we compile all solutions
     to an individual spectrum, removing any duplicate solutions, and
     wrap them up to a single instance of the individual_spectrum class. These
-    are then sorted and then packaged in a dictionary.
+    are then sorted and then packaged in a ResultStore, which holds them in
+    columns rather than as one object per spectrum.
+
+    The spectra are grouped by index by sorting once, so that the compilation
+    scales as N log N with the number of modelled spectra.
 
     Parameters
     ----------
@@ -248,35 +535,41 @@ def compile_spectra(scouseobject, indivspec_list_completed):
 
     Returns
     -------
-        A dictionary of modelled spectra
+        A ResultStore of modelled spectra
     """
     from tqdm import tqdm
     from .verbose_output import print_to_terminal
+    from .result_store import ResultStore
 
     if scouseobject.verbose:
         progress_bar = print_to_terminal(stage='s3', step='compileinit')
 
     # start by getting all of the indices
     indexarr=np.asarray([indivspec.index for indivspec in indivspec_list_completed])
-
-    # get the unique ones
-    indexarr_unique=np.sort(np.unique(indexarr))
-
-    # create a list to house the output
-    indivspec_list_compiled=[]
-    # loop over the individual spectra
-    inputlist=[[i]+[indexarr]+[indexarr_unique]+[indivspec_list_completed] for i in range(len(indexarr_unique))]
-
+    # the aic values by which we will determine uniqueness
+    aicarr=np.asarray([np.around(indivspec.model_from_parent.AIC, decimals=2)
+                       if indivspec.model_from_parent is not None else np.nan
+                       for indivspec in indivspec_list_completed], dtype='float64')
+
+    # group the spectra by index. The sort is stable so that within each group
+    # the spectra retain their order in indivspec_list_completed
+    order=np.argsort(indexarr, kind='stable')
+    indexarr_unique, starts, counts = np.unique(indexarr[order], return_index=True,
+                                                return_counts=True)
+
+    groups=range(len(indexarr_unique))
     if scouseobject.verbose:
-        results=[compilation_method(input) for input in tqdm(inputlist)]
-    else:
-        results=[compilation_method(input) for input in inputlist]
-
-    # create a dictionary that is going to contain all of our models
-    scouseobject.indiv_dict={}
-    for i, indivspec in enumerate(results):
-        key=indivspec.index
-        scouseobject.indiv_dict[key]=indivspec
+        groups=tqdm(groups)
+
+    # create a store that is going to contain all of our models. The spectra
+    # are copied into it, such that the individual_spectrum objects can be
+    # discarded once compiled
+    scouseobject.indiv_dict=ResultStore(scouseobject.cube.shape[1:])
+    for i in groups:
+        ids=order[starts[i]:starts[i]+counts[i]]
+        inputlist=[[indivspec_list_completed[j] for j in ids], aicarr[ids]]
+        indivspec=compilation_method(inputlist)
+        scouseobject.indiv_dict[indivspec.index]=indivspec
 
 def compilation_method(input):
     """
@@ -287,10 +580,9 @@ def compilation_method(input):
     input : list
         A list which contains the following:
 
-        i : indexing the fitting
-        indexarr : list of all indices contained in indivspec_list_completed
-        indexarr_unique : unique indices in indivspec_list_completed
-        indivspec_list_completed : the list of modelled spectra
+        indivspec_sublist : the modelled spectra of a given index
+        aic_sublist : the rounded aic values of their models (nan where the
+                      spectrum could not be fit)
 
     Returns
     -------
@@ -300,70 +592,33 @@ def compilation_method(input):
 
     """
     # unpack the input
-    i, indexarr, indexarr_unique, indivspec_list_completed = input
-    # identify the locations of the modelled spectra
-    idx=np.where(indexarr==indexarr_unique[i])[0]
-
-    # if the size of idx is 1 there are two possibilities:
-    #   1. the model_from_parent has a none value
-    #   2. there is only one available model
-    # here we add both
-    if np.size(idx)==1:
-        # get the spectrum
-        indivspec=indivspec_list_completed[idx[0]]
-        # create a list of models and saa pointers for the unique values
-        saa_dict_index=[indivspec.saa_dict_index]
-        saaindex=[indivspec.saaindex]
-        model_from_parent=[indivspec.model_from_parent]
-        # add the information to this spectrum
-        setattr(indivspec, 'saa_dict_index', saa_dict_index)
-        setattr(indivspec, 'saaindex', saaindex)
-        setattr(indivspec, 'model_from_parent', model_from_parent)
-    else:
-        # else there are multiple models available for a given solution
-
-        # create a sublist of modelled spectra
-        indivspec_sublist_completed=[indivspec_list_completed[j] for j in idx]
-        # get the aic values for which we will determine uniqueness
-        aic_sublist_completed=[np.around(indivspec.model_from_parent.AIC, decimals=2) if indivspec.model_from_parent is not None else np.nan for indivspec in indivspec_sublist_completed]
-
-        # convert to arrays
-        aic_subarr_completed=np.asarray(aic_sublist_completed)
-        indivspec_subarr_completed = np.asarray(indivspec_sublist_completed)
+    indivspec_sublist, aic_sublist = input
+    aic_sublist=np.asarray(aic_sublist)
 
+    if not np.any(~np.isnan(aic_sublist)):
         # if in all cases the spectrum could not be fit and therefore
-        # model_from_parent==None in all cases just take the first and
-        # update
-        if not np.any(~np.isnan(aic_subarr_completed)):
-            # select the first model from the list
-            indivspec=indivspec_subarr_completed[0]
-            # create a list of models and saa pointers for the unique values
-            saa_dict_index=[indivspec.saa_dict_index]
-            saaindex=[indivspec.saaindex]
-            model_from_parent=[indivspec.model_from_parent]
-            # add the information to this spectrum
-            setattr(indivspec, 'saa_dict_index', saa_dict_index)
-            setattr(indivspec, 'saaindex', saaindex)
-            setattr(indivspec, 'model_from_parent', model_from_parent)
-        else:
-            # find the unique (non-nan) aic values
-            uniqvals, uniqids = np.unique(aic_subarr_completed, return_index=True)
-            # at this point there may still be nans in the aic array
-            idnotnan=np.where(~np.isnan(uniqvals))[0]
-            # remove these but retain the reference to the original array
-            uniqvals=uniqvals[idnotnan]
-            uniqids=uniqids[idnotnan]
-
-            # create a list of models and saa pointers for the unique values
-            saa_dict_index=[indivspec.saa_dict_index for indivspec in indivspec_subarr_completed[uniqids]]
-            saaindex=[indivspec.saaindex for indivspec in indivspec_subarr_completed[uniqids]]
-            model_from_parent=[indivspec.model_from_parent for indivspec in indivspec_subarr_completed[uniqids]]
-            # select the first model from the list
-            indivspec=indivspec_subarr_completed[uniqids[0]]
-            # add the information to this
-            setattr(indivspec, 'saa_dict_index', saa_dict_index)
-            setattr(indivspec, 'saaindex', saaindex)
-            setattr(indivspec, 'model_from_parent', model_from_parent)
+        # model_from_parent==None in all cases (or if there is only one
+        # spectrum) just take the first and update
+        uniqids=np.array([0])
+    else:
+        # find the unique (non-nan) aic values
+        uniqvals, uniqids = np.unique(aic_sublist, return_index=True)
+        # at this point there may still be nans in the aic array. Remove these
+        # but retain the reference to the original array
+        uniqids=uniqids[~np.isnan(uniqvals)]
+
+    # create a list of models and saa pointers for the unique values
+    saa_dict_index=[indivspec_sublist[j].saa_dict_index for j in uniqids]
+    saaindex=[indivspec_sublist[j].saaindex for j in uniqids]
+    model_from_parent=[indivspec_sublist[j].model_from_parent for j in uniqids]
+    nretries=[indivspec_sublist[j].nretries for j in uniqids]
+    # select the first model from the list
+    indivspec=indivspec_sublist[uniqids[0]]
+    # add the information to this spectrum
+    setattr(indivspec, 'saa_dict_index', saa_dict_index)
+    setattr(indivspec, 'saaindex', saaindex)
+    setattr(indivspec, 'model_from_parent', model_from_parent)
+    setattr(indivspec, 'nretries', nretries)
 
     return indivspec
 
@@ -6,6 +6,7 @@ from astropy.table import Table
 from astropy.table import Column
 
 from .io import get_headings
+from .result_store import ResultStore
 
 class stats(object):
     def __init__(self, scouseobject=None):
@@ -30,7 +31,8 @@ class stats(object):
         self._meanchisq = None
         self._meanredchisq = None
         self._meanAIC = None
-        
+        self._results = None
+
         self._nspec = get_nspec(self, scouseobject)
         self._nsaa, self._nsaa_indiv = get_nsaa(self,scouseobject)
         self._nspecsaa, self._nspecsaa_indiv = get_nspecsaa(self, scouseobject)
@@ -41,6 +43,7 @@ class stats(object):
 
         if 's4' in scouseobject.completed_stages:
 
+            self._results = ResultStore.from_scouseobject(scouseobject)
             self._nfits = get_nfits(self, scouseobject)
             self._ncomps = get_ncomps(self, scouseobject)
             self._noriginal = get_noriginal(self, scouseobject)
@@ -297,37 +300,29 @@ def get_saa_stats(self, scouseobject):
     return stat_dict
 
 
+def get_results(self, scouseobject):
+    """
+    Returns the columnar store of the best-fitting solutions
+    """
+    if self._results is None:
+        self._results = ResultStore.from_scouseobject(scouseobject)
+    return self._results
+
 def get_param_stats(self, scouseobject):
     """
     Calculates statistics for parameters
     """
+    results = get_results(self, scouseobject)
+    nparams = results.nparams
+    fitted = results.fitted
 
-    keys = list(scouseobject.indiv_dict.keys())
-    nparams = np.size(scouseobject.indiv_dict[keys[0]].model.parnames)
-
-    ncomps = []
-    params = []
-    errors = []
-    rms = []
-    residstd = []
-    chisq = []
-    redchisq = []
-    AIC = []
-
-    for key in keys:
-        spectrum = scouseobject.indiv_dict[key]
-        if spectrum.model is not None:
-            if spectrum.model.ncomps != 0.0:
-                ncomps.append(spectrum.model.ncomps)
-                rms.append(spectrum.rms)
-                residstd.append(spectrum.model.residstd)
-                chisq.append(spectrum.model.chisq)
-                redchisq.append(spectrum.model.redchisq)
-                AIC.append(spectrum.model.AIC)
-
-                for i in range(0, int(spectrum.model.ncomps)):
-                    params.append(spectrum.model.params[(i*len(spectrum.model.parnames)):(i*len(spectrum.model.parnames))+len(spectrum.model.parnames)])
-                    errors.append(spectrum.model.errors[(i*len(spectrum.model.parnames)):(i*len(spectrum.model.parnames))+len(spectrum.model.parnames)])
+    ncomps = results.ncomps[fitted]
+    rms = results.specrms[fitted]
+    residstd = results.residstd[fitted]
+    chisq = results.chisq[fitted]
+    redchisq = results.redchisq[fitted]
+    AIC = results.AIC[fitted]
+    rows, params, errors = results.get_components(mask=fitted)
 
     commonstats = [ncomps, rms, residstd, chisq, redchisq, AIC]
     commonstatkeys = ['ncomps','rms','residstd','chisq','redchisq','AIC']
@@ -397,25 +392,15 @@ def get_residratio(self, scouseobject):
     """
     Calculates mean ratio of resid/rms
     """
-    rmslist=[]
-    residlist=[]
-    for key in scouseobject.indiv_dict.keys():
-        if scouseobject.indiv_dict[key].model is not None:
-            if scouseobject.indiv_dict[key].model.ncomps != 0.0:
-                rmslist.append(scouseobject.indiv_dict[key].model.rms)
-                residlist.append(scouseobject.indiv_dict[key].model.residstd)
-    return (np.asarray(residlist)/np.asarray(rmslist)).mean(axis=0)
+    results = get_results(self, scouseobject)
+    fitted = results.fitted
+    return (results.residstd[fitted]/results.rms[fitted]).mean(axis=0)
 
 def get_nfits(self, scouseobject):
     """
     Calculates number of non-dud fits
     """
-    fits=[]
-    for key in scouseobject.indiv_dict.keys():
-        if scouseobject.indiv_dict[key].model is not None:
-            if scouseobject.indiv_dict[key].model.ncomps != 0.0:
-                fits.append(1)
-    return np.size(fits)
+    return int(np.count_nonzero(get_results(self, scouseobject).fitted))
 
 def get_nspec(self, scouseobject):
     """
@@ -427,23 +412,15 @@ def get_ncomps(self, scouseobject):
     """
     Calculates number of components
     """
-    fits=[]
-    for key in scouseobject.indiv_dict.keys():
-        if scouseobject.indiv_dict[key].model is not None:
-            if scouseobject.indiv_dict[key].model.ncomps != 0.0:
-                fits.append(scouseobject.indiv_dict[key].model.ncomps)
-    return np.sum(fits)
+    results = get_results(self, scouseobject)
+    return int(np.sum(results.ncomps[results.fitted]))
 
 def get_nmultiple(self, scouseobject):
     """
     Calculates number of components
     """
-    fits=[]
-    for key in scouseobject.indiv_dict.keys():
-        if scouseobject.indiv_dict[key].model is not None:
-            if scouseobject.indiv_dict[key].model.ncomps > 1.0:
-                fits.append(1)
-    return np.size(fits)
+    results = get_results(self, scouseobject)
+    return int(np.count_nonzero(results.has_model & (results.ncomps > 1.0)))
 
 def get_ncomps_saa(self, scouseobject):
     """
@@ -529,36 +506,21 @@ def get_nrefit(self, scouseobject):
     Get the number of spectra that were manually refitted.
     """
 
-    nrefit = 0.0
-    for key in scouseobject.indiv_dict.keys():
-        spectrum = scouseobject.indiv_dict[key]
-        if spectrum.decision == 'refit':
-            nrefit+=1
-
-    return nrefit
+    results = get_results(self, scouseobject)
+    return float(np.count_nonzero(results.decision == 'refit'))
 
 def get_nalt(self, scouseobject):
     """
     Get the number of spectra that were manually refitted.
     """
 
-    nalt = 0.0
-    for key in scouseobject.indiv_dict.keys():
-        spectrum = scouseobject.indiv_dict[key]
-        if spectrum.decision == 'alternative':
-            nalt+=1
-
-    return nalt
+    results = get_results(self, scouseobject)
+    return float(np.count_nonzero(results.decision == 'alternative'))
 
 def get_noriginal(self, scouseobject):
     """
     Get the number of spectra that were manually refitted.
     """
 
-    noriginal = 0.0
-    for key in scouseobject.indiv_dict.keys():
-        spectrum = scouseobject.indiv_dict[key]
-        if spectrum.decision == 'original':
-            noriginal+=1
-
-    return noriginal
+    results = get_results(self, scouseobject)
+    return float(np.count_nonzero(results.decision == 'original'))
@@ -0,0 +1,408 @@
+# Licensed under an MIT open source license - see LICENSE
+
+"""
+Model synthesis engine.
+
+Evaluates the best-fitting models directly from the parameter arrays of a
+ResultStore, in tiles of rows of the map, rather than building a pyspeckit
+Spectrum for every pixel. Gaussian profiles are evaluated natively. Other
+fittypes use the model function of the corresponding pyspeckit fitter unless
+a vectorised profile has been registered with register_profile.
+
+The tiles can be written straight into a FITS file which is memory mapped
+from disk, such that model cubes larger than the available memory can be
+produced. Residual cubes and their statistics are produced in the same way,
+reading the data one tile at a time.
+"""
+
+import numpy as np
+
+__all__ = ('gaussian_profile', 'register_profile', 'get_profile',
+           'get_model_components', 'model_spectra', 'model_tile',
+           'get_tiles', 'create_fits_file', 'synthesise_cube',
+           'residual_statistics', 'synthesise_residuals')
+
+def gaussian_profile(x, params):
+    """
+    Evaluates Gaussian components
+
+    Parameters
+    ----------
+    x : ndarray
+        the spectral axis, shape (nchan,)
+    params : ndarray
+        the parameters of each component (amplitude, shift, width), shape
+        (ncomponents, 3)
+
+    Returns
+    -------
+    profiles : ndarray
+        the profile of each component, shape (ncomponents, nchan)
+
+    """
+    amp=params[:,0,np.newaxis]
+    shift=params[:,1,np.newaxis]
+    width=params[:,2,np.newaxis]
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        return amp*np.exp(-0.5*((x[np.newaxis,:]-shift)/width)**2)
+
+# vectorised profiles, keyed by fittype
+_profiles={'gaussian': gaussian_profile}
+
+def register_profile(fittype, function):
+    """
+    Registers a vectorised profile
+
+    Parameters
+    ----------
+    fittype : string
+        the fittype (as used by pyspeckit)
+    function : callable
+        function(x, params) returning the profiles of the components, where
+        params has shape (ncomponents, nparams). See gaussian_profile
+
+    """
+    _profiles[fittype]=function
+
+def get_profile(fittype):
+    """
+    Returns the vectorised profile of a given fittype. If none has been
+    registered, the model function of pyspeckit's fitter is evaluated for
+    each component in turn.
+    """
+    if fittype in _profiles:
+        return _profiles[fittype]
+
+    from pyspeckit.spectrum.fitters import default_Registry
+    if fittype not in default_Registry.multifitters:
+        raise ValueError("Unknown fittype: {0}".format(fittype))
+    fitter=default_Registry.multifitters[fittype]
+
+    def profile(x, params):
+        profiles=np.empty((np.shape(params)[0], np.size(x)))
+        for k in range(np.shape(params)[0]):
+            profiles[k]=fitter.n_modelfunc(list(params[k]), **fitter.modelfunc_kwargs)(x)
+        return profiles
+
+    return profile
+
+def get_model_components(store):
+    """
+    Gathers the components of the best-fitting models of a ResultStore
+
+    Parameters
+    ----------
+    store : instance of the ResultStore class
+
+    Returns
+    -------
+    components : dictionary
+        index : flattened pixel index of each component (sorted)
+        params : parameters of each component, shape (ncomponents, nparams)
+        fittype : fittype of each component
+        modelled : flattened pixel indices of the models with at least one
+                   component (sorted)
+        has_model : flattened pixel indices of all of the best-fitting
+                    models, including those with zero components (sorted)
+
+    """
+    if not store.is_sorted:
+        # e.g. spectra added during stage 4 are appended to the store
+        store.sort()
+    rows, params, errors = store.get_components()
+    return {'index': store.index[rows], 'params': params,
+            'fittype': store.fittype[rows],
+            'modelled': store.index[store.fitted],
+            'has_model': store.index[store.has_model]}
+
+def model_spectra(x, params, fittype, pixels):
+    """
+    Evaluates the total model of each pixel
+
+    Parameters
+    ----------
+    x : ndarray
+        the spectral axis
+    params : ndarray
+        parameters of each component, shape (ncomponents, nparams)
+    fittype : ndarray
+        fittype of each component
+    pixels : ndarray
+        pixel to which each component belongs. Must be sorted
+
+    Returns
+    -------
+    unique : ndarray
+        the pixels
+    models : ndarray
+        the model of each pixel, shape (npixels, nchan)
+
+    """
+    x=np.asarray(x, dtype='float64')
+    unique, starts = np.unique(pixels, return_index=True)
+    profiles=np.empty((np.size(pixels), np.size(x)))
+    for name in np.unique(fittype):
+        ids=np.flatnonzero(fittype==name)
+        profiles[ids]=get_profile(name)(x, params[ids])
+    # components which cannot be evaluated are ignored, as in np.nansum
+    profiles[~np.isfinite(profiles)]=0.0
+    if np.size(unique)==0:
+        return unique, profiles
+    return unique, np.add.reduceat(profiles, starts, axis=0)
+
+def model_tile(x, components, shape, y0, y1, dtype='float32'):
+    """
+    Evaluates the models of rows y0 to y1 (exclusive) of the map
+
+    Parameters
+    ----------
+    x : ndarray
+        the spectral axis
+    components : dictionary
+        see get_model_components
+    shape : tuple
+        (y, x) shape of the map
+    y0, y1 : int
+        the rows of the tile
+
+    Returns
+    -------
+    tile : ndarray
+        the models, shape (nchan, y1-y0, nx). Pixels without a model (or with
+        zero components) are NaN
+
+    """
+    nx=shape[1]
+    i0, i1 = np.searchsorted(components['index'], [y0*nx, y1*nx])
+    tile=np.full((np.size(x), (y1-y0)*nx), np.nan, dtype=dtype)
+
+    pixels, models = model_spectra(x, components['params'][i0:i1],
+                                   components['fittype'][i0:i1],
+                                   components['index'][i0:i1])
+    tile[:, pixels-y0*nx]=models.T
+
+    return tile.reshape(np.size(x), y1-y0, nx)
+
+def get_tiles(shape, nchan, tilesize=2**22):
+    """
+    Divides the map into tiles of rows
+
+    Parameters
+    ----------
+    shape : tuple
+        (y, x) shape of the map
+    nchan : int
+        number of channels
+    tilesize : int
+        approximate number of elements (pixels times channels) per tile
+
+    Returns
+    -------
+    tiles : list
+        (y0, y1) of each tile
+
+    """
+    ny, nx = shape
+    nrows=int(np.clip(tilesize//max(nx*nchan, 1), 1, ny))
+    return [(y0, min(y0+nrows, ny)) for y0 in range(0, ny, nrows)]
+
+def create_fits_file(filename, header, shape, overwrite=True):
+    """
+    Creates a float32 FITS file of a given shape without holding the data in
+    memory. The data can then be written through a memory map, e.g. using
+    astropy.io.fits.open(filename, mode='update', memmap=True)
+
+    Parameters
+    ----------
+    filename : string
+        output file
+    header : FITS header
+        header of the cube (e.g. the WCS)
+    shape : tuple
+        numpy shape of the data, i.e. (nchan, ny, nx)
+    overwrite : bool
+        overwrite an existing file
+
+    """
+    import os
+    from astropy.io import fits
+
+    if os.path.exists(filename):
+        if not overwrite:
+            raise IOError("File {0} already exists".format(filename))
+        os.remove(filename)
+
+    hdu=fits.PrimaryHDU(data=np.zeros((1,)*len(shape), dtype='float32'))
+    newheader=hdu.header
+    skip=['', 'COMMENT', 'HISTORY', 'BSCALE', 'BZERO', 'BLANK']
+    for card in header.cards:
+        if (card.keyword in newheader) or (card.keyword in skip) or \
+           card.keyword.startswith('NAXIS'):
+            continue
+        newheader.append(card)
+    for i, n in enumerate(shape[::-1], start=1):
+        newheader['NAXIS{0}'.format(i)]=int(n)
+
+    nbytes=int(np.prod(shape))*4
+    nbytes=((nbytes+2879)//2880)*2880
+    newheader.tofile(filename)
+    with open(filename, 'rb+') as fh:
+        fh.seek(len(newheader.tostring())+nbytes-1)
+        fh.write(b'\0')
+
+def synthesise_cube(x, components, shape, out, njobs=1, tilesize=2**22,
+                    transform=None, verbose=False):
+    """
+    Evaluates the models of the whole map tile by tile, writing each tile into
+    out. The tiles are evaluated in parallel
+
+    Parameters
+    ----------
+    x : ndarray
+        the spectral axis
+    components : dictionary
+        see get_model_components
+    shape : tuple
+        (y, x) shape of the map
+    out : ndarray
+        array of shape (nchan, ny, nx), e.g. the memory-mapped data of a FITS
+        file
+    njobs : int
+        number of processes
+    tilesize : int
+        approximate number of elements per tile
+    transform : callable, optional
+        function(tile, y0, y1) applied to each model tile before it is written
+    verbose : bool
+        display a progress bar
+
+    """
+    from .executor import get_executor
+
+    tiles=get_tiles(shape, np.size(x), tilesize=tilesize)
+    executor=get_executor(njobs)
+    for i, tile in executor.imap(synthesise_tile, tiles,
+                                 context=[x, components, shape],
+                                 verbose=verbose):
+        y0, y1 = tiles[i]
+        if transform is not None:
+            tile=transform(tile, y0, y1)
+        out[:, y0:y1, :]=tile
+
+def synthesise_tile(input):
+    """
+    Evaluates the models of a tile. Parallelised.
+    """
+    x, components, shape, (y0, y1) = input
+    return model_tile(x, components, shape, y0, y1)
+
+def residual_statistics(residuals):
+    """
+    Computes the rms, maximum and skewness of the residuals of each spectrum
+
+    Parameters
+    ----------
+    residuals : ndarray
+        the residuals, with the spectral axis first. NaNs are ignored
+
+    Returns
+    -------
+    statistics : ndarray
+        the rms, maximum and skewness, shape (3,)+residuals.shape[1:]
+
+    """
+    import warnings
+    residuals=np.asarray(residuals, dtype='float64')
+    with warnings.catch_warnings():
+        # spectra without any valid channels
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        mean=np.nanmean(residuals, axis=0)
+        rms=np.sqrt(np.nanmean(residuals**2, axis=0))
+        _max=np.nanmax(residuals, axis=0)
+        deviation=residuals-mean
+        m2=np.nanmean(deviation**2, axis=0)
+        m3=np.nanmean(deviation**3, axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            skew=m3/m2**1.5
+    return np.array([rms, _max, skew])
+
+def synthesise_residuals(x, components, cube, out, out_model=None,
+                         channels=None, njobs=1, tilesize=2**22, verbose=False):
+    """
+    Computes the residuals of the whole map tile by tile in a single pass over
+    the cube. Each worker reads a tile of the cube, evaluates the models of
+    the tile and returns the residuals and their statistics
+
+    Parameters
+    ----------
+    x : ndarray
+        the spectral axis
+    components : dictionary
+        see get_model_components
+    cube : spectral cube
+        the data. The residuals are computed from the unmasked data, i.e. the
+        spectra which were fitted
+    out : ndarray
+        array of shape (nchan, ny, nx) receiving the residuals, e.g. the
+        memory-mapped data of a FITS file. Pixels without a model are NaN. The
+        residuals of models with zero components are the data
+    out_model : ndarray, optional
+        array of shape (nchan, ny, nx) receiving the models
+    channels : ndarray, optional
+        the channels over which the residual statistics are computed, e.g.
+        those within vel_range. Default is all channels
+    njobs : int
+        number of processes
+    tilesize : int
+        approximate number of elements per tile
+    verbose : bool
+        display a progress bar
+
+    Returns
+    -------
+    statistics : ndarray
+        maps of the rms, maximum and skewness of the residuals, shape
+        (3, ny, nx)
+
+    """
+    from .executor import get_executor
+
+    shape=cube.shape[1:]
+    statistics=np.full((3,)+tuple(shape), np.nan)
+    tiles=get_tiles(shape, np.size(x), tilesize=tilesize)
+    executor=get_executor(njobs)
+    for i, result in executor.imap(synthesise_residual_tile, tiles,
+                                   context=[x, components, cube, channels, out_model is not None],
+                                   verbose=verbose):
+        y0, y1 = tiles[i]
+        model, residuals, statistics[:, y0:y1, :] = result
+        out[:, y0:y1, :]=residuals
+        if out_model is not None:
+            out_model[:, y0:y1, :]=model
+
+    return statistics
+
+def synthesise_residual_tile(input):
+    """
+    Computes the residuals of a tile and their statistics. Parallelised.
+    """
+    x, components, cube, channels, return_model, (y0, y1) = input
+    shape=cube.shape[1:]
+    nx=shape[1]
+    model=model_tile(x, components, shape, y0, y1)
+    # the unmasked data, as fitted (cube[:, y, x].value)
+    data=cube.unmasked_data[:, y0:y1, :].value
+
+    # pixels with a model of zero components have a model of zero
+    i0, i1 = np.searchsorted(components['has_model'], [y0*nx, y1*nx])
+    has_model=np.zeros((y1-y0)*nx, dtype='bool')
+    has_model[components['has_model'][i0:i1]-y0*nx]=True
+    has_model=has_model.reshape(y1-y0, nx)
+
+    residuals=np.where(has_model, data-np.nan_to_num(model), np.nan).astype('float32')
+    if channels is None:
+        statistics=residual_statistics(residuals)
+    else:
+        statistics=residual_statistics(residuals[channels])
+
+    return (model if return_model else None), residuals, statistics
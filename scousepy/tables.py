@@ -0,0 +1,234 @@
+# Licensed under an MIT open source license - see LICENSE
+
+"""
+Streaming writers for the tables of best-fitting model solutions.
+
+The rows of the table (one per component, see io.get_soln_desc) are generated
+in chunks directly from the parameter arrays of a ResultStore and written out
+as they are produced, such that the full table is never held in memory. The
+tables can be written as delimited text, as a FITS binary table, or as a
+compressed, columnar .npz file which can be read with numpy.load.
+"""
+
+import os
+import shutil
+import zipfile
+import numpy as np
+
+__all__ = ('get_table_headings', 'get_table_nrows', 'iter_table_chunks',
+           'write_ascii_table', 'write_fits_table', 'write_npz_table',
+           'write_table')
+
+# columns preceding and following the parameters
+_before=['ncomps', 'x', 'y']
+_after=['rms', 'residual', 'chisq', 'dof', 'redchisq', 'aic']
+
+def get_table_headings(store):
+    """
+    Returns the headings of the table, as in io.get_headings
+    """
+    parnames=store.parnames if store.parnames is not None else []
+    headings_pars=[]
+    for parname in parnames:
+        headings_pars.extend([parname, 'err {0}'.format(parname)])
+    return _before+headings_pars+_after
+
+def _get_rows(store, mask=None):
+    """
+    The rows of the store included in the table
+    """
+    if mask is None:
+        mask=store.has_model
+    return np.flatnonzero(mask)
+
+def get_table_nrows(store, mask=None):
+    """
+    Returns the number of rows of the table. Models with zero components
+    contribute a single row
+    """
+    rows=_get_rows(store, mask=mask)
+    return int(np.sum(np.maximum(np.nan_to_num(store.ncomps[rows]).astype('int64'), 1)))
+
+def iter_table_chunks(store, mask=None, chunksize=2**16):
+    """
+    Generates the table in chunks
+
+    Parameters
+    ----------
+    store : instance of the ResultStore class
+    mask : ndarray, optional
+        only include the rows of the store within this mask. Default is all
+        rows with a model
+    chunksize : int
+        number of spectra per chunk
+
+    Yields
+    ------
+    chunk : ndarray
+        the rows of the table, shape (nrows, ncolumns)
+
+    """
+    rows=_get_rows(store, mask=mask)
+    # without parameter names there are no parameter columns (see
+    # get_table_headings)
+    nparams=0 if store.parnames is None else store.nparams
+    for start in range(0, np.size(rows), chunksize):
+        components, params, errors = store.get_components(rows=rows[start:start+chunksize],
+                                                          include_empty=True)
+        chunk=np.empty((np.size(components), 3+2*nparams+6))
+        chunk[:,0]=store.ncomps[components]
+        chunk[:,1]=store.x[components]
+        chunk[:,2]=store.y[components]
+        # interleave the parameters and their uncertainties
+        if nparams > 0:
+            chunk[:,3:3+2*nparams:2]=params
+            chunk[:,4:4+2*nparams:2]=errors
+        for j, name in enumerate(['rms', 'residstd', 'chisq', 'dof', 'redchisq', 'AIC']):
+            chunk[:,3+2*nparams+j]=getattr(store, name)[components]
+        yield chunk
+
+def write_ascii_table(filename, headings, chunks, delimiter='\t', fmt='%.16g'):
+    """
+    Writes a delimited text table
+
+    Parameters
+    ----------
+    filename : string
+        output file
+    headings : list
+        the column names
+    chunks : iterable
+        the rows of the table, in chunks
+    delimiter : string
+        column delimiter
+    fmt : string
+        format of the values
+
+    """
+    # column names containing the delimiter or spaces are quoted, as astropy
+    names=[('"'+name+'"') if ((' ' in name) or (delimiter in name)) else name for name in headings]
+    with open(filename, 'w') as fh:
+        fh.write(delimiter.join(names)+'\n')
+        for chunk in chunks:
+            np.savetxt(fh, chunk, fmt=fmt, delimiter=delimiter)
+
+def write_fits_table(filename, headings, chunks, nrows, overwrite=True):
+    """
+    Writes a FITS binary table. The data are streamed to the file after the
+    header, such that the number of rows must be known in advance
+
+    Parameters
+    ----------
+    filename : string
+        output file
+    headings : list
+        the column names
+    chunks : iterable
+        the rows of the table, in chunks
+    nrows : int
+        total number of rows
+    overwrite : bool
+        overwrite an existing file
+
+    """
+    from astropy.io import fits
+
+    if os.path.exists(filename) and not overwrite:
+        raise IOError("File {0} already exists".format(filename))
+
+    columns=[fits.Column(name=name, format='D') for name in headings]
+    header=fits.BinTableHDU.from_columns(columns, nrows=0).header
+    header['NAXIS2']=nrows
+    header['EXTNAME']='SOLUTIONS'
+
+    written=0
+    with open(filename, 'wb') as fh:
+        fh.write(fits.PrimaryHDU().header.tostring().encode('ascii'))
+        fh.write(header.tostring().encode('ascii'))
+        for chunk in chunks:
+            fh.write(np.ascontiguousarray(chunk, dtype='>f8').tobytes())
+            written+=np.shape(chunk)[0]
+        if written!=nrows:
+            raise ValueError("Expected {0} rows but {1} were written".format(nrows, written))
+        size=written*8*len(headings)
+        fh.write(b'\0'*((-size)%2880))
+
+def write_npz_table(filename, headings, chunks, nrows, compress=True):
+    """
+    Writes a columnar .npz file, with one array per column, readable with
+    numpy.load. The columns are first streamed to temporary memory-mapped
+    files, and then compressed into the archive one at a time
+
+    Parameters
+    ----------
+    filename : string
+        output file
+    headings : list
+        the column names
+    chunks : iterable
+        the rows of the table, in chunks
+    nrows : int
+        total number of rows
+    compress : bool
+        deflate the columns
+
+    """
+    tmpdir=filename+'.tmp'
+    if os.path.exists(tmpdir):
+        shutil.rmtree(tmpdir)
+    os.makedirs(tmpdir)
+
+    try:
+        columns=[np.lib.format.open_memmap(os.path.join(tmpdir, '{0}.npy'.format(j)),
+                                           mode='w+', dtype='float64', shape=(nrows,))
+                 for j in range(len(headings))]
+        start=0
+        for chunk in chunks:
+            for j, column in enumerate(columns):
+                column[start:start+np.shape(chunk)[0]]=chunk[:,j]
+            start+=np.shape(chunk)[0]
+        for column in columns:
+            column.flush()
+        del columns
+
+        compression=zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+        with zipfile.ZipFile(filename, mode='w', compression=compression, allowZip64=True) as zf:
+            for j, name in enumerate(headings):
+                with open(os.path.join(tmpdir, '{0}.npy'.format(j)), 'rb') as src, \
+                     zf.open(name+'.npy', mode='w', force_zip64=True) as dst:
+                    shutil.copyfileobj(src, dst, 2**24)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def write_table(store, filename, format='ascii', mask=None, chunksize=2**16,
+                delimiter='\t'):
+    """
+    Writes the table of best-fitting model solutions
+
+    Parameters
+    ----------
+    store : instance of the ResultStore class
+    filename : string
+        output file
+    format : string
+        'ascii' (delimited text), 'fits' (binary table) or 'npz' (compressed
+        columnar)
+    mask : ndarray, optional
+        only include the rows of the store within this mask. Default is all
+        rows with a model
+    chunksize : int
+        number of spectra per chunk
+    delimiter : string
+        column delimiter of the ascii table
+
+    """
+    headings=get_table_headings(store)
+    chunks=iter_table_chunks(store, mask=mask, chunksize=chunksize)
+    if format=='ascii':
+        write_ascii_table(filename, headings, chunks, delimiter=delimiter)
+    elif format=='fits':
+        write_fits_table(filename, headings, chunks, get_table_nrows(store, mask=mask))
+    elif format=='npz':
+        write_npz_table(filename, headings, chunks, get_table_nrows(store, mask=mask))
+    else:
+        raise ValueError("Unknown format: {0}".format(format))
@@ -96,6 +96,11 @@ def print_to_terminal(stage='', step='', length=None, var=None, t1=None, t2=None
             print("")
             print(colors.fg._lightblue_+"Beginning stage_3 analysis..."+colors._endc_)
             progress_bar=[]
+        if step=='extract':
+            print("")
+            rate=length/(t2-t1) if t2 > t1 else float('inf')
+            print('Extracted {0} spectra in {1:.2f} seconds ({2:.0f} spectra per second)'.format(length, t2-t1, rate))
+            progress_bar=[]
         if step=='init':
             if length != None:
                 print("")
@@ -112,6 +117,10 @@ def print_to_terminal(stage='', step='', length=None, var=None, t1=None, t2=None
             print('Fitting spectra...')
             print("")
             progress_bar = []
+        if step=='dedup':
+            print('Duplicate fits skipped: {0} of {1}'.format(var, length))
+            print("")
+            progress_bar=[]
         if step=='fitting':
             if length != None:
                 progress_bar = length
@@ -171,6 +180,9 @@ def print_to_terminal(stage='', step='', length=None, var=None, t1=None, t2=None
         if step=='diagnostics':
             if length != None:
                 progress_bar = tqdm(total=length, position=0, leave=True)
+        if step=='refit':
+            print("Refit sweep {0}: {1} tiles, {2} models accepted".format(var[0], var[1], var[2]))
+            progress_bar=[]
         if step=='end':
             if np.size(var) == 1:
                 print("A single spectrum was inspected.")